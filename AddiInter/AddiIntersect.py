@@ -1,5 +1,15 @@
 import os
-import geopandas as gpd
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Common.AreaEngine import reproject, shares
+from Common.Catalog import find_layer
+from Common.CountyStore import county_layer_path
+from Common.GeoStore import layer_crs, read_layer
+from Common.OverlayKernel import intersect, overlay_options
+from Common.Preprocess import preprocess_dir, preprocess_layer
+from Common.RunLog import StageLog
+from Common.TaskGuard import run_with_fallback
 
 states_fips_codes = {
     'Alabama': '01',
@@ -60,6 +70,11 @@ states_fips_codes = {
 
 
 def construct_shapefile_paths(year, state, layer_type, base_dir='D:\\UMich\\Win24\\IntersectionProject'):
+    # an input recorded in the input catalog is taken from it, see Common/Catalog.py
+    catalogued = find_layer(os.path.join(base_dir, 'shapefiles'), 'CoC_Merged' if layer_type == 'CoC' else layer_type,
+                            year, state, states_fips_codes.get(state))
+    if catalogued is not None:
+        return catalogued
     if layer_type == 'CoC':
         layer_dir = os.path.join(base_dir, 'shapefiles', 'CoC_Merged', str(year), state,
                                         f"{state.replace(' ', '_')}_{year}_CoC_Merged.shp")
@@ -71,6 +86,9 @@ def construct_shapefile_paths(year, state, layer_type, base_dir='D:\\UMich\\Win2
         layer_dir = os.path.join(base_dir, 'shapefiles', 'counties', str(year),
                                        f"{fips}_{state.upper().replace(' ', '_')}",
                                        f"{county_prefix}_{year}_{fips}_county{county_suffix}.shp")
+        # from 2011 on the counties of the state are a partition of the county store, see Common/CountyStore.py
+        if year >= 2011:
+            layer_dir = county_layer_path(os.path.join(base_dir, 'shapefiles', 'counties'), year, fips, layer_dir)
         return layer_dir
     elif layer_type == 'county subdivisions':
         subdivisions_prefix = 'fe' if year == 2007 else 'tl'
@@ -91,100 +109,141 @@ def construct_shapefile_paths(year, state, layer_type, base_dir='D:\\UMich\\Win2
         return layer_dir
 
 
+# the census layers a CoC layer can be intersected with
+census_layers = ('counties', 'Census places', 'county subdivisions')
 
-def perform_intersections(intersections, base_dir='D:\\UMich\\Win24\\IntersectionProject'):
-    for year, combinations in intersections.items():
-        for combo in combinations:
-            state_a, layer_a, state_b, layer_b = combo
-            fips_a = states_fips_codes[state_a]
-            fips_b = states_fips_codes[state_b]
-
-            # Construct paths for each layer
-            layer_a_path = construct_shapefile_paths(year, state_a, layer_a, base_dir)
-            layer_b_path = construct_shapefile_paths(year, state_b, layer_b, base_dir)
-
-            # Read the shapefiles
-            gdf_a = gpd.read_file(layer_a_path)
-            gdf_b = gpd.read_file(layer_b_path)
-
-            # Ensure CRS match or reproject
-            if gdf_a.crs is None:
-                print(f"Missing CRS for shapefile: {layer_a_path}, passing for now")
-                continue
-            if gdf_b is None:
-                print(f"Missing CRS for shapefile: {layer_b_path}, passing for now")
-                continue
-            try:
-                if gdf_a.crs != gdf_b.crs:
-                    gdf_b = gdf_b.to_crs(gdf_a.crs)
-            except ValueError as e:
-                print(f"Error reprojecting CoC shapefile: {e}")
-                continue
 
-            # Perform intersection
+def check_census_layer(layer_type):
+    if layer_type not in census_layers:
+        raise ValueError(f"Unknown census layer: {layer_type}, expected one of {census_layers}")
+
+
+def intersect_pair(year, state_a, layer_a, state_b, layer_b, base_dir, options=None):
+    """
+    Intersect the census layer of state_a with the CoC layer of state_b and write the shp and csv outputs.
+
+    :return: the csv output path, None when the pair passed (e.g. a missing CRS)
+    """
+    check_census_layer(layer_a)
+    options = overlay_options(options)
+    log = StageLog('perform_intersections', year=year, state=state_a, layer=layer_a, coc_state=state_b)
+
+    # Construct paths for each layer
+    layer_a_path = construct_shapefile_paths(year, state_a, layer_a, base_dir)
+    layer_b_path = construct_shapefile_paths(year, state_b, layer_b, base_dir)
+
+    # Read the shapefiles (or their GeoParquet versions or downloaded zip archives, see Common/GeoStore.py)
+    gdf_a = read_layer(layer_a_path)
+    # only the features of layer b around layer a can intersect it, the others are not read
+    bbox = None
+    crs_b = layer_crs(layer_b_path)
+    if gdf_a.crs is not None and crs_b is not None:
+        bbox = reproject(gdf_a, crs_b).total_bounds
+    gdf_b = read_layer(layer_b_path, bbox=bbox)
+    log.lap('read', gdf_a, gdf_b)
+
+    # Ensure CRS match or reproject
+    if gdf_a.crs is None:
+        print(f"Missing CRS for shapefile: {layer_a_path}, passing for now")
+        return None
+    if gdf_b.crs is None:
+        print(f"Missing CRS for shapefile: {layer_b_path}, passing for now")
+        return None
+    try:
+        if gdf_a.crs != gdf_b.crs:
+            gdf_b = reproject(gdf_b, gdf_a.crs)
+    except ValueError as e:
+        print(f"Error reprojecting CoC shapefile: {e}")
+        return None
+    log.lap('reproject')
+
+    # repair the geometries and snap them to the precision grid, cached per input file
+    # (see Common/Preprocess.py, layer b is only read around layer a, so its bbox is part of the key)
+    gdf_a = preprocess_layer(gdf_a, layer_a_path, options['precision'], preprocess_dir(base_dir),
+                             repair=options['repair'])
+    gdf_b = preprocess_layer(gdf_b, layer_b_path, options['precision'], preprocess_dir(base_dir),
+                             extra={'bbox': None if bbox is None else [float(v) for v in bbox]},
+                             repair=options['repair'])
+    log.lap('preprocess', gdf_a, gdf_b)
+
+    # Perform intersection (an error is raised to run_with_fallback, which retries with a heavier repair)
+    intersected_gdf = intersect(gdf_a, gdf_b, method=options['method'], containment=options['containment'],
+                                memory_budget=options['memory_budget'], rows=True)
+    log.lap('overlay', intersected_gdf)
+
+    # the share of the census polygon and of the CoC each piece covers, the areas are looked up by the row
+    # positions intersect() carried through the overlay (see Common/AreaEngine.py)
+    census_share, coc_share = shares(intersected_gdf, gdf_a, gdf_b, options['area'], options['area_crs'])
+    intersected_gdf = intersected_gdf.drop(columns=['__row1', '__row2'])
+    if layer_a == 'counties':
+        intersected_gdf['%of_county'] = census_share
+        intersected_gdf['%of_coc'] = coc_share
+        log.lap('area', intersected_gdf)
+        # save the shp output
+        shp_output_dir = os.path.join(base_dir, 'AddiInter', 'Output', str(year), 'CoC@Counties', 'shp')
+        if not os.path.exists(shp_output_dir):
+            os.makedirs(shp_output_dir)
+        intersected_gdf.to_file(os.path.join(shp_output_dir, f"CoCOf{state_b}_CountyOf{state_a}_{str(year)[2:]}.shp"))
+        # save the csv output
+        csv_output_dir = os.path.join(base_dir, 'AddiInter', 'Output', str(year), 'CoC@Counties', 'csv')
+        if not os.path.exists(csv_output_dir):
+            os.makedirs(csv_output_dir)
+        csv_output_path = os.path.join(csv_output_dir, f"CoCOf{state_b}_CountyOf{state_a}_{str(year)[2:]}.csv")
+        intersected_gdf.drop('geometry', axis=1).to_csv(csv_output_path, index=False)
+        log.lap('write')
+
+    if layer_a == 'Census places':
+        intersected_gdf['%of_place'] = census_share
+        intersected_gdf['%of_coc'] = coc_share
+        log.lap('area', intersected_gdf)
+        # save the shp output
+        shp_output_dir = os.path.join(base_dir, 'AddiInter', 'Output', str(year), 'CoC@Places', 'shp')
+        if not os.path.exists(shp_output_dir):
+            os.makedirs(shp_output_dir)
+        intersected_gdf.to_file(os.path.join(shp_output_dir, f"CoCOf{state_b}_PlacesOf{state_a}_{str(year)[2:]}.shp"))
+        # save the csv output
+        csv_output_dir = os.path.join(base_dir, 'AddiInter', 'Output', str(year), 'CoC@Places', 'csv')
+        if not os.path.exists(csv_output_dir):
+            os.makedirs(csv_output_dir)
+        csv_output_path = os.path.join(csv_output_dir, f"CoCOf{state_b}_PlacesOf{state_a}_{str(year)[2:]}.csv")
+        intersected_gdf.drop('geometry', axis=1).to_csv(csv_output_path, index=False)
+        log.lap('write')
+
+
+    elif layer_a == 'county subdivisions':
+        intersected_gdf['%of_subdivision'] = census_share
+        intersected_gdf['%of_coc'] = coc_share
+        log.lap('area', intersected_gdf)
+        # save the shp output
+        shp_output_dir = os.path.join(base_dir, 'AddiInter', 'Output', str(year), 'CoC@Subdivisions', 'shp')
+        if not os.path.exists(shp_output_dir):
+            os.makedirs(shp_output_dir)
+        intersected_gdf.to_file(os.path.join(shp_output_dir, f"CoCOf{state_b}_PlacesOf{state_a}_{str(year)[2:]}.shp"))
+        # save the csv output
+        csv_output_dir = os.path.join(base_dir, 'AddiInter', 'Output', str(year), 'CoC@Subdivisions', 'csv')
+        if not os.path.exists(csv_output_dir):
+            os.makedirs(csv_output_dir)
+        csv_output_path = os.path.join(csv_output_dir, f"CoCOf{state_b}_PlacesOf{state_a}_{str(year)[2:]}.csv")
+        intersected_gdf.drop('geometry', axis=1).to_csv(csv_output_path, index=False)
+        log.lap('write')
+    return csv_output_path
+
+
+def perform_intersections(intersections, base_dir='D:\\UMich\\Win24\\IntersectionProject', timeout=None,
+                          memory_limit=None, **options):
+    options = overlay_options(options)
+    for year, combinations in intersections.items():
+        for state_a, layer_a, state_b, layer_b in combinations:
+            # each pair runs under the time and memory limits and is retried with a heavier repair of the geometries
+            # when it fails or runs out of time (see Common/TaskGuard.py), a pair that fails with every repair is
+            # reported and skipped
             try:
-                intersected_gdf = gpd.overlay(gdf_a, gdf_b, how='intersection')
+                # an unknown layer is reported once instead of failing every repair
+                check_census_layer(layer_a)
+                run_with_fallback(intersect_pair, (year, state_a, layer_a, state_b, layer_b, base_dir), options,
+                                  timeout, memory_limit, year=year, state=state_a, layer=layer_a, coc_state=state_b)
             except Exception as e:
                 print(f"Error during overlay operation for {state_a}-{state_b} in {year}: {e}")
-                continue
-
-            # create new column
-            intersected_gdf['area'] = intersected_gdf['geometry'].area
-            gdf_a['total_area'] = gdf_a['geometry'].area
-            if layer_a == 'counties':
-                gdf_a_area = gdf_a[['COUNTYFP' if year != 2010 else 'COUNTYFP10', 'total_area']].drop_duplicates()
-                intersected_gdf = intersected_gdf.merge(gdf_a_area, on='COUNTYFP' if year != 2010 else 'COUNTYFP10', how='left')
-                intersected_gdf['%of_county'] = intersected_gdf['area'] / intersected_gdf['total_area']
-                # drop the unnecessary columns
-                intersected_gdf = intersected_gdf.drop(columns=['total_area', 'area'])
-                # save the shp output
-                shp_output_dir = os.path.join(base_dir, 'AddiInter', 'Output', str(year), 'CoC@Counties', 'shp')
-                if not os.path.exists(shp_output_dir):
-                    os.makedirs(shp_output_dir)
-                intersected_gdf.to_file(os.path.join(shp_output_dir, f"CoCOf{state_b}_CountyOf{state_a}_{str(year)[2:]}.shp"))
-                # save the csv output
-                csv_output_dir = os.path.join(base_dir, 'AddiInter', 'Output', str(year), 'CoC@Counties', 'csv')
-                if not os.path.exists(csv_output_dir):
-                    os.makedirs(csv_output_dir)
-                csv_output_path = os.path.join(csv_output_dir, f"CoCOf{state_b}_CountyOf{state_a}_{str(year)[2:]}.csv")
-                intersected_gdf.drop('geometry', axis=1).to_csv(csv_output_path, index=False)
-
-            if layer_a == 'Census places':
-                gdf_a_area = gdf_a[['PLACEFP' if year != 2010 else 'PLACEFP10', 'total_area']].drop_duplicates()
-                intersected_gdf = intersected_gdf.merge(gdf_a_area, on='PLACEFP' if year != 2010 else 'PLACEFP10', how='left')
-                intersected_gdf['%of_place'] = intersected_gdf['area'] / intersected_gdf['total_area']
-                # drop the unnecessary columns
-                intersected_gdf = intersected_gdf.drop(columns=['total_area', 'area'])
-                # save the shp output
-                shp_output_dir = os.path.join(base_dir, 'AddiInter', 'Output', str(year), 'CoC@Places', 'shp')
-                if not os.path.exists(shp_output_dir):
-                    os.makedirs(shp_output_dir)
-                intersected_gdf.to_file(os.path.join(shp_output_dir, f"CoCOf{state_b}_PlacesOf{state_a}_{str(year)[2:]}.shp"))
-                # save the csv output
-                csv_output_dir = os.path.join(base_dir, 'AddiInter', 'Output', str(year), 'CoC@Places', 'csv')
-                if not os.path.exists(csv_output_dir):
-                    os.makedirs(csv_output_dir)
-                csv_output_path = os.path.join(csv_output_dir, f"CoCOf{state_b}_PlacesOf{state_a}_{str(year)[2:]}.csv")
-                intersected_gdf.drop('geometry', axis=1).to_csv(csv_output_path, index=False)
-
-
-            elif layer_a == 'county subdivisions':
-                gdf_a_area = gdf_a[['COUSUBFP' if year != 2010 else 'COUSUBFP10', 'total_area']].drop_duplicates()
-                intersected_gdf = intersected_gdf.merge(gdf_a_area, on='COUSUBFP' if year != 2010 else 'COUSUBFP10', how='left')
-                intersected_gdf['%of_subdivision'] = intersected_gdf['area'] / intersected_gdf['total_area']
-                # drop the unnecessary columns
-                intersected_gdf = intersected_gdf.drop(columns=['total_area', 'area'])
-                # save the shp output
-                shp_output_dir = os.path.join(base_dir, 'AddiInter', 'Output', str(year), 'CoC@Subdivisions', 'shp')
-                if not os.path.exists(shp_output_dir):
-                    os.makedirs(shp_output_dir)
-                intersected_gdf.to_file(os.path.join(shp_output_dir, f"CoCOf{state_b}_PlacesOf{state_a}_{str(year)[2:]}.shp"))
-                # save the csv output
-                csv_output_dir = os.path.join(base_dir, 'AddiInter', 'Output', str(year), 'CoC@Subdivisions', 'csv')
-                if not os.path.exists(csv_output_dir):
-                    os.makedirs(csv_output_dir)
-                csv_output_path = os.path.join(csv_output_dir, f"CoCOf{state_b}_PlacesOf{state_a}_{str(year)[2:]}.csv")
-                intersected_gdf.drop('geometry', axis=1).to_csv(csv_output_path, index=False)
 
 
 # Define intersections to perform
@@ -216,4 +275,16 @@ for year in range (2007, 2024):
 #     ],
 # }
 
-perform_intersections(intersections_to_perform)
+# overlay options, see DEFAULT_OVERLAY_OPTIONS in Common/OverlayKernel.py
+# (the census layer comes first here, so the containment pre-pass would look for CoCs inside a county)
+run_options = {'method': 'overlay', 'containment': False, 'area': 'equal_area'}
+
+# wall-clock limit of a pair in seconds and memory limit of its process in MB (None for no limit), see
+# Common/TaskGuard.py
+task_timeout = 3600
+task_memory_limit = None
+
+# NationwideIntersect.py finds these cross-state pairs automatically, the guard lets it import the path helpers
+if __name__ == '__main__':
+    perform_intersections(intersections_to_perform, timeout=task_timeout, memory_limit=task_memory_limit,
+                          **run_options)
@@ -0,0 +1,194 @@
+"""
+This script performs the CoC overlay for all states of a year in one pass (nationwide mode).
+
+The per-state scripts in Intersection only intersect a state's CoCs with the same state's census layer, so the pieces
+of CoCs crossing a state line are missed and had to be listed by hand in AddiIntersect.py. Here the CoC and census
+layers of every state are loaded into one national GeoDataFrame each (reprojected to one CRS) and intersected once
+through the spatial index of the kernel, so the cross-state pairs are found automatically.
+
+The result is split by the state of the census feature and written with the same names and layout as the
+Intersection scripts, so one run replaces the 54 per-state passes and the extra AddiIntersect pairs. The output has one
+extra column, CoC_State, the state of the CoC file each piece comes from, so it is written to a folder of its own
+instead of over the results of the per-state scripts.
+
+The HUD CoC boundaries never follow the TIGER lines exactly, so every CoC along a state line overlaps the census
+polygons of the neighbouring state by thin slivers. The pieces below min_share (a fraction, 0.001 by default) of both
+their census polygon and their CoC are dropped before the results and the cross-state report are written, so the
+report only lists the pairs that really cross a state line (min_share=0 keeps every piece):
+- Intersection
+    - Output
+        - Nationwide
+            - 2007
+                - CoC@Counties
+                    - shp
+                        - CoC_Counties_01_Alabama_07.shp
+                        - ...
+                    - csv
+                        - CoC_Counties_01_Alabama_07.csv
+                        - ...
+                    - CoC_Counties_cross_state_07.csv  (the pieces where the CoC and the county are in different states)
+            - dataset   (with output='dataset', see Common/ResultStore.py)
+"""
+
+import os
+import sys
+import pandas as pd
+import geopandas as gpd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from AddiInter.AddiIntersect import construct_shapefile_paths, states_fips_codes
+from Common.AreaEngine import reproject, shares
+from Common.GeoStore import read_layer, resolve_layer, source_file
+from Common.OverlayKernel import intersect, overlay_options
+from Common.ParallelRunner import run_tasks
+from Common.PieceStore import PieceStore
+from Common.Preprocess import preprocess_dir, preprocess_layer
+from Common.ResultStore import write_partition
+from Common.TaskGuard import run_with_fallback
+
+# output name and share column of each census layer
+layers = {
+    'counties': ('Counties', '%of_county'),
+    'Census places': ('Places', '%of_place'),
+    'county subdivisions': ('Subdivisions', '%of_subdiv'),
+}
+
+# the pieces below this share of both their census polygon and their CoC are boundary slivers, see the docstring
+MIN_SHARE = 0.001
+
+
+def nationwide_output_dir(base_dir):
+    # the Output folder of the nationwide results, next to the results of the per-state scripts
+    return os.path.join(base_dir, 'Intersection', 'Output', 'Nationwide')
+
+
+def load_national_layer(year, layer_type, states, base_dir, crs=None, precision=None, repair='make_valid'):
+    """
+    Read the layer of every state and concatenate them into one GeoDataFrame in a single CRS.
+
+    A '__state' column records the state of the file each row comes from. States without the layer (e.g. the
+    subdivisions, which only exist for some states) are skipped. The layer of each state is preprocessed (repaired and
+    snapped to the precision grid, see Common/Preprocess.py) once it is in the common CRS.
+    """
+    gdfs = []
+    for state in states:
+        path = resolve_layer(construct_shapefile_paths(year, state, layer_type, base_dir))
+        if not os.path.exists(source_file(path)):
+            continue
+        gdf = read_layer(path)
+        if gdf.crs is None:
+            print(f"Missing CRS for shapefile: {path}, passing for now")
+            continue
+        if crs is None:
+            crs = gdf.crs
+        elif gdf.crs != crs:
+            gdf = reproject(gdf, crs)
+        gdf = preprocess_layer(gdf, path, precision, preprocess_dir(base_dir), repair=repair)
+        gdf['__state'] = state
+        gdfs.append(gdf)
+
+    if not gdfs:
+        return None
+    return gpd.GeoDataFrame(pd.concat(gdfs, ignore_index=True), crs=crs)
+
+
+def overlay_nationwide_layer(year, layer_type, states, base_dir, min_share=MIN_SHARE, options=None):
+    options = overlay_options(options)
+    name, share_column = layers[layer_type]
+
+    coc_gdf = load_national_layer(year, 'CoC', states, base_dir, precision=options['precision'],
+                                  repair=options['repair'])
+    if coc_gdf is None:
+        print(f"No CoC shapefiles for {year}, passing for now")
+        return
+    census_gdf = load_national_layer(year, layer_type, states, base_dir, crs=coc_gdf.crs,
+                                     precision=options['precision'], repair=options['repair'])
+    if census_gdf is None:
+        print(f"No {layer_type} shapefiles for {year}, passing for now")
+        return
+    coc_gdf = coc_gdf.rename(columns={'__state': 'CoC_State'})
+
+    store = None
+    if options['reuse']:
+        store = PieceStore(os.path.join(base_dir, 'Intersection', 'Output', 'pieces', f'Nationwide_CoC@{name}.sqlite'))
+    intersected_gdf = intersect(coc_gdf, census_gdf, method=options['method'], containment=options['containment'],
+                                store=store, memory_budget=options['memory_budget'], rows=True)
+    if store is not None:
+        store.close()
+
+    # the areas are looked up by the row positions intersect() carried through the overlay, FIPS codes are only
+    # unique in a state (see Common/AreaEngine.py)
+    coc_share, census_share = shares(intersected_gdf, coc_gdf, census_gdf, options['area'], options['area_crs'])
+    intersected_gdf = intersected_gdf.drop(columns=['__row1', '__row2'])
+    intersected_gdf[share_column] = census_share
+    intersected_gdf['%of_coc'] = coc_share
+
+    # drop the slivers along the CoC boundaries that do not follow the census lines
+    slivers = (intersected_gdf[share_column] < min_share) & (intersected_gdf['%of_coc'] < min_share)
+    intersected_gdf = intersected_gdf[~slivers]
+
+    output_dir = os.path.join(nationwide_output_dir(base_dir), str(year), f'CoC@{name}')
+    os.makedirs(output_dir, exist_ok=True)
+
+    # report the pairs the per-state passes would have missed
+    cross_state = intersected_gdf[intersected_gdf['CoC_State'] != intersected_gdf['__state']]
+    cross_state.drop(columns='geometry').rename(columns={'__state': 'Census_State'}).to_csv(
+        os.path.join(output_dir, f"CoC_{name}_cross_state_{str(year)[2:]}.csv"), index=False)
+
+    # split the national result by the state of the census feature
+    for state, state_gdf in intersected_gdf.groupby('__state'):
+        fips = states_fips_codes[state]
+        state_gdf = state_gdf.drop(columns='__state')
+        # with output='dataset' each state goes to its partition of the result dataset, see Common/ResultStore.py
+        if options['output'] == 'dataset':
+            write_partition(state_gdf, base_dir, year, name, state, nationwide_output_dir(base_dir))
+            continue
+        os.makedirs(os.path.join(output_dir, 'shp'), exist_ok=True)
+        os.makedirs(os.path.join(output_dir, 'csv'), exist_ok=True)
+        output_name = f"CoC_{name}_{fips}_{state}_{str(year)[2:]}"
+        state_gdf.to_file(os.path.join(output_dir, 'shp', f"{output_name}.shp"))
+        state_gdf.drop('geometry', axis=1).to_csv(os.path.join(output_dir, 'csv', f"{output_name}.csv"), index=False)
+
+    print(f"Finished nationwide CoC@{name} for {year}: {len(intersected_gdf)} pieces, "
+          f"{len(cross_state)} across state lines, {int(slivers.sum())} slivers below {min_share} dropped")
+
+
+def overlay_nationwide_guarded(year, layer_type, states, base_dir, min_share=MIN_SHARE, options=None, timeout=None,
+                               memory_limit=None):
+    # the task under the time and memory limits, retried with a heavier repair of the geometries when it fails or
+    # runs out of time (see Common/TaskGuard.py)
+    return run_with_fallback(overlay_nationwide_layer, (year, layer_type, states, base_dir, min_share), options,
+                             timeout, memory_limit, year=year, layer=layer_type)
+
+
+def overlay_nationwide(years, layer_types, states, base_dir='D:\\UMich\\Win24\\IntersectionProject', workers=1,
+                       timeout=None, memory_limit=None, min_share=MIN_SHARE, **options):
+    """
+    :param min_share: the pieces below this share of both their census polygon and their CoC are dropped as
+                      slivers, see the module docstring
+    :param options: overlay options, see DEFAULT_OVERLAY_OPTIONS in Common/OverlayKernel.py
+    """
+    # one task per (year, layer), each one holds the whole country for that layer in memory
+    tasks = [(year, layer_type, states, base_dir, min_share, options, timeout, memory_limit)
+             for year in years for layer_type in layer_types]
+    return run_tasks(overlay_nationwide_guarded, tasks, workers=workers, label='overlay_nationwide')
+
+
+year_to_process = range(2007, 2024)
+layers_to_process = ['counties', 'Census places', 'county subdivisions']
+
+# overlay options, see DEFAULT_OVERLAY_OPTIONS in Common/OverlayKernel.py, and the minimum share of the pieces kept
+# (the slivers along the state lines are dropped, see the module docstring)
+run_options = {'method': 'strtree', 'containment': True, 'reuse': True, 'area': 'equal_area', 'min_share': MIN_SHARE}
+
+# number of worker processes
+workers = 2
+
+# wall-clock limit of a (year, layer) in seconds and memory limit of its process in MB (None for no limit), see
+# Common/TaskGuard.py
+task_timeout = None
+task_memory_limit = None
+
+if __name__ == '__main__':
+    overlay_nationwide(year_to_process, layers_to_process, list(states_fips_codes), workers=workers,
+                       timeout=task_timeout, memory_limit=task_memory_limit, **run_options)
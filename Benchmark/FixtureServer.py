@@ -0,0 +1,252 @@
+"""
+This script serves fixture archives over a local HTTP server, so the BulkDownload scripts can be run and timed without
+the HUD and Census servers.
+
+build_fixtures zips synthetic layers (see SyntheticData.py) under the same relative URLs as the real files:
+- <directory>
+    - hud
+        - CoC_GIS_State_Shapefile_CT_2018.zip
+    - tiger
+        - TIGER2018
+            - COUNTY
+                - tl_2018_us_county.zip
+            - PLACE
+                - tl_2018_09_place.zip
+            - COUSUB
+                - tl_2018_09_cousub.zip
+        - TIGER2007FE
+            - 09_CONNECTICUT
+                - fe_2007_09_county.zip
+                - fe_2007_09_place.zip
+                - 09001_0
+                    - fe_2007_09001_cousub.zip
+                - ...
+        - ...
+    - fips-by-state.csv     (the counties of the 2007 county subdivision archives, as read by
+                             SubdivisionsDownload_for2007.py)
+
+serve starts a threaded HTTP server on it. Set the base_url of a download script to f'{server.url}/hud' (CoC) or
+f'{server.url}/tiger/' (Census) to download from it. The server answers Range requests (with If-Range) and
+conditional requests (ETag / Last-Modified, from the size and modification time of the file), and records every
+request in server.requests. To exercise the download engine it can
+    - answer the first `failures` requests of every file with a 503 (the retries)
+    - drop the connection after `cut` bytes of the first full answer of every file (the resumed downloads)
+"""
+
+import csv
+import os
+import re
+import sys
+import tempfile
+import threading
+import zipfile
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+import geopandas as gpd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from SyntheticData import STATE_EXTENT, generate_state
+
+
+def census_urls(year, fips, name):
+    """Relative URLs of the county, place and county subdivision archives of a state, as in the download scripts."""
+    if year >= 2011:
+        return {'counties': f"tiger/TIGER{year}/COUNTY/tl_{year}_us_county.zip",
+                'Census places': f"tiger/TIGER{year}/PLACE/tl_{year}_{fips}_place.zip",
+                'county subdivisions': f"tiger/TIGER{year}/COUSUB/tl_{year}_{fips}_cousub.zip"}
+    if year == 2010:
+        return {'counties': f"tiger/TIGER{year}/COUNTY/2010/tl_{year}_{fips}_county10.zip",
+                'Census places': f"tiger/TIGER{year}/PLACE/2010/tl_{year}_{fips}_place10.zip",
+                'county subdivisions': f"tiger/TIGER{year}/COUSUB/2010/tl_{year}_{fips}_cousub10.zip"}
+    if year == 2007:
+        return {'counties': f"tiger/TIGER{year}FE/{fips}_{name}/fe_{year}_{fips}_county.zip",
+                'Census places': f"tiger/TIGER{year}FE/{fips}_{name}/fe_{year}_{fips}_place.zip"}
+    return {'counties': f"tiger/TIGER{year}/{fips}_{name}/tl_{year}_{fips}_county.zip",
+            'Census places': f"tiger/TIGER{year}/{fips}_{name}/tl_{year}_{fips}_place.zip",
+            'county subdivisions': f"tiger/TIGER{year}/{fips}_{name}/tl_{year}_{fips}_cousub.zip"}
+
+
+def write_zip(gdfs, zip_path):
+    """Write shapefiles into a zip archive, gdfs is a dict path inside the archive (.shp) -> GeoDataFrame."""
+    os.makedirs(os.path.dirname(zip_path), exist_ok=True)
+    with tempfile.TemporaryDirectory() as temp_dir, zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for member, gdf in gdfs.items():
+            shp_path = os.path.join(temp_dir, member)
+            os.makedirs(os.path.dirname(shp_path), exist_ok=True)
+            gdf.to_file(shp_path)
+            stem = os.path.splitext(shp_path)[0]
+            for file_name in os.listdir(os.path.dirname(shp_path)):
+                path = os.path.join(os.path.dirname(shp_path), file_name)
+                if os.path.splitext(path)[0] == stem:
+                    archive.write(path, os.path.relpath(path, temp_dir))
+
+
+def build_fixtures(directory, years, states, size='small', seed=0):
+    """
+    Zip the synthetic layers of every (year, state) under directory, see the module docstring.
+
+    :param states: dict state name -> (abbreviation, fips)
+    :return: list of the relative URLs written
+    """
+    written = []
+    county_rows = []
+    for year in years:
+        suffix = '10' if year == 2010 else ''
+        national_counties = []
+        for i, (state, (abbreviation, fips)) in enumerate(states.items()):
+            origin = (-120.0 + (i % 10) * STATE_EXTENT[0], 30.0 + (i // 10) * STATE_EXTENT[1])
+            layers = generate_state(size, state, fips, year, seed + i, origin)
+            name = state.upper().replace(' ', '_')
+
+            # the CoC archive has a top folder, from 2010 on with a subfolder per CoC
+            top = f"CoC_GIS_State_Shapefile_{abbreviation}_{year}"
+            cocs = {}
+            for number, coc in layers['CoC'].drop(columns='CoC_Number').groupby('COCNUM'):
+                if year >= 2010:
+                    cocs[f"{top}/{number.replace('-', '_')}/{number.replace('-', '_')}.shp"] = coc
+                else:
+                    separator = '-' if year == 2007 else '_'
+                    cocs[f"{top}/{abbreviation}{separator}{number.split('-')[1]}.shp"] = coc
+            url = f"hud/CoC_GIS_State_Shapefile_{abbreviation}_{year}.zip"
+            write_zip(cocs, os.path.join(directory, url))
+            written.append(url)
+
+            for layer_type, url in census_urls(year, fips, name).items():
+                if layer_type == 'counties' and year >= 2011:
+                    national_counties.append(layers[layer_type])
+                    continue
+                write_zip({os.path.basename(url).replace('.zip', '.shp'): layers[layer_type]},
+                          os.path.join(directory, url))
+                written.append(url)
+
+            if year == 2007:
+                # the 2007 county subdivisions come in one archive per county
+                subdivisions = layers['county subdivisions']
+                for county_fp, county_name in zip(layers['counties']['COUNTYFP'], layers['counties']['NAMELSAD']):
+                    county = subdivisions[subdivisions['COUNTYFP'] == county_fp]
+                    if county.empty:
+                        continue
+                    county_fips = f"{fips}{county_fp}"
+                    county_dir = county_name.replace('County', '').strip().replace(' ', '_')
+                    url = (f"tiger/TIGER{year}FE/{fips}_{name}/{county_fips}_{county_dir}/"
+                           f"fe_{year}_{county_fips}_cousub.zip")
+                    write_zip({f"fe_{year}_{county_fips}_cousub.shp": county}, os.path.join(directory, url))
+                    written.append(url)
+                    county_rows.append({'fips': county_fips, 'name': county_name, 'state': abbreviation})
+
+        if national_counties:
+            url = f"tiger/TIGER{year}/COUNTY/tl_{year}_us_county.zip"
+            counties = gpd.GeoDataFrame(pd.concat(national_counties, ignore_index=True), crs='EPSG:4269')
+            write_zip({f"tl_{year}_us_county{suffix}.shp": counties}, os.path.join(directory, url))
+            written.append(url)
+
+    if county_rows:
+        with open(os.path.join(directory, 'fips-by-state.csv'), 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=['fips', 'name', 'state'])
+            writer.writeheader()
+            writer.writerows(county_rows)
+    return written
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        path = os.path.join(server.directory, *self.path.split('?')[0].lstrip('/').split('/'))
+        with server.lock:
+            server.requests.append((self.command, self.path, self.headers.get('Range')))
+            failed = server.failed.get(self.path, 0)
+            if failed < server.failures:
+                server.failed[self.path] = failed + 1
+        if failed < server.failures:
+            self.send_error(503)
+            return
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        stat = os.stat(path)
+        size = stat.st_size
+        etag = f'"{size:x}-{stat.st_mtime_ns:x}"'
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
+        since = self.headers.get('If-Modified-Since')
+        if (self.headers.get('If-None-Match') == etag or self.headers.get('If-None-Match') is None and since
+                and parsedate_to_datetime(since).timestamp() >= int(stat.st_mtime)):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        start = 0
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if_range = self.headers.get('If-Range')
+        if match and if_range is not None and if_range not in (etag, last_modified):
+            # the file changed since the client started its copy, it gets the whole file
+            match = None
+        if match:
+            start = int(match.group(1))
+            if start >= size:
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{size - 1}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(size - start))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+
+        end = size
+        with server.lock:
+            if server.cut is not None and not match and self.path not in server.cut_paths:
+                server.cut_paths.add(self.path)
+                end = min(size, server.cut)
+        with open(path, 'rb') as file:
+            file.seek(start)
+            self.wfile.write(file.read(end - start))
+        if end < size:
+            # the client sees a connection closed before Content-Length bytes
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        # the download scripts report the progress
+        pass
+
+
+def serve(directory, port=0, failures=0, cut=None):
+    """
+    Serve directory on a local HTTP server running in a background thread.
+
+    :param port: 0 picks a free port
+    :param failures: number of requests of every file answered with a 503 before it is served
+    :param cut: number of bytes after which the first full answer of every file is cut off, None never cuts
+    :return: the server, its URL is server.url, server.shutdown() stops it
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), FixtureHandler)
+    server.directory = directory
+    server.failures = failures
+    server.failed = {}
+    server.cut = cut
+    server.cut_paths = set()
+    server.requests = []
+    server.lock = threading.Lock()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+fixture_directory = os.path.join(tempfile.gettempdir(), 'coc_fixtures')
+years_to_build = [2007, 2010, 2018]
+states_to_build = {'Connecticut': ('CT', '09'), 'Rhode Island': ('RI', '44')}
+
+if __name__ == '__main__':
+    build_fixtures(fixture_directory, years_to_build, states_to_build)
+    fixture_server = serve(fixture_directory, port=8765)
+    print(f"Serving {fixture_directory} on {fixture_server.url}, press Ctrl+C to stop")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        fixture_server.shutdown()
@@ -0,0 +1,194 @@
+"""
+This script times the stages of the CoC x census layer overlay on synthetic data (see SyntheticData.py).
+
+For every dataset size, census layer and overlay configuration it times, separately:
+    - read: reading the CoC and the census layer
+    - reproject: projecting the census layer to the CRS of the CoC layer
+    - preprocess: repairing the geometries and snapping them to the precision grid (without the cache)
+    - overlay: the intersection kernel
+    - share: the areas and the %of_ share column
+    - write: the shp and csv outputs
+    - script: the whole state function of the Intersection script, as a check of the sum of the stages
+
+The result of every configuration is also checked (check_result): the %of_county and %of_subdiv shares of each county
+and subdivision sum to 1 (the CoCs tile the state), and the pieces are those of method='overlay'.
+
+Each stage is run `repeat` times and the fastest run is kept. The results are printed as a table and written to
+benchmark.csv in the output directory:
+- <output_dir>
+    - small
+        - shapefiles    (the generated input)
+        - Intersection  (the outputs of the script stage)
+    - medium
+    - ...
+    - benchmark.csv
+"""
+
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import shapely
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Common.AreaEngine import reproject, shares
+from Common.GeoStore import read_layer
+from Common.OverlayKernel import intersect, overlay_options
+from Common.Preprocess import preprocess_geometries
+from SyntheticData import generate_dataset, layer_paths
+
+# the overlay configurations to compare, see DEFAULT_OVERLAY_OPTIONS in Common/OverlayKernel.py
+configurations = {
+    'overlay': {'method': 'overlay'},
+    'strtree': {'method': 'strtree'},
+    'strtree+containment': {'method': 'strtree', 'containment': True},
+    'tiled': {'method': 'strtree', 'containment': True, 'memory_budget': 16},
+}
+
+# the share column of each census layer
+share_columns = {
+    'counties': '%of_county',
+    'Census places': '%of_place',
+    'county subdivisions': '%of_subdiv',
+}
+
+# the layers the CoCs tile, so that the shares of each of their polygons sum to 1
+tiled_layers = ('counties', 'county subdivisions')
+
+# relative tolerance of the checks of the results
+CHECK_TOLERANCE = 1e-6
+
+
+def load_state_functions():
+    # the Intersection scripts cannot be imported by name, CoC@AllLayers.py loads them and lists their state functions
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Intersection',
+                        'CoC@AllLayers.py')
+    if 'CoC_AllLayers' not in sys.modules:
+        spec = importlib.util.spec_from_file_location('CoC_AllLayers', path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules['CoC_AllLayers'] = module
+        spec.loader.exec_module(module)
+    return {layer_type: layer[0] for layer_type, layer in sys.modules['CoC_AllLayers'].layers.items()}
+
+
+def _fastest(func, repeat):
+    # run func repeat times, return its last result and the fastest time
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def check_result(result, reference, layer_type, features):
+    """
+    Check an overlay result with its share columns against the reference result of method='overlay' (both with the
+    '__row1' / '__row2' positions of the input rows), see the module docstring. Raises an AssertionError.
+
+    :param features: number of polygons of the census layer, a polygon without any piece has a share sum of 0
+    """
+    if layer_type in tiled_layers:
+        sums = result.groupby('__row2')[share_columns[layer_type]].sum().reindex(range(features), fill_value=0)
+        assert np.allclose(sums, 1, rtol=0, atol=CHECK_TOLERANCE), \
+            f"{layer_type}: the shares of {int((~np.isclose(sums, 1, rtol=0, atol=CHECK_TOLERANCE)).sum())} " \
+            f"polygons do not sum to 1 (min {sums.min()}, max {sums.max()})"
+    if reference is None:
+        return
+    result, reference = (df.sort_values(['__row1', '__row2']) for df in (result, reference))
+    assert np.array_equal(result[['__row1', '__row2']].to_numpy(), reference[['__row1', '__row2']].to_numpy()), \
+        f"{layer_type}: {len(result)} pieces, {len(reference)} with method='overlay'"
+    areas, reference_areas = shapely.area(result.geometry.values), shapely.area(reference.geometry.values)
+    assert np.allclose(areas, reference_areas, rtol=CHECK_TOLERANCE, atol=0), \
+        f"{layer_type}: the areas of the pieces differ from method='overlay' by up to " \
+        f"{np.abs(areas - reference_areas).max()}"
+
+
+def benchmark_layer(base_dir, year, state, fips, layer_type, options=None, repeat=3):
+    """Time the stages of one (year, state, layer) overlay, return a dict stage -> seconds."""
+    options = overlay_options(options)
+    paths = layer_paths(base_dir, year, state, fips)
+    share_column = share_columns[layer_type]
+    seconds = {}
+
+    (coc_gdf, census_gdf), seconds['read'] = _fastest(
+        lambda: (read_layer(paths['CoC']), read_layer(paths[layer_type])), repeat)
+    census_gdf, seconds['reproject'] = _fastest(lambda: reproject(census_gdf, coc_gdf.crs), repeat)
+
+    def preprocess():
+        return (coc_gdf.set_geometry(preprocess_geometries(np.asarray(coc_gdf.geometry.array), options['precision'])),
+                census_gdf.set_geometry(preprocess_geometries(np.asarray(census_gdf.geometry.array),
+                                                              options['precision'])))
+
+    (coc_gdf, census_gdf), seconds['preprocess'] = _fastest(preprocess, repeat)
+    intersected_gdf, seconds['overlay'] = _fastest(
+        lambda: intersect(coc_gdf, census_gdf, method=options['method'], containment=options['containment'],
+                          memory_budget=options['memory_budget'], rows=True), repeat)
+
+    def share():
+        coc_share, census_share = shares(intersected_gdf, coc_gdf, census_gdf, options['area'], options['area_crs'])
+        result = intersected_gdf.copy()
+        result[share_column] = census_share
+        result['%of_coc'] = coc_share
+        return result
+
+    intersected_gdf, seconds['share'] = _fastest(share, repeat)
+
+    # the other configurations must give the pieces of the plain overlay
+    reference = None
+    if (options['method'], options['containment'], options['memory_budget']) != ('overlay', False, None):
+        reference = intersect(coc_gdf, census_gdf, method='overlay', rows=True)
+    check_result(intersected_gdf, reference, layer_type, len(census_gdf))
+    intersected_gdf = intersected_gdf.drop(columns=['__row1', '__row2'])
+
+    def write():
+        with tempfile.TemporaryDirectory() as output_dir:
+            intersected_gdf.to_file(os.path.join(output_dir, 'result.shp'))
+            intersected_gdf.drop(columns='geometry').to_csv(os.path.join(output_dir, 'result.csv'), index=False)
+
+    _, seconds['write'] = _fastest(write, repeat)
+    seconds['pieces'] = len(intersected_gdf)
+    return seconds
+
+
+def run_benchmarks(output_dir, sizes=('small', 'medium', 'large'), layer_types=tuple(share_columns),
+                   configs=None, year=2018, state='Connecticut', fips='09', repeat=3):
+    """
+    Generate a state of each size and time every layer and configuration, see the module docstring.
+
+    :return: DataFrame with one row per (size, layer, configuration) and one column per stage
+    """
+    configs = configs if configs is not None else configurations
+    state_functions = load_state_functions()
+    rows = []
+    for size in sizes:
+        base_dir = os.path.join(output_dir, size)
+        generate_dataset(base_dir, [year], {state: fips}, size)
+        for layer_type in layer_types:
+            for name, options in configs.items():
+                options = overlay_options(options)
+                row = {'size': size, 'layer': layer_type, 'config': name}
+                row.update(benchmark_layer(base_dir, year, state, fips, layer_type, options, repeat))
+                # the real script, as a check that the stages cover all of its work
+                _, row['script'] = _fastest(lambda: state_functions[layer_type](year, state, fips, base_dir, options),
+                                            1)
+                rows.append(row)
+                print(f"[benchmark] {size} {layer_type} {name}: " +
+                      ', '.join(f"{k} {v:.3f}s" for k, v in row.items() if isinstance(v, float)))
+
+    results = pd.DataFrame(rows)
+    os.makedirs(output_dir, exist_ok=True)
+    results.to_csv(os.path.join(output_dir, 'benchmark.csv'), index=False)
+    return results
+
+
+output_directory = os.path.join(tempfile.gettempdir(), 'coc_benchmark')
+sizes_to_run = ('small', 'medium', 'large')
+
+if __name__ == '__main__':
+    with pd.option_context('display.width', 200, 'display.max_columns', 20):
+        print(run_benchmarks(output_directory, sizes_to_run).round(3))
@@ -0,0 +1,20 @@
+"""
+This script prints the report of the run log written by the pipeline steps (see Common/RunLog.py): the time spent per
+step and stage, the peak memory of each step, and the slowest tasks, states and years.
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Common.RunLog import run_log_path, summarize_run_log
+
+# the log to report on, by default logs/run_log.jsonl (or the COC_RUN_LOG environment variable)
+log_path = run_log_path()
+# only use the records written at or after this ISO time, e.g. '2024-02-01T09:00', None uses the whole log
+since = None
+# number of rows of the rankings
+top = 10
+
+if __name__ == '__main__':
+    summarize_run_log(log_path, top, since)
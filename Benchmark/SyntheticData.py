@@ -0,0 +1,225 @@
+"""
+This script generates synthetic CoC and TIGER-like census layers, so the pipeline can be run and timed without the
+multi-GB downloads.
+
+A state is a rectangle tiled by the Voronoi cells of random seed points. The cells are densified and warped by a
+smooth function, so their boundaries are wiggly lines with many vertices but still shared exactly by the neighbours.
+The layers are nested like the real ones:
+    - county subdivisions: the cells
+    - counties: unions of neighbouring subdivisions
+    - CoC: unions of neighbouring counties, minus the city CoCs, which are cut out of the largest places (so some
+      counties straddle a CoC boundary, as in the real data)
+    - Census places: irregular polygons around random points, which may cross county lines but do not overlap each
+      other, as the real places of a state
+
+The attribute columns use the TIGER names (STATEFP, COUNTYFP, PLACEFP, COUSUBFP, GEOID, NAME, ...) with the '10'
+suffix in 2010, the census layers are in NAD83 and the CoC layer in coc_crs. The files are written with the names
+and the layout the Merge, CountyProcess and Intersection scripts use (see generate_dataset):
+- shapefiles
+    - CoC_Merged
+        - 2018
+            - Connecticut
+                - Connecticut_2018_CoC_Merged.shp
+    - counties
+        - 2018
+            - 09_CONNECTICUT
+                - tl_2018_09_county.shp
+    - Census places
+    - county subdivisions   (2007 in 2007_Merged, as after SubdivisionMerge.py)
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Common.GeoStore import write_layer
+
+# feature counts and vertex density of each dataset size, the segment length is a fraction of the state width
+SIZES = {
+    'small': {'subdivisions': 40, 'counties': 10, 'cocs': 3, 'city_cocs': 1, 'places': 30, 'segment': 0.02},
+    'medium': {'subdivisions': 400, 'counties': 60, 'cocs': 8, 'city_cocs': 2, 'places': 300, 'segment': 0.004},
+    'large': {'subdivisions': 2000, 'counties': 250, 'cocs': 20, 'city_cocs': 4, 'places': 1500, 'segment': 0.001},
+}
+
+# width and height of a state in degrees
+STATE_EXTENT = (4.0, 3.0)
+
+
+def _cells(points, extent):
+    # Voronoi cells of the points, clipped to the extent, in the order of the points
+    cells = shapely.get_parts(shapely.voronoi_polygons(shapely.multipoints(points), extend_to=extent, ordered=True))
+    return shapely.intersection(cells, extent)
+
+
+def _warp(geoms, width, amplitude=0.01):
+    # a smooth displacement of every vertex; shared vertices move together, so the tiling stays exact
+    wavelength = width / 7
+
+    def displace(coords):
+        x, y = coords[:, 0], coords[:, 1]
+        return np.column_stack([x + amplitude * width * np.sin(y / wavelength * 2.3),
+                                y + amplitude * width * np.sin(x / wavelength * 1.7)])
+
+    return shapely.transform(geoms, displace)
+
+
+def _groups(points, n, rng):
+    # assign the points to n compact groups (the nearest of n random group centers)
+    centers = points[rng.choice(len(points), n, replace=False)]
+    return np.argmin(((points[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2), axis=1)
+
+
+def _dissolve(geoms, groups):
+    return np.array([shapely.union_all(geoms[groups == g]) for g in range(groups.max() + 1)], dtype=object)
+
+
+def generate_state(size='small', state='Connecticut', fips='09', year=2018, seed=0, origin=(-76.0, 40.0),
+                   coc_crs='EPSG:4326'):
+    """
+    Generate the four layers of one state.
+
+    :param size: one of SIZES, or a dict with the same keys
+    :param origin: (longitude, latitude) of the lower left corner of the state
+    :return: dict layer type ('CoC', 'counties', 'Census places', 'county subdivisions') -> GeoDataFrame
+    """
+    params = SIZES[size] if isinstance(size, str) else size
+    rng = np.random.default_rng(seed)
+    width, height = STATE_EXTENT
+    extent = shapely.box(origin[0], origin[1], origin[0] + width, origin[1] + height)
+    suffix = '10' if year == 2010 else ''
+
+    # subdivisions: densified and warped Voronoi cells
+    seeds = np.column_stack([rng.uniform(origin[0], origin[0] + width, params['subdivisions']),
+                             rng.uniform(origin[1], origin[1] + height, params['subdivisions'])])
+    subdivisions = _cells(seeds, extent)
+    subdivisions = _warp(shapely.segmentize(subdivisions, params['segment'] * width), width)
+
+    # counties: unions of neighbouring subdivisions
+    county_of = _groups(seeds, params['counties'], rng)
+    counties = _dissolve(subdivisions, county_of)
+    county_seeds = np.array([seeds[county_of == c].mean(axis=0) for c in range(len(counties))])
+
+    # places: irregular blobs around random points, at most as large as a subdivision
+    centers = shapely.points(rng.uniform(origin[0], origin[0] + width, params['places']),
+                             rng.uniform(origin[1], origin[1] + height, params['places']))
+    radii = rng.uniform(0.05, 0.5, params['places']) * np.sqrt(width * height / params['subdivisions'])
+    places = shapely.buffer(centers, radii, quad_segs=8)
+    places = shapely.intersection(_warp(shapely.segmentize(places, params['segment'] * width / 4), width, 0.002),
+                                  shapely.union_all(counties))
+    places = shapely.make_valid(places)
+    # the places of a state do not overlap: each blob loses the parts already taken by the places before it (the
+    # earlier places it overlaps only shrank since the tree was built, so the tree still finds all of them)
+    left, right = shapely.STRtree(places).query(places, predicate='intersects')
+    for i in range(len(places)):
+        earlier = right[(left == i) & (right < i)]
+        if len(earlier):
+            places[i] = shapely.difference(places[i], shapely.union_all(places[earlier]))
+    places = places[shapely.area(places) > 0]
+
+    # CoCs: unions of neighbouring counties, the largest places become city CoCs and are cut out of them
+    cocs = _dissolve(counties, _groups(county_seeds, params['cocs'], rng))
+    city_places = np.argsort(shapely.area(places))[::-1][:params['city_cocs']]
+    cities = places[city_places]
+    if len(cities):
+        cocs = shapely.difference(cocs, shapely.union_all(cities))
+    cocs = np.concatenate([cocs, cities])
+
+    n_cocs, n_counties, n_places, n_subdivisions = len(cocs), len(counties), len(places), len(subdivisions)
+    coc_numbers = [f"{state[:2].upper()}-{500 + i}" for i in range(n_cocs)]
+    layers = {
+        'CoC': gpd.GeoDataFrame({
+            'COCNUM': coc_numbers,
+            'COCNAME': [f"{state} CoC {i}" if i < n_cocs - len(cities) else f"City {i} CoC" for i in range(n_cocs)],
+            'STATE_NAME': state,
+            'CoC_Number': [number.split('-')[1] for number in coc_numbers],
+        }, geometry=cocs, crs='EPSG:4269').to_crs(coc_crs),
+        'counties': gpd.GeoDataFrame({
+            f'STATEFP{suffix}': fips,
+            f'COUNTYFP{suffix}': [f"{2 * i + 1:03d}" for i in range(n_counties)],
+            f'COUNTYNS{suffix}': [f"{rng.integers(10 ** 7):08d}" for _ in range(n_counties)],
+            f'GEOID{suffix}': [f"{fips}{2 * i + 1:03d}" for i in range(n_counties)],
+            f'NAME{suffix}': [f"County {i}" for i in range(n_counties)],
+            f'NAMELSAD{suffix}': [f"County {i} County" for i in range(n_counties)],
+            f'ALAND{suffix}': np.round(shapely.area(counties) * 1e10).astype(np.int64),
+            f'AWATER{suffix}': 0,
+        }, geometry=counties, crs='EPSG:4269'),
+        'Census places': gpd.GeoDataFrame({
+            f'STATEFP{suffix}': fips,
+            f'PLACEFP{suffix}': [f"{1000 * (i + 1):05d}" for i in range(n_places)],
+            f'PLACENS{suffix}': [f"{rng.integers(10 ** 7):08d}" for _ in range(n_places)],
+            f'GEOID{suffix}': [f"{fips}{1000 * (i + 1):05d}" for i in range(n_places)],
+            f'NAME{suffix}': [f"Place {i}" for i in range(n_places)],
+            f'NAMELSAD{suffix}': [f"Place {i} city" for i in range(n_places)],
+        }, geometry=places, crs='EPSG:4269'),
+        'county subdivisions': gpd.GeoDataFrame({
+            f'STATEFP{suffix}': fips,
+            f'COUNTYFP{suffix}': [f"{2 * c + 1:03d}" for c in county_of],
+            f'COUSUBFP{suffix}': [f"{10 * (i + 1):05d}" for i in range(n_subdivisions)],
+            f'GEOID{suffix}': [f"{fips}{2 * c + 1:03d}{10 * (i + 1):05d}" for i, c in enumerate(county_of)],
+            f'NAME{suffix}': [f"Township {i}" for i in range(n_subdivisions)],
+        }, geometry=subdivisions, crs='EPSG:4269'),
+    }
+    return layers
+
+
+def layer_paths(base_dir, year, state, fips):
+    """The shapefile paths the Intersection scripts read the layers of a (year, state) from."""
+    prefix = 'fe' if year == 2007 else 'tl'
+    suffix = '10' if year == 2010 else ''
+    state_dir = f"{fips}_{state.upper().replace(' ', '_')}"
+    return {
+        'CoC': os.path.join(base_dir, 'shapefiles', 'CoC_Merged', str(year), state,
+                            f"{state.replace(' ', '_')}_{year}_CoC_Merged.shp"),
+        'counties': os.path.join(base_dir, 'shapefiles', 'counties', str(year), state_dir,
+                                 f"{prefix}_{year}_{fips}_county{suffix}.shp"),
+        'Census places': os.path.join(base_dir, 'shapefiles', 'Census places', str(year), state_dir,
+                                      f"{prefix}_{year}_{fips}_place{suffix}.shp"),
+        'county subdivisions': os.path.join(base_dir, 'shapefiles', 'county subdivisions',
+                                            '2007_Merged' if year == 2007 else str(year), state_dir,
+                                            f"{prefix}_{year}_{fips}_cousub{suffix}.shp"),
+    }
+
+
+def generate_dataset(base_dir, years, states_fips, size='small', seed=0, fmt='shp', coc_crs='EPSG:4326'):
+    """
+    Generate and write the layers of every (year, state) under base_dir.
+
+    The states are laid out side by side, and the geometry of a state is the same in every year (only the column
+    names change in 2010), like the mostly unchanged boundaries of the real data.
+
+    :param fmt: 'shp' or 'parquet', see Common/GeoStore.py
+    :return: dict (year, state) -> dict layer type -> path written
+    """
+    written = {}
+    for i, (state, fips) in enumerate(states_fips.items()):
+        origin = (-120.0 + (i % 10) * STATE_EXTENT[0], 30.0 + (i // 10) * STATE_EXTENT[1])
+        for year in years:
+            layers = generate_state(size, state, fips, year, seed + i, origin, coc_crs)
+            paths = layer_paths(base_dir, year, state, fips)
+            written[(year, state)] = {}
+            for layer_type, gdf in layers.items():
+                os.makedirs(os.path.dirname(paths[layer_type]), exist_ok=True)
+                written[(year, state)][layer_type] = write_layer(gdf, paths[layer_type], fmt)
+    return written
+
+
+def describe(layers):
+    """Feature and vertex counts of generated layers."""
+    return pd.DataFrame([{'layer': layer_type, 'features': len(gdf),
+                          'vertices': int(shapely.get_num_coordinates(np.asarray(gdf.geometry.array)).sum())}
+                         for layer_type, gdf in layers.items()])
+
+
+output_dir = os.path.join('D:\\UMich\\z-others\\Haolin_Code', 'synthetic')
+years_to_generate = [2010, 2018]
+states_to_generate = {'Connecticut': '09', 'Rhode Island': '44'}
+dataset_size = 'small'
+
+if __name__ == '__main__':
+    generate_dataset(output_dir, years_to_generate, states_to_generate, dataset_size)
+    print(describe(generate_state(dataset_size)))
@@ -9,13 +9,18 @@ that is organized by year and state. The script will not download
 shapefiles for a state if the shapefiles already exist in the
 target directory.
 
+The states are downloaded concurrently on the shared download engine
+(Common/Downloader.py), see the settings at the bottom. The archives
+are saved into shapefiles/Continuums of Care and kept compressed,
+Merge/CoCMerge.py reads the shapefiles from inside them (set
+extract = True to also extract them).
+
 target directory structure:
-    Data
+    Continuums of Care
     ├── 2007
     │   ├── Alabama
-    │   │   ├── CoC_GIS_2007.shp
-    │   │   ├── CoC_GIS_2007.shx
-    │   │   ├── ...
+    │   │   ├── CoC_GIS_State_Shapefile_AL_2007.zip
+    │   │   ├── (AL-500.shp, AL-500.shx, ... when extracted)
     │   ├── Alaska
     │   │   ├── ...
     │   ├── ...
@@ -25,9 +30,13 @@ target directory structure:
 """
 
 import os
-import requests
+import shutil
+import sys
 import zipfile
-from io import BytesIO
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from Common.Downloader import Downloader
+from Common.RunLog import StageLog
 
 # states and their abbreviations
 states = {
@@ -50,22 +59,24 @@ states = {
     "VI": "Virgin Islands of the United States"
 }
 
-base_url = "https://files.hudexchange.info/reports/published"
-target_directory = "Data"
 
 
-def download_and_extract_coc_shapefiles(year, states, base_url, target_directory):
-    for state_abbr, state_name in states.items():
-        url = f"{base_url}/CoC_GIS_State_Shapefile_{state_abbr}_{year}.zip"
-        response = requests.get(url)
+def download_and_extract_coc_state(year, state_abbr, state_name, base_url, target_directory):
+    url = f"{base_url}/CoC_GIS_State_Shapefile_{state_abbr}_{year}.zip"
+    # make sure the target directory exists
+    state_directory = os.path.join(target_directory, str(year), state_name)
+    os.makedirs(state_directory, exist_ok=True)
 
-        if response.status_code == 200:
-            # make sure the target directory exists
-            state_directory = os.path.join(target_directory, str(year), state_name)
-            os.makedirs(state_directory, exist_ok=True)
+    # the archive is streamed to disk, an interrupted download resumes where it stopped
+    zip_path = os.path.join(state_directory, os.path.basename(url))
+    log = StageLog('download_and_extract_coc_shapefiles', year=year, state=state_name)
+    status = downloader.download(url, zip_path)
+    log.lap('download', bytes=os.path.getsize(zip_path) if status == 200 else 0, status=status)
 
-            # process the zip file
-            with zipfile.ZipFile(BytesIO(response.content)) as zip_ref:
+    if status == 200:
+        if extract:
+            # process the zip file, member by member from disk
+            with zipfile.ZipFile(zip_path) as zip_ref:
                 for member in zip_ref.infolist():
                     # add the year and state name to the path
                     path_parts = member.filename.split('/')[1:]
@@ -74,19 +85,42 @@ def download_and_extract_coc_shapefiles(year, states, base_url, target_directory
                     if member.is_dir():
                         os.makedirs(extracted_path, exist_ok=True)
                     else:
-                        with open(extracted_path, 'wb') as file:
-                            file.write(zip_ref.read(member.filename))
+                        os.makedirs(os.path.dirname(extracted_path), exist_ok=True)
+                        with zip_ref.open(member) as source, open(extracted_path, 'wb') as file:
+                            shutil.copyfileobj(source, file)
+            log.lap('extract')
+
+        print(f"Downloaded {state_name} data for {year}")
+    elif status == 304:
+        # the archive kept from an earlier run is still the current one
+        print(f"{state_name} data for {year} is up to date")
+    else:
+        print(f"Failed to download data for {state_name} in {year}")
+    return status
 
-            print(f"Downloaded and extracted {state_name} data for {year}")
-        else:
-            print(f"Failed to download data for {state_name} in {year}")
 
+def download_and_extract_coc_shapefiles(year, states, base_url, target_directory):
+    downloader.run(download_and_extract_coc_state,
+                   [(year, state_abbr, state_name, base_url, target_directory)
+                    for state_abbr, state_name in states.items()], label=f'CoC {year}')
+
+
+base_url = "https://files.hudexchange.info/reports/published"
+# the archives are saved into the shapefiles folder the pipeline reads (see README), so nothing has to be copied
+target_directory = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                'shapefiles', 'Continuums of Care')
+
+# False keeps the archives compressed, Merge/CoCMerge.py reads the shapefiles from inside them
+extract = False
 
-# download the shapefiles for 2010
-# download_and_extract_coc_shapefiles(2010, states, base_url, target_directory)
-#
-# # and other years
-for year in range(2007, 2024):
-    download_and_extract_coc_shapefiles(year, states, base_url, target_directory)
+# number of concurrent downloads and requests per second to the HUD server (None for no limit)
+# the manifest records the archives (ETag, Last-Modified, size, hash), reruns only fetch the ones that changed
+downloader = Downloader(workers=8, rate_limit=4,
+                        manifest=os.path.join(target_directory, 'download_manifest.json'))
 
-# download_and_extract_coc_shapefiles(2009, states, base_url, target_directory)
+if __name__ == '__main__':
+    # download the shapefiles of all years and states in one batch
+    # (download_and_extract_coc_shapefiles(2010, states, base_url, target_directory) downloads a single year)
+    downloader.run(download_and_extract_coc_state,
+                   [(year, state_abbr, state_name, base_url, target_directory)
+                    for year in range(2007, 2024) for state_abbr, state_name in states.items()], label='CoC')
@@ -3,27 +3,35 @@ Author: Haolin Li
 Last Updated: 12/21/2023
 
 This script is for downloading the Census County Shapefiles from the TIGER/Line database.
-The shapefiles are downloaded and extracted into the Data directory.
+The archives are downloaded into shapefiles/counties, several at a time on the shared download engine
+(Common/Downloader.py, see the settings at the bottom), and kept compressed: the pipeline reads the shapefiles from
+inside them (see Common/GeoStore.py).
 
-Target Directory Structure (Data):
-Data
+Target Directory Structure (shapefiles/counties):
+counties
 ├── 2007
 │   ├── 01_ALABAMA
-│   │   └── place shapefile
+│   │   └── county archive (.zip)
 │   ├── 02_ALASKA
-│   │   └── place shapefile
+│   │   └── county archive (.zip)
 │   ├── 04_ARIZONA
 │   │   └── ...
 │   ├── ...
 │   ...
 ├── 2008
-
+│   ...
+├── 2011
+│   └── tl_2011_us_county.zip (all states, split per state by CountyProcess)
+│   ...
 """
 
 import os
-import requests
+import sys
 import zipfile
-from io import BytesIO
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from Common.Downloader import Downloader
+from Common.RunLog import StageLog
 
 # Define the base URL for the Census shapefiles.
 base_url = "https://www2.census.gov/geo/tiger/"
@@ -93,38 +101,60 @@ def download_and_extract_county(year, code, name):
     # Modify the URL and directory structure based on the year.
     if year >= 2011:
         url = f"{base_url}TIGER{year}/COUNTY/tl_{year}_us_county.zip"
-        dir_path = f"Data/{year}/"  # No need for state subdirectories from 2011 onwards.
+        dir_path = os.path.join(target_directory, str(year))  # No need for state subdirectories from 2011 onwards.
     elif year == 2010:
         url = f"{base_url}TIGER{year}/COUNTY/2010/tl_{year}_{code}_county10.zip"
-        dir_path = f"Data/{year}/{code}_{name}"
+        dir_path = os.path.join(target_directory, str(year), f"{code}_{name}")
     elif year == 2007:
         url = f"{base_url}TIGER{year}FE/{code}_{name}/fe_{year}_{code}_county.zip"
-        dir_path = f"Data/{year}/{code}_{name}"
+        dir_path = os.path.join(target_directory, str(year), f"{code}_{name}")
     else:  # For 2008 and 2009
         url = f"{base_url}TIGER{year}/{code}_{name}/tl_{year}_{code}_county.zip"
-        dir_path = f"Data/{year}/{code}_{name}"
+        dir_path = os.path.join(target_directory, str(year), f"{code}_{name}")
 
     # Create the directory if it does not exist.
     os.makedirs(dir_path, exist_ok=True)
 
-    # Download the zip file.
-    response = requests.get(url)
-    if response.status_code == 200:
-        zip_file = zipfile.ZipFile(BytesIO(response.content))
-
-        # Extract the shapefile into the specified directory.
-        zip_file.extractall(path=dir_path)
-        print(f"Successfully downloaded and extracted county files for {name}, {year}")
+    # Download the zip file, streamed to disk (an interrupted download resumes where it stopped).
+    zip_path = os.path.join(dir_path, os.path.basename(url))
+    log = StageLog('download_and_extract_county', year=year, state=name)
+    status = downloader.download(url, zip_path)
+    log.lap('download', bytes=os.path.getsize(zip_path) if status == 200 else 0, status=status)
+    if status == 200:
+        if extract:
+            # Extract the shapefile into the specified directory, reading the archive from disk.
+            with zipfile.ZipFile(zip_path) as zip_file:
+                zip_file.extractall(path=dir_path)
+            log.lap('extract')
+        print(f"Successfully downloaded county files for {name}, {year}")
+    elif status == 304:
+        # the archive kept from an earlier run is still the current one
+        print(f"County files for {name}, {year} are up to date")
     else:
-        print(f"Failed to download county data for {name}, {year}. HTTP status code: {response.status_code}")
+        print(f"Failed to download county data for {name}, {year}. HTTP status code: {status}")
+    return status
 
 
-# Modify the loop to download and extract the county shapefiles.
-for year in range(2007, 2024):
-    if year >= 2011:
-        # For 2011 and later, download the US-wide file without looping through states.
-        download_and_extract_county(year, 'us', 'USA')
-    else:
-        # For 2007 to 2010, continue downloading files for each state and territory.
-        for code, name in states_and_territories.items():
-            download_and_extract_county(year, code, name)
+# where the archives are saved: the folder of the layer in the shapefiles folder the pipeline reads (see README),
+# laid out as the scripts construct the shapefile paths, so nothing has to be copied
+target_directory = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                'shapefiles', 'counties')
+
+# False keeps the archives compressed, the shapefiles are read from inside them (/vsizip/, see Common/GeoStore.py)
+extract = False
+
+# number of concurrent downloads and requests per second to the Census server (None for no limit)
+# the manifest records the archives (ETag, Last-Modified, size, hash), reruns only fetch the ones that changed
+downloader = Downloader(workers=8, rate_limit=4,
+                        manifest=os.path.join(target_directory, 'download_manifest.json'))
+
+if __name__ == '__main__':
+    tasks = []
+    for year in range(2007, 2024):
+        if year >= 2011:
+            # For 2011 and later, download the US-wide file without looping through states.
+            tasks.append((year, 'us', 'USA'))
+        else:
+            # For 2007 to 2010, continue downloading files for each state and territory.
+            tasks.extend((year, code, name) for code, name in states_and_territories.items())
+    downloader.run(download_and_extract_county, tasks, label='counties')
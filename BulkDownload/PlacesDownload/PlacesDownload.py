@@ -3,15 +3,17 @@ Author: Haolin Li
 Last Updated: 12/21/2023
 
 This script is for downloading the Census Place Shapefiles from the TIGER/Line database.
-The shapefiles are downloaded and extracted into the Data directory.
+The archives are downloaded into shapefiles/Census places, several at a time on the shared download engine
+(Common/Downloader.py, see the settings at the bottom), and kept compressed: the pipeline reads the shapefiles from
+inside them (see Common/GeoStore.py).
 
-Target Directory Structure (Data):
-Data
+Target Directory Structure (shapefiles/Census places):
+Census places
 ├── 2007
 │   ├── 01_ALABAMA
-│   │   └── place shapefile
+│   │   └── place archive (.zip)
 │   ├── 02_ALASKA
-│   │   └── place shapefile
+│   │   └── place archive (.zip)
 │   ├── 04_ARIZONA
 │   │   └── ...
 │   ├── ...
@@ -21,9 +23,12 @@ Data
 """
 
 import os
-import requests
+import sys
 import zipfile
-from io import BytesIO
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from Common.Downloader import Downloader
+from Common.RunLog import StageLog
 
 # Define the base URL for the Census shapefiles.
 base_url = "https://www2.census.gov/geo/tiger/"
@@ -100,23 +105,44 @@ def download_and_extract(year, code, name):
         url = f"{base_url}TIGER{year}/{code}_{name}/tl_{year}_{code}_place.zip"
 
     # Define the directory path based on the year, code, and name.
-    dir_path = f"Data/{year}/{code}_{name}"
+    dir_path = os.path.join(target_directory, str(year), f"{code}_{name}")
 
     # Create the directory if it does not exist.
     os.makedirs(dir_path, exist_ok=True)
 
-    # Download the zip file.
-    response = requests.get(url)
-    if response.status_code == 200:
-        zip_file = zipfile.ZipFile(BytesIO(response.content))
-
-        # Extract the shapefile into the specified directory.
-        zip_file.extractall(path=dir_path)
-        print(f"Successfully downloaded and extracted files for {name}, {year}")
+    # Download the zip file, streamed to disk (an interrupted download resumes where it stopped).
+    zip_path = os.path.join(dir_path, os.path.basename(url))
+    log = StageLog('download_and_extract', year=year, state=name)
+    status = downloader.download(url, zip_path)
+    log.lap('download', bytes=os.path.getsize(zip_path) if status == 200 else 0, status=status)
+    if status == 200:
+        if extract:
+            # Extract the shapefile into the specified directory, reading the archive from disk.
+            with zipfile.ZipFile(zip_path) as zip_file:
+                zip_file.extractall(path=dir_path)
+            log.lap('extract')
+        print(f"Successfully downloaded files for {name}, {year}")
+    elif status == 304:
+        # the archive kept from an earlier run is still the current one
+        print(f"Files for {name}, {year} are up to date")
     else:
-        print(f"Failed to download data for {code} - {name}, {year}. HTTP status code: {response.status_code}")
+        print(f"Failed to download data for {code} - {name}, {year}. HTTP status code: {status}")
+    return status
+
+# where the archives are saved: the folder of the layer in the shapefiles folder the pipeline reads (see README),
+# laid out as the scripts construct the shapefile paths, so nothing has to be copied
+target_directory = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                'shapefiles', 'Census places')
+
+# False keeps the archives compressed, the shapefiles are read from inside them (/vsizip/, see Common/GeoStore.py)
+extract = False
+
+# number of concurrent downloads and requests per second to the Census server (None for no limit)
+# the manifest records the archives (ETag, Last-Modified, size, hash), reruns only fetch the ones that changed
+downloader = Downloader(workers=8, rate_limit=4,
+                        manifest=os.path.join(target_directory, 'download_manifest.json'))
 
-# Loop through each year and state/territory to download and extract the shapefiles.
-for year in range(2007, 2024):
-    for code, name in states_and_territories.items():
-        download_and_extract(year, code, name)
+# Download and extract the shapefiles of each year and state/territory.
+if __name__ == '__main__':
+    downloader.run(download_and_extract, [(year, code, name) for year in range(2007, 2024)
+                                          for code, name in states_and_territories.items()], label='places')
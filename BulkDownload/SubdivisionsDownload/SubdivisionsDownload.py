@@ -1,7 +1,10 @@
 import os
-import requests
+import sys
 import zipfile
-from io import BytesIO
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from Common.Downloader import Downloader
+from Common.RunLog import StageLog
 
 # Define the base URL for the Census shapefiles.
 base_url = "https://www2.census.gov/geo/tiger/"
@@ -33,37 +36,56 @@ def download_and_extract_cousub(year, code, name):
     # Modify the URL and directory structure based on the year.
     if year >= 2011:
         url = f"{base_url}TIGER{year}/COUSUB/tl_{year}_{code}_cousub.zip"
-        dir_path = f"Data/{year}/{code}_{name}"
+        dir_path = os.path.join(target_directory, str(year), f"{code}_{name}")
     elif year == 2010:
         url = f"{base_url}TIGER{year}/COUSUB/2010/tl_{year}_{code}_cousub10.zip"
-        dir_path = f"Data/{year}/{code}_{name}"
+        dir_path = os.path.join(target_directory, str(year), f"{code}_{name}")
     elif year == 2007:
-        # 2007 data is within each county directory, so this requires a different approach to fetch all counties.
-        pass  # Placeholder for now, as it requires fetching county-specific data.
+        # 2007 data is within each county directory, the counties are fetched by SubdivisionsDownload_for2007.py
+        raise ValueError("The 2007 county subdivisions are per county, download them with "
+                         "SubdivisionsDownload_for2007.py")
     else:  # For 2008 and 2009
         url = f"{base_url}TIGER{year}/{code}_{name}/tl_{year}_{code}_cousub.zip"
-        dir_path = f"Data/{year}/{code}_{name}"
+        dir_path = os.path.join(target_directory, str(year), f"{code}_{name}")
 
     # Create the directory if it does not exist.
     os.makedirs(dir_path, exist_ok=True)
 
-    # Download the zip file.
-    response = requests.get(url)
-    if response.status_code == 200:
-        zip_file = zipfile.ZipFile(BytesIO(response.content))
-
-        # Extract the shapefile into the specified directory.
-        zip_file.extractall(path=dir_path)
-        print(f"Successfully downloaded and extracted cousub files for {name}, {year}")
+    # Download the zip file, streamed to disk (an interrupted download resumes where it stopped).
+    zip_path = os.path.join(dir_path, os.path.basename(url))
+    log = StageLog('download_and_extract_cousub', year=year, state=name)
+    status = downloader.download(url, zip_path)
+    log.lap('download', bytes=os.path.getsize(zip_path) if status == 200 else 0, status=status)
+    if status == 200:
+        if extract:
+            # Extract the shapefile into the specified directory, reading the archive from disk.
+            with zipfile.ZipFile(zip_path) as zip_file:
+                zip_file.extractall(path=dir_path)
+            log.lap('extract')
+        print(f"Successfully downloaded cousub files for {name}, {year}")
+    elif status == 304:
+        # the archive kept from an earlier run is still the current one
+        print(f"Cousub files for {name}, {year} are up to date")
     else:
-        print(f"Failed to download cousub data for {name}, {year}. HTTP status code: {response.status_code}")
+        print(f"Failed to download cousub data for {name}, {year}. HTTP status code: {status}")
+    return status
 
-# Modify the loop to download and extract the county subdivision shapefiles.
-for year in range(2007, 2024):
-    if year != 2007:
-        # For 2008 onwards, download files for specified states.
-        for code, name in specified_states.items():
-            download_and_extract_cousub(year, code, name)
-    else:
-        # TODO: Implement the logic for 2007 data, which requires county-specific URLs.
-        pass  # Placeholder for 2007 logic.
+# where the archives are saved: the folder of the layer in the shapefiles folder the pipeline reads (see README),
+# laid out as the scripts construct the shapefile paths, so nothing has to be copied
+target_directory = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                'shapefiles', 'county subdivisions')
+
+# False keeps the archives compressed, the shapefiles are read from inside them (/vsizip/, see Common/GeoStore.py)
+extract = False
+
+# number of concurrent downloads and requests per second to the Census server (None for no limit)
+# (the downloads run on the shared download engine, see Common/Downloader.py)
+# the manifest records the archives (ETag, Last-Modified, size, hash), reruns only fetch the ones that changed
+downloader = Downloader(workers=8, rate_limit=4,
+                        manifest=os.path.join(target_directory, 'download_manifest.json'))
+
+# Download and extract the county subdivision shapefiles.
+if __name__ == '__main__':
+    # For 2008 onwards, download files for specified states (2007: see SubdivisionsDownload_for2007.py).
+    downloader.run(download_and_extract_cousub, [(year, code, name) for year in range(2008, 2024)
+                                                 for code, name in specified_states.items()], label='subdivisions')
@@ -1,9 +1,14 @@
 import os
-import requests
+import sys
+import threading
 import zipfile
-from io import BytesIO
 import csv
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from Common.Downloader import Downloader
+from Common.GeoStore import LayerWriter, archive_layers, read_layer, resolve_layer
+from Common.RunLog import StageLog
+
 state_names = {
     "AL": "01_ALABAMA",
     "AK": "02_ALASKA",
@@ -95,40 +100,208 @@ def read_csv_to_dict(csv_path):
     return counties_by_state
 
 # url: https://www2.census.gov/geo/tiger/TIGER2007FE/09_CONNECTICUT/09001_Fairfield/fe_2007_09001_cousub.zip
-def download_and_extract_shapefile(state, county, year, fips):
+def county_url(state, county, year, fips):
     # Constructing the download URL
-    base_url = "https://www2.census.gov/geo/tiger/TIGER{year}FE/{state_fips}_{state_name}/{county_fips}_{county}/fe_{year}_{county_fips}_cousub.zip"
+    url = "{base_url}TIGER{year}FE/{state_fips}_{state_name}/{county_fips}_{county}/fe_{year}_{county_fips}_cousub.zip"
     state_fips, state_name = state.split('_')
-    county_fips = fips
-    county_dir_name = f"{county_fips}_{county.replace(' ', '_')}"
-    download_url = base_url.format(year=year, state_fips=state_fips, state_name=state_name.replace(' ', '_'), county_fips=county_fips, county=county)
+    return url.format(base_url=base_url, year=year, state_fips=state_fips, state_name=state_name.replace(' ', '_'),
+                      county_fips=fips, county=county)
 
-    # Download the file
-    response = requests.get(download_url)
-    if response.status_code == 200:
-        # Define the path to save the zip file and extract to
-        county_dir_path = os.path.join('Data', '2007', state, county_dir_name)
-        zip_path = os.path.join(county_dir_path, f'{county_fips}_{county}.zip')
 
-        # Ensure the directories exist
-        os.makedirs(county_dir_path, exist_ok=True)
+def county_archive_path(state, county, fips):
+    # the archive of a county, kept in data_directory: <state>/<fips>_<county>/<fips>_<county>.zip
+    county_dir_name = f"{fips}_{county.replace(' ', '_')}"
+    return os.path.join(data_directory, state, county_dir_name, f'{fips}_{county}.zip')
 
-        # Write the zip file to the specified path
-        with open(zip_path, 'wb') as file:
-            file.write(response.content)
 
+def download_and_extract_shapefile(state, county, year, fips):
+    download_url = county_url(state, county, year, fips)
+
+    # Define the path to save the zip file and extract to
+    zip_path = county_archive_path(state, county, fips)
+    county_dir_path = os.path.dirname(zip_path)
+
+    # Ensure the directories exist
+    os.makedirs(county_dir_path, exist_ok=True)
+
+    # Download the file, streamed to the zip path (an interrupted download resumes where it stopped)
+    log = StageLog('download_and_extract_shapefile', year=year, state=state, county=county)
+    status = downloader.download(download_url, zip_path)
+    log.lap('download', bytes=os.path.getsize(zip_path) if status == 200 else 0, status=status)
+    if status == 200:
         # Extract the zip file
         with zipfile.ZipFile(zip_path, 'r') as zip_ref:
             zip_ref.extractall(county_dir_path)
-        os.remove(zip_path)  # Remove the zip file after extracting
+        log.lap('extract')
 
         print(f'Successfully downloaded and extracted {county} in {state}')
+    elif status == 304:
+        # the archive kept from an earlier run is still the current one
+        print(f'{county} in {state} is up to date')
+    else:
+        print(f'Failed to download data for {county} in {state}. URL: {download_url} returned status code {status}')
+
+class StateMerger:
+    def __init__(self, counties_by_state, year, output_dir, fmt='shp'):
+        """
+        Appends the county subdivisions of each state to the merged file of the state as the counties are fetched,
+        so the merged file of a state does not wait for the other states and only the county being appended is in
+        memory. The counties are appended in the order of the csv: a county fetched before the ones listed above it
+        waits for them as the path of its archive.
+
+        A state whose archives were all answered with a 304 (unchanged since the last run) is not written again when
+        its merged file is there.
+
+        :param counties_by_state: dict state (e.g. '09_CONNECTICUT') -> list of {"fips": ..., "name": ...}
+        :param output_dir: the merged states are written to <output_dir>/<state>/fe_<year>_<fips>_cousub.shp
+        :param fmt: 'shp' or 'parquet', see Common/GeoStore.py
+        """
+        self.year = year
+        self.output_dir = output_dir
+        self.fmt = fmt
+        self.order = {state: [county['fips'] for county in counties] for state, counties in counties_by_state.items()}
+        # state -> fips -> archive of the county (None when it could not be fetched), as they come in
+        self.archives = {state: {} for state in counties_by_state}
+        self.changed = {state: False for state in counties_by_state}
+        # state -> LayerWriter and number of counties of the order appended so far
+        self.writers = {}
+        self.appended = {state: 0 for state in counties_by_state}
+        # one lock per state, the counties of a state are appended one at a time
+        self.locks = {state: threading.Lock() for state in counties_by_state}
+
+    def merged_path(self, state):
+        state_fips = state.split('_')[0]
+        return os.path.join(self.output_dir, state.replace(' ', '_'), f'fe_{self.year}_{state_fips}_cousub.shp')
+
+    def add(self, state, fips, archive, changed=True):
+        """
+        Add the archive of a county (None when it could not be fetched), changed is False when the archive kept from
+        an earlier run is still the current one.
+        """
+        with self.locks[state]:
+            self.archives[state][fips] = archive
+            self.changed[state] = self.changed[state] or changed
+            complete = len(self.archives[state]) == len(self.order[state])
+            if not self.changed[state]:
+                # nothing to write until a county changed, or the last county is in and the state was never merged
+                if not complete:
+                    return
+                if os.path.exists(resolve_layer(self.merged_path(state))):
+                    print(f'The county subdivisions of {state} are up to date')
+                    return
+            self._append_fetched(state)
+            if complete:
+                self._close(state)
+
+    def _append_fetched(self, state):
+        # append the counties of the order that are in, up to the first one still being fetched
+        if state not in self.writers:
+            path = self.merged_path(state)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.writers[state] = LayerWriter(path, self.fmt)
+        order, archives = self.order[state], self.archives[state]
+        while self.appended[state] < len(order) and order[self.appended[state]] in archives:
+            fips = order[self.appended[state]]
+            archive = archives[fips]
+            if archive is not None:
+                try:
+                    gdf = read_layer(archive_layers(archive)[0])
+                except Exception as e:
+                    # an archive that cannot be read (e.g. a corrupt zip) is a missing county, the state is still
+                    # merged; the archive is removed so that the next run downloads it again
+                    archives[fips] = None
+                    StageLog('fetch_and_merge_subdivisions', year=self.year, state=state, county=fips).lap(
+                        'read', error=f'{e.__class__.__name__}: {e}'[-2000:])
+                    print(f'Could not read {archive} ({e.__class__.__name__}: {e}), county {fips} of {state} skipped')
+                    os.remove(archive)
+                else:
+                    self.writers[state].append(gdf)
+            self.appended[state] += 1
+
+    def _close(self, state):
+        writer = self.writers.pop(state)
+        missing = sum(archive is None for archive in self.archives[state].values())
+        counties = len(self.order[state]) - missing
+        path = writer.close()
+        if path is None:
+            print(f'No county subdivisions fetched for {state}, nothing written')
+            return
+        StageLog('fetch_and_merge_subdivisions', year=self.year, state=state).lap(
+            'write', features=writer.features, counties=counties, missing=missing)
+        print(f'Merged {counties} counties of {state} into {path}' +
+              (f' ({missing} counties missing)' if missing else ''))
+
+
+def fetch_and_merge_county(merger, state, county, year, fips):
+    """
+    Fetch the archive of a county, with a conditional request when it is kept from an earlier run, and hand it to
+    the merger, which reads its shapefile from inside the archive.
+    """
+    # a county that could not be fetched does not make its state be written again by itself
+    archive, changed = None, False
+    try:
+        download_url = county_url(state, county, year, fips)
+        zip_path = county_archive_path(state, county, fips)
+        os.makedirs(os.path.dirname(zip_path), exist_ok=True)
+        log = StageLog('fetch_and_merge_subdivisions', year=year, state=state, county=county)
+        status = downloader.download(download_url, zip_path)
+        log.lap('download', bytes=os.path.getsize(zip_path) if status == 200 else 0, status=status)
+        if status in (200, 304):
+            archive, changed = zip_path, status == 200
+        else:
+            print(f'Failed to download data for {county} in {state}. URL: {download_url} returned status code '
+                  f'{status}')
+    finally:
+        # a failed county still counts, so that its state is written with the other counties
+        merger.add(state, fips, archive, changed)
+
+
+def fetch_and_merge_subdivisions(counties_by_state, year, output_dir, fmt='shp'):
+    """
+    Download the county archives of all states concurrently and merge them per state in one pass, replacing
+    download_and_extract_shapefile followed by Merge/SubdivisionMerge.py. Nothing is extracted: the archives are kept
+    in data_directory (so a rerun only fetches the ones that changed) and each county is appended to
+    <output_dir>/<state>/fe_<year>_<fips>_cousub.shp as it comes in, see StateMerger.
+    """
+    merger = StateMerger(counties_by_state, year, output_dir, fmt)
+    return downloader.run(fetch_and_merge_county,
+                          [(merger, state, county['name'], year, county['fips'])
+                           for state, counties in counties_by_state.items() for county in counties],
+                          label='subdivisions 2007 fetch and merge')
+
+
+# where the county archives are kept (and extracted when fetch_and_merge is False), with their download manifest
+data_directory = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                              'Data', '2007')
+
+# number of concurrent downloads and requests per second to the Census server (None for no limit)
+# (the downloads run on the shared download engine, see Common/Downloader.py)
+# the manifest records the archives (ETag, Last-Modified, size, hash), reruns only fetch the ones that changed
+downloader = Downloader(workers=16, rate_limit=8, manifest=os.path.join(data_directory, 'download_manifest.json'))
+
+# the Census server, set to the url of a local fixture server to test (see Benchmark/FixtureServer.py)
+base_url = "https://www2.census.gov/geo/tiger/"
+
+# True: fetch the counties and write the merged states in one pass (no extracted files, no SubdivisionMerge.py run)
+# False: keep the archives and the extracted county shapefiles in data_directory, to be merged by SubdivisionMerge.py
+fetch_and_merge = True
+
+# where the merged states are written, the layout read by Intersection/CoC@Subdivisions.py
+merged_directory = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                'shapefiles', 'county subdivisions', '2007_Merged')
+
+# Format of the merged files: 'shp' or 'parquet' (GeoParquet, see Common/GeoStore.py)
+intermediate_format = 'shp'
+
+if __name__ == '__main__':
+    # Replace 'path_to_your_csv' with the actual path to your CSV file
+    counties_by_state = read_csv_to_dict("fips-by-state.csv")
+    # Only proceed with the states in the list of states to download
+    counties_by_state = {state: counties for state, counties in counties_by_state.items()
+                         if state in states_to_download}
+    if fetch_and_merge:
+        fetch_and_merge_subdivisions(counties_by_state, 2007, merged_directory, intermediate_format)
     else:
-        print(f'Failed to download data for {county} in {state}. URL: {download_url} returned status code {response.status_code}')
-
-# Replace 'path_to_your_csv' with the actual path to your CSV file
-counties_by_state = read_csv_to_dict("fips-by-state.csv")
-for state, counties in counties_by_state.items():
-    if state in states_to_download:  # Only proceed if the state is in the list of states to download
-        for county in counties:
-            download_and_extract_shapefile(state, county['name'], 2007, county['fips'])
+        downloader.run(download_and_extract_shapefile,
+                       [(state, county['name'], 2007, county['fips']) for state, counties in counties_by_state.items()
+                        for county in counties], label='subdivisions 2007')
@@ -0,0 +1,34 @@
+"""
+This script builds (or updates) the input catalog of the shapefiles folder, shapefiles/catalog.sqlite.
+
+Every layer under the shapefiles folder (extracted shapefiles, GeoParquet files, downloaded zip archives and the county
+store partitions) is recorded from its header only: layer, year, state, fips, CRS, feature count, bounds, columns and
+content hash, see Common/Catalog.py. The Merge, Intersection and AddiInter scripts then take their inputs from the
+catalog instead of formatting the paths and listing the folders. Run it again after a download or a merge, only the
+new and changed files are read.
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Common.Catalog import Catalog
+
+
+def build_catalog(shapefiles_dir, workers=8):
+    """Scan the shapefiles folder into its catalog, return the number of layers per (layer, year)."""
+    catalog = Catalog(shapefiles_dir)
+    try:
+        catalog.scan(workers)
+        return catalog.layers().groupby(['layer', 'year']).size().rename('files')
+    finally:
+        catalog.close()
+
+
+shapefiles_directory = "D:\\UMich\\z-others\\Haolin_Code\\shapefiles"
+
+# number of threads reading the headers
+workers = 8
+
+if __name__ == '__main__':
+    print(build_catalog(shapefiles_directory, workers).to_string())
@@ -0,0 +1,99 @@
+"""
+This module computes the areas behind the share columns (%of_county, %of_place, %of_subdiv).
+
+The scripts used GeoSeries.area in the CRS of the CoC file, which is often geographic, so the areas were in square
+degrees and the shares of a polygon were skewed by its latitude. The area method of a run (the 'area' option) is
+one of AREA_METHODS:
+    - 'planar': GeoSeries.area in the CRS of the layer, the original behaviour
+    - 'equal_area': planar area after a projection to an equal-area CRS (the 'area_crs' option, CONUS Albers by
+      default, which keeps areas exact outside CONUS too)
+    - 'geodesic': area on the ellipsoid of the layer's CRS (pyproj.Geod), the most accurate and the slowest
+
+shares computes both shares of each intersection piece, of its census polygon and of its CoC, from the row positions
+intersect(..., rows=True) carries through the overlay: the areas of the input polygons are computed once and looked up
+by position, instead of a merge on the FIPS columns (which are only unique within a state).
+
+The geometries are projected as one coordinate array with shapely.transform, and the pyproj transformers are created
+once per (source, target) CRS pair and process, instead of once per to_crs call. reproject uses the same transformers
+for the CRS alignment of the input layers.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+import geopandas as gpd
+import pyproj
+import shapely
+
+AREA_METHODS = ('planar', 'equal_area', 'geodesic')
+
+# NAD83 / Conus Albers
+DEFAULT_AREA_CRS = 'EPSG:5070'
+
+
+@lru_cache(maxsize=None)
+def _crs(crs):
+    return pyproj.CRS.from_user_input(crs)
+
+
+@lru_cache(maxsize=None)
+def _transformer(source, target):
+    # keyed by the WKT of both CRS, so equal CRS objects share one transformer
+    return pyproj.Transformer.from_crs(_crs(source), _crs(target), always_xy=True)
+
+
+def transform_geometries(geoms, source, target):
+    """Project an array of shapely geometries from one CRS to another in a single batch."""
+    transformer = _transformer(pyproj.CRS(source).to_wkt(), pyproj.CRS(target).to_wkt())
+
+    def project(coords):
+        x, y = transformer.transform(coords[:, 0], coords[:, 1])
+        return np.column_stack([x, y])
+
+    return shapely.transform(geoms, project)
+
+
+def reproject(gdf, crs):
+    """GeoDataFrame.to_crs with a cached transformer."""
+    if gdf.crs == crs:
+        return gdf
+    geometry = gpd.GeoSeries(transform_geometries(np.asarray(gdf.geometry.array), gdf.crs, crs), index=gdf.index,
+                             crs=crs, name=gdf.geometry.name)
+    return gdf.set_geometry(geometry)
+
+
+def areas(geoseries, method='planar', area_crs=DEFAULT_AREA_CRS):
+    """
+    Areas of the geometries of a GeoSeries as a numpy array, see AREA_METHODS.
+
+    'planar' keeps the units of the CRS, 'equal_area' and 'geodesic' return square meters.
+    """
+    if method not in AREA_METHODS:
+        raise ValueError(f"Unknown area method: {method}, expected one of {AREA_METHODS}")
+    geoms = np.asarray(geoseries.array)
+    if method == 'planar':
+        return shapely.area(geoms)
+    if geoseries.crs is None:
+        raise ValueError(f"The '{method}' area method needs a CRS")
+    if method == 'equal_area':
+        return shapely.area(transform_geometries(geoms, geoseries.crs, area_crs))
+
+    # pyproj has no batch version of the geodesic area, but the projection to longitude / latitude is batched
+    crs = _crs(geoseries.crs.to_wkt())
+    geod = crs.get_geod()
+    lonlat = transform_geometries(geoms, crs, crs.geodetic_crs)
+    return np.array([abs(geod.geometry_area_perimeter(geom)[0]) if geom is not None else np.nan for geom in lonlat])
+
+
+def shares(pieces, df1, df2, method='planar', area_crs=DEFAULT_AREA_CRS):
+    """
+    Share of its df1 polygon and of its df2 polygon each intersection piece covers.
+
+    :param pieces: result of intersect(df1, df2, rows=True), with the '__row1' / '__row2' row positions
+    :return: (share of the df1 polygon, share of the df2 polygon) as numpy arrays
+    """
+    piece_areas = areas(pieces.geometry, method, area_crs)
+    # one gather per layer instead of a join, the polygons without pieces are measured too but are only read once
+    areas1 = areas(df1.geometry, method, area_crs)[pieces['__row1'].to_numpy()]
+    areas2 = areas(df2.geometry, method, area_crs)[pieces['__row2'].to_numpy()]
+    return piece_areas / areas1, piece_areas / areas2
@@ -0,0 +1,182 @@
+"""
+This module keeps a build manifest so that a rerun only recomputes the tasks whose inputs or parameters changed.
+
+For every finished task the manifest records the content hash of its input shapefiles (.shp, .dbf and .prj together),
+a hash of the processing parameters and the list of output files. A task is skipped when the hashes are unchanged
+and all its outputs still exist.
+
+Hashing a multi-GB TIGER file takes a while, so the hash of each file is also kept in the manifest together with its
+size and modification time and is only recomputed when those change. A run that changes nothing only stats files.
+An input read from inside a zip archive (a /vsizip/ path, see Common/GeoStore.py) is hashed as the whole archive.
+
+Several drivers may share a manifest (e.g. CoC@AllLayers.py and CoC@Counties.py, or two scripts run at the same
+time). save() takes a lock file next to the manifest, reads the manifest again and only writes over it the entries
+this process hashed or recorded, so the tasks another driver recorded in the meantime are kept.
+
+Manifest layout (json):
+{
+    "files": {"<path>": {"size": ..., "mtime": ..., "sha256": "..."}},
+    "tasks": {"<key>": {"inputs": {"<path>": "<sha256>"}, "params": "<sha256>", "outputs": ["<path>", ...]}}
+}
+"""
+
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from Common.GeoStore import archive_of, source_file
+from Common.ParallelRunner import run_tasks
+
+# the parts of a shapefile that define its content (.shx is derived from .shp, .cpg only names the encoding)
+SHAPEFILE_PARTS = ('.shp', '.dbf', '.prj')
+
+# a lock file older than this (in seconds) was left behind by a process that died while saving, it is taken over
+STALE_LOCK = 60
+
+
+def _sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextmanager
+def _file_lock(path, poll=0.05):
+    # hold <path>.lock, created exclusively so that only one process (of any driver) holds it at a time
+    lock_path = f'{path}.lock'
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > STALE_LOCK:
+                    os.remove(lock_path)
+                    continue
+            except OSError:
+                # released in the meantime
+                continue
+            time.sleep(poll)
+    try:
+        os.close(fd)
+        yield
+    finally:
+        os.remove(lock_path)
+
+
+def params_hash(params):
+    """Hash of a json serializable parameter dict, independent of the key order."""
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class BuildCache:
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.manifest = {'files': {}, 'tasks': {}}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as file:
+                self.manifest = json.load(file)
+        # the entries hashed or recorded by this process, the only ones save() writes over the manifest on disk
+        self.changed = {'files': set(), 'tasks': set()}
+
+    def file_hash(self, path):
+        """Content hash of one file, reusing the stored hash while its size and modification time are unchanged."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self.manifest['files'].get(path)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': _sha256(path)}
+            self.manifest['files'][path] = entry
+            self.changed['files'].add(path)
+        return entry['sha256']
+
+    def input_hash(self, path):
+        """Content hash of an input, a shapefile is hashed together with its .dbf and .prj, or as its zip archive."""
+        if archive_of(path) is not None:
+            return self.file_hash(archive_of(path))
+        base, ext = os.path.splitext(path)
+        if ext.lower() != '.shp':
+            return self.file_hash(path)
+        digest = hashlib.sha256()
+        for part in SHAPEFILE_PARTS:
+            if os.path.exists(base + part):
+                digest.update(f'{part}:{self.file_hash(base + part)};'.encode())
+        return digest.hexdigest()
+
+    def input_hashes(self, inputs):
+        # a missing input gets no hash, so the task is never fresh and runs (and reports the missing file)
+        return {os.path.abspath(p): self.input_hash(p) if os.path.exists(source_file(p)) else None for p in inputs}
+
+    def is_fresh(self, key, inputs, params, outputs):
+        entry = self.manifest['tasks'].get(key)
+        if entry is None:
+            return False
+        hashes = self.input_hashes(inputs)
+        return (None not in hashes.values() and entry['inputs'] == hashes and entry['params'] == params_hash(params)
+                and sorted(entry['outputs']) == sorted(os.path.abspath(p) for p in outputs)
+                and all(os.path.exists(p) for p in outputs))
+
+    def record(self, key, inputs, params, outputs, hashes=None):
+        self.manifest['tasks'][key] = {
+            'inputs': hashes if hashes is not None else self.input_hashes(inputs),
+            'params': params_hash(params),
+            'outputs': [os.path.abspath(p) for p in outputs],
+        }
+        self.changed['tasks'].add(key)
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.manifest_path)), exist_ok=True)
+        with _file_lock(self.manifest_path):
+            # merge into the manifest as it is on disk now, another driver may have saved it since it was read
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path) as file:
+                    manifest = json.load(file)
+                for section, keys in self.changed.items():
+                    manifest[section].update({key: self.manifest[section][key] for key in keys})
+                self.manifest = manifest
+            # write to a temporary file first so that an interrupted run never leaves a broken manifest behind
+            temp_path = f'{self.manifest_path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w') as file:
+                json.dump(self.manifest, file, indent=1)
+            os.replace(temp_path, self.manifest_path)
+        self.changed = {'files': set(), 'tasks': set()}
+
+
+def run_cached(func, tasks, paths, manifest_path, params, workers=1, label='', force=False):
+    """
+    Run the tasks whose inputs, parameters or outputs changed since the last run, see run_tasks.
+
+    :param func: task function, returns None when it passed without writing its outputs
+    :param paths: function returning the (inputs, outputs) file lists of a task, called with the task arguments,
+                  the first output is used as the key of the task in the manifest
+    :param manifest_path: json manifest of this kind of task
+    :param params: processing parameters that affect the output
+    :param force: ignore the manifest and run every task
+    :return: the run_tasks records of the tasks that were run
+    """
+    cache = BuildCache(manifest_path)
+    pending, pending_hashes = [], []
+    for task in tasks:
+        inputs, outputs = paths(*task)
+        # the output files identify a task
+        key = os.path.abspath(outputs[0])
+        if not force and cache.is_fresh(key, inputs, params, outputs):
+            continue
+        pending.append(task)
+        # remember the hashes the task was started with, a file changed during the run is picked up next time
+        pending_hashes.append((key, inputs, outputs, cache.input_hashes(inputs)))
+
+    print(f"[{label}] {len(tasks) - len(pending)}/{len(tasks)} tasks are up to date")
+    records = run_tasks(func, pending, workers=workers, label=label) if pending else []
+
+    for record, (key, inputs, outputs, hashes) in zip(records, pending_hashes):
+        # a task that passed without writing (e.g. a missing CRS) returns None and is not recorded
+        if record['status'] == 'ok' and record['result'] is not None and None not in hashes.values() \
+                and all(os.path.exists(p) for p in outputs):
+            cache.record(key, inputs, params, outputs, hashes)
+    cache.save()
+    return records
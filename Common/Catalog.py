@@ -0,0 +1,272 @@
+"""
+This module keeps the input catalog: one indexed record per layer file found under the shapefiles folder.
+
+The scripts used to find their inputs by formatting paths (fe/tl prefixes, the '10' suffix of 2010, the 2007_Merged
+folder, ...) and the merge scripts listed the folders again on every run. Catalog.scan walks the shapefiles folder
+once and records, from the file headers only (no geometry is read):
+    path, source (shp, parquet, zip or store), layer, year, state, fips, part, crs, features, bounds, columns,
+    sha256 of the file (or of its zip archive), size and modification time
+
+- layer is the top folder (CoC_Merged, Continuums of Care, counties, Census places, county subdivisions)
+- year comes from the year folder (2007_Merged is 2007), state and fips from the state folder (09_CONNECTICUT or
+  Connecticut), the partitions of a county store (see Common/CountyStore.py) only have a fips
+- part is '' for the layer of a whole state, else the path of the file below the state folder (the CoC files of a
+  state, the 2007 county subdivision files of a county). The 2007 - 2009 CoC shapefiles lie directly in the state
+  folder, one per CoC, so they are parts named by the file (which holds the CoC number, e.g. CT-500.shp). A zip
+  archive holding a single shapefile of its own name is the layer of its folder; the files of other archives are
+  parts, without the top folder of the archive, and a file that was also extracted next to its archive is recorded
+  once, as the extracted file
+- a shapefile, its GeoParquet version and its zip archive are one layer, read from the file read_layer would pick
+  (see Common/GeoStore.py)
+
+The catalog is a SQLite database, shapefiles/catalog.sqlite, indexed on (layer, year, fips) and (layer, year, state),
+so find_layer resolves an input with one indexed lookup and Catalog.layers lists the inputs of a step (with their
+feature counts and bounds) without opening any file. A rescan only reads the headers and hashes of the files whose
+size or modification time changed, and drops the records of the files that are gone.
+"""
+
+import json
+import os
+import re
+import sqlite3
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+import pyarrow.parquet as pq
+import pyogrio
+
+from Common.BuildCache import BuildCache
+from Common.GeoStore import resolve_layer, source_file, vsizip_path
+
+CATALOG_NAME = 'catalog.sqlite'
+
+COLUMNS = ('path', 'source', 'layer', 'year', 'state', 'fips', 'part', 'crs', 'features', 'minx', 'miny', 'maxx',
+           'maxy', 'columns', 'sha256', 'size', 'mtime', 'scanned')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS layers (
+    path TEXT PRIMARY KEY, source TEXT, layer TEXT, year INTEGER, state TEXT, fips TEXT, part TEXT, crs TEXT,
+    features INTEGER, minx REAL, miny REAL, maxx REAL, maxy REAL, columns TEXT, sha256 TEXT, size INTEGER,
+    mtime INTEGER, scanned TEXT
+);
+CREATE INDEX IF NOT EXISTS layers_fips ON layers (layer, year, fips);
+CREATE INDEX IF NOT EXISTS layers_state ON layers (layer, year, state);
+"""
+
+# the file of a layer that is preferred when several are recorded for the same state (e.g. a county store partition
+# and an older per-state split, or the two merged 2007 subdivision folders): store first, then the newest file
+SOURCE_ORDER = "CASE source WHEN 'store' THEN 0 ELSE 1 END, mtime DESC"
+
+# the layers and years whose files directly in the state folder are parts of the state (one file per CoC) instead of
+# the layer of the whole state
+STATE_FOLDER_PARTS = {'Continuums of Care': (2007, 2008, 2009)}
+
+
+def catalog_path(shapefiles_dir):
+    return os.path.join(shapefiles_dir, CATALOG_NAME)
+
+
+def state_key(name):
+    """The state name as recorded in the catalog: upper case with underscores (Rhode Island -> RHODE_ISLAND)."""
+    return name.upper().replace(' ', '_') if name else None
+
+
+def _location(shapefiles_dir, path):
+    # layer, year, state folder and the path below the state folder of a file, from its folders
+    parts = os.path.relpath(path, shapefiles_dir).split(os.sep)
+    layer, year, position = parts[0], None, None
+    for i, part in enumerate(parts[1:-1], 1):
+        match = re.match(r'(\d{4})(_|$)', part)
+        if match:
+            year, position = int(match.group(1)), i
+            break
+    if year is None:
+        return layer, None, None, None
+    below = parts[position + 1:]
+    if below and below[0] == 'county_store':
+        # a partition of a county store, <fips>.parquet
+        return layer, year, None, os.path.splitext(below[-1])[0]
+    if len(below) < 2:
+        # a file directly in the year folder, e.g. the national county file
+        return layer, year, None, ''
+    return layer, year, below[0], '/'.join(below[1:])
+
+
+def _candidates(shapefiles_dir):
+    # the layer files under the shapefiles folder as (read path, source, file on disk, state folder, part)
+    found = {}
+    for root, dirs, files in os.walk(shapefiles_dir):
+        dirs.sort()
+        names = set(files)
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            stem, ext = os.path.splitext(name)
+            ext = ext.lower()
+            layer, year, state_dir, part = _location(shapefiles_dir, path)
+            if year is None:
+                continue
+            if 'county_store' in path.split(os.sep) and ext == '.parquet':
+                if name != 'index.parquet':
+                    found[path] = (path, 'store', path, None, stem)
+                continue
+            if ext not in ('.shp', '.parquet', '.zip') or ext == '.zip' and (f'{stem}.shp' in names or
+                                                                            f'{stem}.parquet' in names):
+                continue
+            # a file directly in the state folder is the layer of the state, a file further down is a part of it
+            folder = part.rsplit('/', 1)[0] + '/' if part and '/' in part else ''
+            whole = f'{folder}{stem}.shp' if folder or year in STATE_FOLDER_PARTS.get(layer, ()) else ''
+            logical = os.path.join(root, f'{stem}.shp')
+            if ext == '.zip':
+                with zipfile.ZipFile(path) as archive:
+                    members = [m for m in archive.namelist() if m.lower().endswith('.shp')]
+                if [m.lower() for m in members] != [f'{stem}.shp'.lower()]:
+                    for member in members:
+                        # the members are parts of the folder, without the top folder of the archive
+                        inner = member.split('/', 1)[1] if '/' in member else member
+                        if os.path.exists(os.path.join(root, *inner.split('/'))):
+                            # extracted next to the archive, recorded as the extracted file
+                            continue
+                        found[vsizip_path(path, member)] = (vsizip_path(path, member), 'zip', path, state_dir,
+                                                            folder + inner)
+                    continue
+            # a shapefile, its GeoParquet version and its zip archive are one layer, read from the file read_layer
+            # picks
+            read_path = resolve_layer(logical)
+            source = ('parquet' if read_path.endswith('.parquet') else
+                      'zip' if read_path.startswith('/vsizip/') else 'shp')
+            found[logical] = (read_path, source, source_file(read_path), state_dir, whole)
+    return list(found.values())
+
+
+def _header(path):
+    # crs, feature count, bounds and attribute columns of a layer, from its header only
+    if path.endswith('.parquet'):
+        metadata = pq.read_metadata(path)
+        geo = json.loads(metadata.metadata[b'geo'])
+        column = geo['columns'][geo['primary_column']]
+        crs = column.get('crs', 'OGC:CRS84')
+        columns = [name for name in metadata.schema.names if name not in (geo['primary_column'], 'bbox')]
+        bounds = column.get('bbox') or [None] * 4
+        return (json.dumps(crs) if isinstance(crs, dict) else crs), metadata.num_rows, bounds, columns
+    info = pyogrio.read_info(path)
+    bounds = info.get('total_bounds')
+    return info['crs'], info['features'], list(bounds) if bounds is not None else [None] * 4, list(info['fields'])
+
+
+class Catalog:
+    def __init__(self, shapefiles_dir):
+        """:param shapefiles_dir: the shapefiles folder, base_dir/shapefiles"""
+        self.shapefiles_dir = shapefiles_dir
+        self.path = catalog_path(shapefiles_dir)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+
+    def scan(self, workers=8):
+        """
+        Record every layer under the shapefiles folder, reading the headers and hashes of the new and changed files
+        only, see the module docstring.
+
+        :param workers: number of threads reading the headers
+        :return: the number of layers recorded
+        """
+        known = {row[0]: row[1:] for row in self.connection.execute('SELECT path, size, mtime FROM layers')}
+        hashes = BuildCache(os.path.join(self.shapefiles_dir, 'catalog_hashes.json'))
+        candidates = _candidates(self.shapefiles_dir)
+
+        def record(candidate):
+            read_path, source, file_path, state_dir, part = candidate
+            stat = os.stat(file_path)
+            entry = known.get(read_path)
+            if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+                return None
+            layer, year, _, _ = _location(self.shapefiles_dir, file_path)
+            fips, state = None, None
+            if source == 'store':
+                fips = part
+                part = ''
+            elif state_dir is not None:
+                match = re.match(r'(\d{2})_(.+)$', state_dir)
+                fips, state = (match.group(1), state_key(match.group(2))) if match else (None, state_key(state_dir))
+            crs, features, bounds, columns = _header(read_path)
+            sha256 = hashes.input_hash(read_path)
+            return (read_path, source, layer, year, state, fips, part, crs, features, *bounds, json.dumps(columns),
+                    sha256, stat.st_size, stat.st_mtime_ns, datetime.now().isoformat(timespec='seconds'))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            rows = [row for row in executor.map(record, candidates) if row is not None]
+        hashes.save()
+
+        current = {candidate[0] for candidate in candidates}
+        with self.connection:
+            self.connection.executemany(f"INSERT OR REPLACE INTO layers VALUES ({', '.join('?' * len(COLUMNS))})", rows)
+            self.connection.executemany('DELETE FROM layers WHERE path = ?',
+                                        [(path,) for path in known if path not in current])
+        print(f"[catalog] {len(current)} layers, {len(rows)} new or changed, "
+              f"{len([p for p in known if p not in current])} removed")
+        return len(current)
+
+    def resolve(self, layer, year, state=None, fips=None):
+        """The path of the layer of a state (by fips or state name), None when it is not in the catalog."""
+        row = self.connection.execute(
+            f"SELECT path FROM layers WHERE layer = ? AND year = ? AND part = '' AND (fips = ? OR state = ?) "
+            f"ORDER BY {SOURCE_ORDER} LIMIT 1", (layer, year, fips, state_key(state))).fetchone()
+        return row[0] if row is not None else None
+
+    def layers(self, layer=None, year=None, state=None, fips=None, parts=None):
+        """
+        The records matching the given fields (None matches all) as a DataFrame, e.g. to plan the tasks of a step.
+
+        :param parts: True only returns the parts of states, False only the layers of whole states, None both
+        """
+        conditions, values = [], []
+        for name, value in (('layer', layer), ('year', year), ('fips', fips), ('state', state_key(state))):
+            if value is not None:
+                conditions.append(f'{name} = ?')
+                values.append(value)
+        if parts is not None:
+            conditions.append("part != ''" if parts else "part = ''")
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        table = pd.read_sql_query(f'SELECT * FROM layers {where} ORDER BY path', self.connection, params=values)
+        table['columns'] = table['columns'].map(json.loads)
+        return table
+
+    def close(self):
+        self.connection.close()
+
+
+# the catalogs opened by find_layer, one per shapefiles folder and process (a SQLite connection must not be shared
+# with the worker processes forked after it was opened)
+_open_catalogs = {}
+
+
+def open_catalog(shapefiles_dir):
+    """The catalog of a shapefiles folder, None when it has not been built."""
+    if not os.path.exists(catalog_path(shapefiles_dir)):
+        return None
+    key = (os.path.abspath(shapefiles_dir), os.getpid())
+    if key not in _open_catalogs:
+        _open_catalogs[key] = Catalog(shapefiles_dir)
+    return _open_catalogs[key]
+
+
+def find_layer(shapefiles_dir, layer, year, state=None, fips=None):
+    """
+    The catalogued path of the layer of a state, None when there is no catalog, the layer is not in it or its file is
+    gone (the caller then falls back to the path it constructs).
+    """
+    catalog = open_catalog(shapefiles_dir)
+    path = catalog.resolve(layer, year, state, fips) if catalog is not None else None
+    if path is None or not os.path.exists(source_file(path)):
+        return None
+    return path
+
+
+def find_parts(shapefiles_dir, layer, year, state=None, fips=None):
+    """The catalogued parts of the layer of a state as (path, part) pairs, empty when there is no catalog."""
+    catalog = open_catalog(shapefiles_dir)
+    if catalog is None:
+        return []
+    table = catalog.layers(layer, year, state, fips, parts=True)
+    return [(path, part) for path, part in zip(table['path'], table['part']) if os.path.exists(source_file(path))]
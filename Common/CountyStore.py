@@ -0,0 +1,126 @@
+"""
+This module keeps the national county file of a year (2011 on) as one store partitioned by STATEFP, instead of the 56
+per-state shapefiles CountyProcess.py used to split it into.
+
+build_county_store reads tl_<year>_us_county (shapefile, GeoParquet or the downloaded zip, see Common/GeoStore.py)
+once and writes one GeoParquet file per state, next to the national file:
+- shapefiles
+    - counties
+        - 2018
+            - tl_2018_us_county.zip
+            - county_store
+                - 01.parquet
+                - 02.parquet
+                - ...
+                - index.parquet
+
+The rows of each partition are sorted along a Hilbert curve and written in small row groups with a bbox covering
+column, so a bbox read only decodes the row groups around it. index.parquet is the spatial index of the store: the
+file, feature count and bounds of every STATEFP partition.
+
+The overlay scripts read the partition of their state (county_layer_path), a read of the whole store selects the
+partitions by STATEFP and bbox through the index and reads only those (read_counties). The stores of several years
+are built in parallel (build_county_stores).
+"""
+
+import os
+import shutil
+
+import geopandas as gpd
+import pandas as pd
+
+from Common.GeoStore import read_layer
+from Common.ParallelRunner import run_tasks
+from Common.RunLog import StageLog
+
+STORE_DIR = 'county_store'
+
+# rows per row group of the partitions, a county read with a bbox decodes about this many rows per group it touches
+STORE_ROW_GROUP_SIZE = 256
+
+
+def county_store_dir(counties_dir, year):
+    """:param counties_dir: the counties folder, base_dir/shapefiles/counties"""
+    return os.path.join(counties_dir, str(year), STORE_DIR)
+
+
+def county_partition_path(counties_dir, year, statefp):
+    return os.path.join(county_store_dir(counties_dir, year), f'{statefp}.parquet')
+
+
+def county_layer_path(counties_dir, year, statefp, split_path):
+    """
+    The file the counties of a state are read from: the partition of the county store when the store of the year is
+    built, else split_path (the per-state file, from 2010 and before or an older CountyProcess run).
+    """
+    if os.path.exists(os.path.join(county_store_dir(counties_dir, year), 'index.parquet')):
+        return county_partition_path(counties_dir, year, statefp)
+    return split_path
+
+
+def build_county_store(counties_dir, year):
+    """
+    Write the county store of a year from its national county file, replacing an earlier store.
+
+    :return: the store directory
+    """
+    log = StageLog('county_store', year=year)
+    gdf = read_layer(os.path.join(counties_dir, str(year), f"tl_{year}_us_county.shp"))
+    log.lap('read', gdf)
+
+    store_dir = county_store_dir(counties_dir, year)
+    # write to a temporary directory first so that a reader never sees half a store
+    temp_dir = f'{store_dir}.{os.getpid()}.tmp'
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    index = []
+    for statefp, group in gdf.groupby('STATEFP', sort=True):
+        # neighbouring counties end up in the same row groups
+        group = group.iloc[group.hilbert_distance().argsort()]
+        group.to_parquet(os.path.join(temp_dir, f'{statefp}.parquet'), index=False, write_covering_bbox=True,
+                         row_group_size=STORE_ROW_GROUP_SIZE)
+        minx, miny, maxx, maxy = group.total_bounds
+        index.append({'STATEFP': statefp, 'file': f'{statefp}.parquet', 'features': len(group),
+                      'minx': minx, 'miny': miny, 'maxx': maxx, 'maxy': maxy})
+    pd.DataFrame(index).to_parquet(os.path.join(temp_dir, 'index.parquet'), index=False)
+
+    if os.path.exists(store_dir):
+        shutil.rmtree(store_dir)
+    os.replace(temp_dir, store_dir)
+    log.lap('write', gdf, partitions=len(index))
+    print(f"Built the county store of {year}: {len(gdf)} counties in {len(index)} partitions")
+    return store_dir
+
+
+def build_county_stores(counties_dir, years, workers=1):
+    """Build the county stores of several years, on a pool of worker processes, see run_tasks."""
+    return run_tasks(build_county_store, [(counties_dir, year) for year in years], workers=workers,
+                     label='county store')
+
+
+def read_index(counties_dir, year):
+    return pd.read_parquet(os.path.join(county_store_dir(counties_dir, year), 'index.parquet'))
+
+
+def read_counties(counties_dir, year, statefp=None, bbox=None, columns=None):
+    """
+    Read the counties of a year from its store, only the partitions and row groups that can match are read.
+
+    :param statefp: a STATEFP or a list of them, None selects all states
+    :param bbox: (minx, miny, maxx, maxy) in the CRS of the store, only the counties intersecting it are read
+    :param columns: attribute columns to read, None reads all of them
+    """
+    index = read_index(counties_dir, year)
+    if statefp is not None:
+        index = index[index['STATEFP'].isin([statefp] if isinstance(statefp, str) else list(statefp))]
+    if bbox is not None:
+        minx, miny, maxx, maxy = bbox
+        index = index[(index['minx'] <= maxx) & (index['maxx'] >= minx) &
+                      (index['miny'] <= maxy) & (index['maxy'] >= miny)]
+    store_dir = county_store_dir(counties_dir, year)
+    gdfs = [read_layer(os.path.join(store_dir, file), columns=columns, bbox=bbox) for file in index['file']]
+    if not gdfs:
+        # an empty selection still has the columns and CRS of the store
+        first = read_index(counties_dir, year)['file'].iloc[0]
+        return read_layer(os.path.join(store_dir, first), columns=columns).iloc[:0]
+    return gpd.GeoDataFrame(pd.concat(gdfs, ignore_index=True), crs=gdfs[0].crs)
@@ -0,0 +1,240 @@
+"""
+This module is the download engine shared by the BulkDownload scripts.
+
+The scripts used to fetch 17 years x up to 56 jurisdictions one blocking requests.get at a time, each on a new
+connection. A Downloader instead:
+    - keeps one requests.Session, whose connection pool keeps the connections to each host alive between files
+    - runs the download tasks of a script on a pool of `workers` threads (see Common/ParallelRunner.py), so at most
+      `workers` files are in flight at a time
+    - limits the requests per second sent to each host (rate_limit, shared by all threads), so the HUD and Census
+      servers are not flooded
+    - retries the connection errors and the 429 / 5xx answers with an exponential backoff (urllib3 Retry, which
+      also honours the Retry-After header)
+    - streams each archive to disk in chunks (download), so memory stays flat whatever the size of the archive: the
+      file grows as <path>.part and is renamed when complete. A connection dropped mid-transfer, or an earlier run
+      that was stopped, resumes from the end of the .part file with an HTTP Range request. The ETag (or Last-Modified)
+      of the answer the .part file was started from is kept in <path>.part.json and sent as If-Range, so a server
+      whose archive changed in between answers with the whole new file instead of appending its bytes to the old one
+    - with a manifest, records the URL, ETag, Last-Modified, size and content hash of every archive it downloaded
+      (DownloadManifest). A rerun asks the server for each archive that is still on disk with a conditional request
+      (If-None-Match / If-Modified-Since), and an unchanged archive is answered with an empty 304 and skipped
+
+The base URLs are settings at the bottom of each script, so the scripts can be run against a local HTTP server that
+serves fixture archives (see Benchmark/FixtureServer.py).
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from Common.BuildCache import _sha256
+from Common.ParallelRunner import run_tasks
+
+# the answers that are retried, the others (e.g. 404 for a year without the file) are returned at once
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# size of the chunks written to disk, a dropped connection loses at most the chunk being read
+CHUNK_SIZE = 256 * 1024
+
+
+def _resume_validator(headers):
+    # the If-Range validator of an answer: its strong ETag, else its Last-Modified date, None when it has neither
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('Last-Modified')
+
+
+def _read_validator(validator_path, url):
+    # the validator of the answer a .part file was started from, None when it was not recorded for url
+    if not os.path.exists(validator_path):
+        return None
+    try:
+        with open(validator_path) as file:
+            entry = json.load(file)
+    except ValueError:
+        return None
+    return entry.get('validator') if entry.get('url') == url else None
+
+
+def _remove(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class HostRateLimiter:
+    def __init__(self, rate=None):
+        """
+        :param rate: maximum number of requests per second to one host, None for no limit
+        """
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        """Block until a request to the host of url may be sent."""
+        if not self.interval:
+            return
+        host = urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        time.sleep(slot - now)
+
+
+class DownloadManifest:
+    def __init__(self, path):
+        """
+        Manifest of the downloaded archives, a json file:
+        {"<url>": {"path": "...", "etag": "...", "last_modified": "...", "size": ..., "sha256": "...", "time": "..."}}
+        """
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as file:
+                self.entries = json.load(file)
+        self.lock = threading.Lock()
+
+    def conditional_headers(self, url, path):
+        """The headers of a conditional request for url, empty when the archive is not on disk as recorded."""
+        with self.lock:
+            entry = self.entries.get(url)
+        if (entry is None or entry['path'] != os.path.abspath(path) or not os.path.exists(path)
+                or os.path.getsize(path) != entry['size']):
+            return {}
+        headers = {}
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def record(self, url, path, headers):
+        entry = {'path': os.path.abspath(path), 'etag': headers.get('ETag'),
+                 'last_modified': headers.get('Last-Modified'), 'size': os.path.getsize(path),
+                 'sha256': _sha256(path), 'time': datetime.now().isoformat(timespec='seconds')}
+        with self.lock:
+            self.entries[url] = entry
+
+    def save(self):
+        # write to a temporary file first so that an interrupted run never leaves a broken manifest behind
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self.lock:
+            temp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w') as file:
+                json.dump(self.entries, file, indent=1)
+            os.replace(temp_path, self.path)
+
+
+class Downloader:
+    def __init__(self, workers=8, rate_limit=None, retries=5, backoff=1.0, timeout=(10, 300), manifest=None,
+                 force=False):
+        """
+        :param workers: number of concurrent downloads
+        :param rate_limit: maximum number of requests per second to one host, None for no limit
+        :param retries: number of retries of a failed request
+        :param backoff: the retries wait backoff * 2 ** (retry - 1) seconds
+        :param timeout: (connect, read) timeout of a request in seconds
+        :param manifest: path of the json download manifest, None downloads every archive unconditionally
+        :param force: download every archive again, but still record it in the manifest
+        """
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.limiter = HostRateLimiter(rate_limit)
+        self.manifest = DownloadManifest(manifest) if manifest is not None else None
+        self.force = force
+        # inside run() the manifest is saved once at the end of the batch instead of after every archive
+        self.batch = False
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUSES,
+                      allowed_methods=('GET', 'HEAD'), raise_on_status=False)
+        # one pooled connection per thread and host
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, **kwargs):
+        """requests.get on the pooled session, after the rate limit of the host."""
+        self.limiter.wait(url)
+        return self.session.get(url, timeout=self.timeout, **kwargs)
+
+    def download(self, url, path, chunk_size=CHUNK_SIZE):
+        """
+        Stream url to the file path, resuming an incomplete download of an earlier attempt, see the module docstring.
+
+        :return: 200 when the file was written (also after a resume), 304 when the archive on disk is up to date,
+                 else the HTTP status of the answer
+        """
+        part_path = f'{path}.part'
+        validator_path = f'{part_path}.json'
+        for attempt in range(self.retries + 1):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            validator = _read_validator(validator_path, url) if offset else None
+            if offset and validator is None:
+                # nothing tells whether the .part file is still a prefix of the file on the server, start again
+                _remove(part_path, validator_path)
+                offset = 0
+            headers = {'Range': f'bytes={offset}-', 'If-Range': validator} if offset else {}
+            if not offset and self.manifest is not None and not self.force:
+                headers = self.manifest.conditional_headers(url, path)
+            try:
+                with self.get(url, headers=headers, stream=True) as response:
+                    if response.status_code == 304:
+                        return 304
+                    if response.status_code == 416:
+                        # the .part file does not match the file on the server anymore, start again
+                        _remove(part_path, validator_path)
+                        continue
+                    if response.status_code not in (200, 206):
+                        return response.status_code
+                    start = re.match(r'bytes (\d+)-', response.headers.get('Content-Range', ''))
+                    if response.status_code == 206 and (start is None or int(start.group(1)) != offset):
+                        _remove(part_path, validator_path)
+                        continue
+                    if response.status_code == 200:
+                        # a new .part file: the whole file, also when the archive changed since the .part file was
+                        # started (If-Range) or the server does not support Range
+                        _remove(validator_path)
+                        validator = _resume_validator(response.headers)
+                        if validator is not None:
+                            with open(validator_path, 'w') as file:
+                                json.dump({'url': url, 'validator': validator}, file)
+                    with open(part_path, 'ab' if response.status_code == 206 else 'wb') as file:
+                        for chunk in response.iter_content(chunk_size):
+                            file.write(chunk)
+                os.replace(part_path, path)
+                _remove(validator_path)
+                if self.manifest is not None:
+                    self.manifest.record(url, path, response.headers)
+                    if not self.batch:
+                        self.manifest.save()
+                return 200
+            except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                if attempt == self.retries:
+                    raise
+                wait = self.backoff * 2 ** attempt
+                print(f"Download of {url} interrupted ({e.__class__.__name__}), resuming in {wait:.1f}s")
+                time.sleep(wait)
+        raise IOError(f"Could not download {url}")
+
+    def run(self, func, tasks, label='download'):
+        """Run func(*task) for every task on the thread pool, see run_tasks in Common/ParallelRunner.py."""
+        self.batch = True
+        try:
+            return run_tasks(func, tasks, self.workers, label, threads=True)
+        finally:
+            self.batch = False
+            if self.manifest is not None:
+                self.manifest.save()
@@ -0,0 +1,242 @@
+"""
+This module reads and writes the intermediate layers either as ESRI shapefiles or as GeoParquet files.
+
+The intermediate data (CoC_Merged, the per-state county splits and the merged 2007 subdivisions) used to be
+shapefiles only. Those are slow to parse, cut the field names to 10 characters and come with several sidecar files.
+With the 'parquet' format the Merge and CountyProcess scripts write a single GeoParquet file next to where the
+shapefile would be, with the same name and a .parquet extension, e.g.
+- shapefiles
+    - CoC_Merged
+        - 2007
+            - Alabama
+                - Alabama_2007_CoC_Merged.parquet
+
+The reading scripts keep constructing the shapefile paths; read_layer picks up the GeoParquet file instead when it is
+there and not older than the shapefile, so both formats can be mixed. The GeoParquet files are written with a bbox
+covering column, which lets a read skip the row groups outside a bounding box, and only the requested columns are
+decoded.
+
+When neither is there but the zip archive the shapefile was downloaded in is (same name with a .zip extension, as the
+TIGER archives are named), the layer is read from inside the archive through GDAL's /vsizip/ file system, so the
+downloads never have to be extracted:
+- shapefiles
+    - Census places
+        - 2018
+            - 09_CONNECTICUT
+                - tl_2018_09_place.zip  (read for tl_2018_09_place.shp)
+
+A layer that is put together from many small pieces (the counties of a 2007 county subdivision state) is written
+with LayerWriter, one piece at a time, instead of concatenating all the pieces in memory first.
+"""
+
+import json
+import os
+import re
+import zipfile
+from io import BytesIO
+
+import geopandas as gpd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyogrio
+import shapely
+
+INTERMEDIATE_FORMATS = ('shp', 'parquet')
+
+# rows per row group of the GeoParquet files, smaller groups make the bbox filter finer but the files larger
+ROW_GROUP_SIZE = 2000
+
+
+def parquet_path(shp_path):
+    return os.path.splitext(shp_path)[0] + '.parquet'
+
+
+def archive_path(shp_path):
+    return os.path.splitext(shp_path)[0] + '.zip'
+
+
+def vsizip_path(zip_path, member):
+    """GDAL path of a member of a zip archive."""
+    return f"/vsizip/{os.path.abspath(zip_path).replace(os.sep, '/')}/{member}"
+
+
+def archive_of(path):
+    """The zip archive a /vsizip/ path points into, None for a path of a plain file."""
+    match = re.match(r'/vsizip/(.+?\.zip)(/|$)', path.replace('\\', '/'), re.IGNORECASE)
+    return match.group(1) if match else None
+
+
+def source_file(path):
+    """The file on disk behind a layer path: the archive of a /vsizip/ path, the path itself otherwise."""
+    return archive_of(path) or path
+
+
+def archive_layers(zip_path, extension='.shp'):
+    """The /vsizip/ paths of the shapefiles (members with the given extension) in a zip archive, in archive order."""
+    with zipfile.ZipFile(zip_path) as archive:
+        return [vsizip_path(zip_path, name) for name in archive.namelist() if name.lower().endswith(extension)]
+
+
+def resolve_layer(path):
+    """
+    The file a layer is read from: the GeoParquet version of a shapefile path when it exists and is not older than
+    the shapefile, the shapefile when it exists, else the shapefile inside the zip archive of the same name (a
+    /vsizip/ path), else the path itself.
+    """
+    if os.path.splitext(path)[1].lower() != '.shp':
+        return path
+    parquet = parquet_path(path)
+    if os.path.exists(parquet) and (not os.path.exists(path) or os.path.getmtime(parquet) >= os.path.getmtime(path)):
+        return parquet
+    if not os.path.exists(path) and os.path.exists(archive_path(path)):
+        name = os.path.basename(path).lower()
+        for layer in archive_layers(archive_path(path)):
+            if layer.rsplit('/', 1)[1].lower() == name:
+                return layer
+    return path
+
+
+def read_layer(path, columns=None, bbox=None):
+    """
+    Read a layer from a shapefile or a GeoParquet file, see resolve_layer.
+
+    :param columns: attribute columns to read (the geometry is always read), None reads all of them
+    :param bbox: (minx, miny, maxx, maxy) in the CRS of the file, only the features intersecting it are read
+    """
+    path = resolve_layer(path)
+    if os.path.splitext(path)[1].lower() == '.parquet':
+        if columns is not None:
+            geometry_column = json.loads(pq.read_schema(path).metadata[b'geo'])['primary_column']
+            columns = list(columns) + [geometry_column]
+        return gpd.read_parquet(path, columns=columns, bbox=None if bbox is None else tuple(bbox))
+    return gpd.read_file(path, columns=columns, bbox=None if bbox is None else tuple(bbox))
+
+
+def concat_layers(paths, tag_column=None, tags=None):
+    """
+    Read many small layers with the same attributes (e.g. the CoC or county files of a state) into one GeoDataFrame.
+
+    Each file is read as Arrow record batches, the batches of all files are concatenated column by column once and
+    converted to a GeoDataFrame once, instead of one read_file and DataFrame per file followed by pd.concat. Columns
+    missing in some files are null in their rows.
+
+    :param tag_column: name of a column set to tags[i] for the rows of paths[i], added after the geometry
+    :return: the GeoDataFrame in the CRS of the first file, None when paths is empty
+    """
+    tables, crs = [], None
+    for path in paths:
+        with pyogrio.open_arrow(path, use_pyarrow=True) as (meta, reader):
+            batches = list(reader)
+            schema = reader.schema
+        crs = crs if crs is not None else meta['crs']
+        geometry_name = meta['geometry_name'] or 'wkb_geometry'
+        table = pa.Table.from_batches(batches, schema=schema)
+        # the same geometry column name in every table, without the per-file field metadata (e.g. the CRS)
+        index = table.schema.get_field_index(geometry_name)
+        tables.append(table.set_column(index, pa.field('geometry', pa.binary()), table.column(index).cast(pa.binary())))
+    if not tables:
+        return None
+
+    table = pa.concat_tables(tables, promote_options='permissive')
+    geometry = shapely.from_wkb(table.column('geometry').to_numpy(zero_copy_only=False))
+    gdf = gpd.GeoDataFrame(table.drop_columns(['geometry']).to_pandas(), geometry=geometry, crs=crs)
+    if tag_column is not None:
+        gdf[tag_column] = np.repeat(np.asarray(tags, dtype=object), [t.num_rows for t in tables])
+    return gdf
+
+
+def layer_crs(path):
+    """CRS of a layer without reading its features, None when the file has no CRS."""
+    path = resolve_layer(path)
+    if os.path.splitext(path)[1].lower() == '.parquet':
+        column = json.loads(pq.read_schema(path).metadata[b'geo'])
+        column = column['columns'][column['primary_column']]
+        # a GeoParquet column without a 'crs' key is in OGC:CRS84, a null one has no CRS
+        crs = column.get('crs', 'OGC:CRS84')
+    else:
+        crs = pyogrio.read_info(path)['crs']
+    return gpd.GeoSeries([], crs=crs).crs if crs is not None else None
+
+
+def write_layer(gdf, shp_path, fmt='shp'):
+    """
+    Write an intermediate layer in the given format ('shp' or 'parquet') and return the path written.
+
+    :param shp_path: the shapefile path of the layer, the GeoParquet file gets the same name with a .parquet extension
+    """
+    if fmt not in INTERMEDIATE_FORMATS:
+        raise ValueError(f"Unknown intermediate format: {fmt}, expected one of {INTERMEDIATE_FORMATS}")
+    if fmt == 'shp':
+        gdf.to_file(shp_path)
+        return shp_path
+    path = parquet_path(shp_path)
+    gdf.to_parquet(path, index=False, write_covering_bbox=True, row_group_size=ROW_GROUP_SIZE)
+    return path
+
+
+class LayerWriter:
+    def __init__(self, shp_path, fmt='shp'):
+        """
+        Write an intermediate layer a piece at a time (e.g. the counties of a state as they are fetched), so only the
+        piece being appended is in memory. The pieces go to a temporary file that close() moves to the path of the
+        layer, a reader never sees half a layer.
+
+        :param shp_path: the shapefile path of the layer, see write_layer
+        """
+        if fmt not in INTERMEDIATE_FORMATS:
+            raise ValueError(f"Unknown intermediate format: {fmt}, expected one of {INTERMEDIATE_FORMATS}")
+        self.fmt = fmt
+        self.path = shp_path if fmt == 'shp' else parquet_path(shp_path)
+        stem, extension = os.path.splitext(self.path)
+        self.temp_path = f'{stem}.{os.getpid()}.tmp{extension}'
+        self.features = 0
+        self.pieces = 0
+        # GeoParquet: the writer opened with the schema of the first piece, and the geo metadata of the file
+        self.writer = None
+        self.geo = None
+
+    def append(self, gdf):
+        if self.fmt == 'shp':
+            gdf.to_file(self.temp_path, mode='a' if self.pieces else 'w')
+        else:
+            # the piece as an Arrow table with its bbox covering column and geo metadata
+            buffer = BytesIO()
+            gdf.to_parquet(buffer, index=False, write_covering_bbox=True)
+            table = pq.read_table(buffer)
+            geo = json.loads(table.schema.metadata[b'geo'])
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.temp_path, table.schema, store_schema=False)
+                self.geo = geo
+            else:
+                # the bounds and geometry types of the file cover all the pieces
+                for name, column in self.geo['columns'].items():
+                    piece = geo['columns'][name]
+                    column['geometry_types'] = sorted(set(column['geometry_types']) | set(piece['geometry_types']))
+                    if 'bbox' in column and 'bbox' in piece:
+                        column['bbox'] = [min(column['bbox'][0], piece['bbox'][0]),
+                                          min(column['bbox'][1], piece['bbox'][1]),
+                                          max(column['bbox'][2], piece['bbox'][2]),
+                                          max(column['bbox'][3], piece['bbox'][3])]
+                table = table.cast(self.writer.schema)
+            self.writer.write_table(table, row_group_size=ROW_GROUP_SIZE)
+        self.features += len(gdf)
+        self.pieces += 1
+
+    def close(self):
+        """Move the layer to its path and return it, None when nothing was appended."""
+        if not self.pieces:
+            return None
+        if self.fmt == 'shp':
+            # the shapefile and its sidecar files
+            directory, name = os.path.split(self.temp_path)
+            temp_stem = os.path.splitext(name)[0]
+            stem = os.path.splitext(self.path)[0]
+            for file in os.listdir(directory):
+                if os.path.splitext(file)[0] == temp_stem:
+                    os.replace(os.path.join(directory, file), stem + os.path.splitext(file)[1])
+        else:
+            self.writer.add_key_value_metadata({'geo': json.dumps(self.geo)})
+            self.writer.close()
+            os.replace(self.temp_path, self.path)
+        return self.path
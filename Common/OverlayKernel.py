@@ -0,0 +1,272 @@
+"""
+This module holds the intersection kernels used by the Intersection and AddiInter scripts.
+
+Two kernels are available and can be selected per run with the `method` argument of `intersect`:
+    - 'overlay': geopandas.overlay(df1, df2, how='intersection'), the original behaviour
+    - 'strtree': a pairwise kernel that only does what the CoC x census layer intersection needs. It finds the
+      candidate (df1 row, df2 row) pairs with one bulk STRtree query, intersects only those pairs with the
+      vectorized shapely.intersection and joins the attributes of both rows by position.
+
+Both kernels return the same GeoDataFrame: the attribute columns of df1, then the ones of df2 (duplicated names get
+the '_1' / '_2' suffixes), then the geometry, one row per intersecting pair in (df1 row, df2 row) order, and only
+polygonal pieces are kept.
+
+With containment=True a pre-pass runs before the kernel: a df2 polygon that lies wholly inside one df1 polygon (and
+no other df1 polygon reaches into it) is its own intersection piece, so it is assigned to that polygon directly and
+its share of the area is exactly 1.0. Only the remaining, boundary straddling df2 polygons are sent to the kernel.
+
+With a PieceStore (reuse=True, 'strtree' kernel only) the pieces of pairs computed in an earlier year are looked up
+by geometry fingerprint instead of being intersected again, see Common/PieceStore.py.
+
+With a memory_budget (in MB) the intersection runs tile by tile and its pieces are stitched back per pair, see
+Common/TiledOverlay.py.
+
+With rows=True the result keeps two extra columns, '__row1' and '__row2', the positions of the df1 and df2 rows of
+each piece, so that the values of the input rows (e.g. their areas, see Common/AreaEngine.py) can be looked up
+without a join.
+
+The options of a run are collected in a plain dict (see DEFAULT_OVERLAY_OPTIONS) that is passed along with every
+(year, state) task.
+"""
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+from Common.AreaEngine import AREA_METHODS, DEFAULT_AREA_CRS
+from Common.PieceStore import geometry_fingerprints
+from Common.ResultStore import OUTPUT_MODES
+
+OVERLAY_METHODS = ('overlay', 'strtree')
+
+# the repairs of the input geometries, from the lightest to the heaviest (see Common/Preprocess.py), a task that fails
+# or runs out of time with one is retried with the next ones (see Common/TaskGuard.py)
+REPAIR_STRATEGIES = ('make_valid', 'snap', 'buffer')
+
+DEFAULT_OVERLAY_OPTIONS = {
+    # intersection kernel, one of OVERLAY_METHODS
+    'method': 'overlay',
+    # assign the polygons lying inside a single CoC directly instead of clipping them
+    'containment': False,
+    # reuse the pieces of unchanged (CoC, census polygon) pairs from earlier years, needs the 'strtree' method
+    'reuse': False,
+    # where the results go, one of OUTPUT_MODES: a shp and a csv per task or the partitioned Parquet dataset
+    'output': 'files',
+    # how the areas behind the shares are computed, one of AREA_METHODS (see Common/AreaEngine.py)
+    'area': 'planar',
+    # equal-area CRS of the 'equal_area' area method
+    'area_crs': DEFAULT_AREA_CRS,
+    # grid size the input geometries are snapped to after their repair, in units of the CoC CRS, None only repairs
+    # them (see Common/Preprocess.py)
+    'precision': None,
+    # repair of the input geometries before the overlay, one of REPAIR_STRATEGIES: 'make_valid' only, 'snap' also
+    # snaps them to a grid (the precision, or REPAIR_PRECISION), 'buffer' runs the buffer + simplify path first
+    'repair': 'make_valid',
+    # approximate memory of the intersection in MB, the state is intersected tile by tile to stay below it
+    # (see Common/TiledOverlay.py), None intersects the whole state at once
+    'memory_budget': None,
+}
+
+# shapely geometry type ids of Polygon / MultiPolygon and of GeometryCollection
+_POLYGON_IDS = (3, 6)
+_COLLECTION_ID = 7
+
+
+def polygonal_parts(geoms):
+    # keep only the polygonal part of each geometry (the same as keep_geom_type=True in gpd.overlay),
+    # everything else (touching boundaries give lines or points) becomes None
+    type_ids = shapely.get_type_id(geoms)
+    result = np.where(np.isin(type_ids, _POLYGON_IDS), geoms, None)
+    for i in np.flatnonzero(type_ids == _COLLECTION_ID):
+        parts = shapely.get_parts(geoms[i])
+        parts = parts[np.isin(shapely.get_type_id(parts), _POLYGON_IDS)]
+        if len(parts):
+            result[i] = shapely.union_all(parts)
+    return result
+
+
+def make_valid_polygons(geoms):
+    # repair invalid polygons only, as gpd.overlay does before intersecting
+    invalid = ~shapely.is_valid(geoms)
+    if invalid.any():
+        geoms = geoms.copy()
+        geoms[invalid] = polygonal_parts(shapely.make_valid(geoms[invalid]))
+    return geoms
+
+
+def _attributes(df, index):
+    return df.drop(columns=df.geometry.name).iloc[index].reset_index(drop=True)
+
+
+def joined_pieces(df1, df2, idx1, idx2, geoms):
+    # build the overlay-like result for the given (df1 row, df2 row) pairs and their pieces
+    attrs1 = _attributes(df1, idx1)
+    attrs2 = _attributes(df2, idx2)
+    shared = attrs1.columns.intersection(attrs2.columns)
+    attrs1 = attrs1.rename(columns={c: f'{c}_1' for c in shared})
+    attrs2 = attrs2.rename(columns={c: f'{c}_2' for c in shared})
+    return gpd.GeoDataFrame(pd.concat([attrs1, attrs2], axis=1), geometry=geoms, crs=df1.crs)
+
+
+def pairwise_intersection(df1, df2, make_valid=True, store=None, tree1=None):
+    """
+    Intersect every polygon of df1 with every polygon of df2 it overlaps.
+
+    :param df1: GeoDataFrame, e.g. the CoC layer
+    :param df2: GeoDataFrame in the same CRS, e.g. the county layer
+    :param make_valid: repair invalid input polygons before intersecting
+    :param store: optional PieceStore, the stored pairs are reused and the new ones are added to it
+    :param tree1: optional STRtree of the df1 geometries, to share one index between several df2 layers
+    :return: GeoDataFrame with the same layout as gpd.overlay(df1, df2, how='intersection')
+    """
+    original_left = np.asarray(df1.geometry.array)
+    left, right = original_left, np.asarray(df2.geometry.array)
+    if make_valid:
+        left = make_valid_polygons(left)
+        right = make_valid_polygons(right)
+
+    # one bulk query for all candidate pairs, sorted the same way as gpd.overlay
+    if tree1 is not None and left is original_left:
+        idx2, idx1 = tree1.query(right, predicate='intersects')
+    else:
+        idx1, idx2 = shapely.STRtree(right).query(left, predicate='intersects')
+    order = np.lexsort((idx2, idx1))
+    idx1, idx2 = idx1[order], idx2[order]
+
+    pieces = np.empty(len(idx1), dtype=object)
+    todo = np.ones(len(idx1), dtype=bool)
+    if store is not None:
+        # the fingerprints are taken before the repair, which gives the same result for the same input
+        fingerprints1 = geometry_fingerprints(df1)[idx1]
+        fingerprints2 = geometry_fingerprints(df2)[idx2]
+        stored = store.fetch(np.unique(fingerprints1))
+        found = np.array([pair in stored for pair in zip(fingerprints1, fingerprints2)], dtype=bool)
+        pieces[found] = shapely.from_wkb([stored[pair] for pair in zip(fingerprints1[found], fingerprints2[found])])
+        todo = ~found
+
+    pieces[todo] = polygonal_parts(shapely.intersection(left[idx1[todo]], right[idx2[todo]]))
+    if store is not None:
+        store.add(fingerprints1[todo], fingerprints2[todo], pieces[todo])
+        print(f"Reused {len(todo) - todo.sum()} of {len(todo)} intersection pieces")
+
+    keep = ~(shapely.is_missing(pieces) | shapely.is_empty(pieces))
+
+    return joined_pieces(df1, df2, idx1[keep], idx2[keep], pieces[keep])
+
+
+def contained_pairs(df1, df2, tree1=None):
+    """
+    Find the df2 polygons that lie wholly inside exactly one df1 polygon.
+
+    The STRtree query evaluates the 'contains' predicate against prepared df1 geometries (the preparation stays with
+    the geometry objects, so it is done once when several df2 layers are checked against the same df1). A df2
+    polygon only counts as contained when no other df1 polygon reaches into its interior, so that the pair is its
+    only piece.
+
+    :param tree1: optional STRtree of the df1 geometries
+    :return: (idx1, idx2) positional indices of the contained pairs, sorted by idx2
+    """
+    left = np.asarray(df1.geometry.array)
+    right = np.asarray(df2.geometry.array)
+    shapely.prepare(left)
+    if tree1 is None:
+        tree1 = shapely.STRtree(left)
+
+    # invalid polygons are left to the kernel, which repairs them first
+    valid_left = np.flatnonzero(shapely.is_valid(left))
+    valid_right = shapely.is_valid(right)
+    idx1, idx2 = shapely.STRtree(right).query(left[valid_left], predicate='contains')
+    idx1 = valid_left[idx1]
+    inside = valid_right[idx2]
+    idx1, idx2 = idx1[inside], idx2[inside]
+    if len(idx2) == 0:
+        return idx1, idx2
+
+    # drop the polygons that are covered by more than one df1 polygon or that another df1 polygon reaches into
+    # (this only happens with overlapping CoCs, the neighbours of a contained polygon normally just touch it)
+    unique2, counts = np.unique(idx2, return_counts=True)
+    once = np.isin(idx2, unique2[counts == 1])
+    idx1, idx2 = idx1[once], idx2[once]
+    n_idx2, n_idx1 = tree1.query(right[idx2], predicate='intersects')
+    others = np.flatnonzero(n_idx1 != idx1[n_idx2])
+    # an invalid neighbour cannot be related reliably, count it as reaching in
+    reaching = ~np.isin(n_idx1[others], valid_left)
+    checked = others[~reaching]
+    reaching[~reaching] = shapely.relate_pattern(left[n_idx1[checked]], right[idx2[n_idx2[checked]]], 'T********')
+    shared = np.unique(n_idx2[others[reaching]])
+    keep = ~np.isin(np.arange(len(idx2)), shared)
+
+    order = np.argsort(idx2[keep], kind='stable')
+    return idx1[keep][order], idx2[keep][order]
+
+
+def _kernel(df1, df2, method, store=None, tree1=None):
+    if method == 'overlay':
+        return gpd.overlay(df1, df2, how='intersection')
+    if method == 'strtree':
+        return pairwise_intersection(df1, df2, store=store, tree1=tree1)
+    raise ValueError(f"Unknown overlay method: {method}, expected one of {OVERLAY_METHODS}")
+
+
+def intersect(df1, df2, method='overlay', containment=False, store=None, tree1=None, memory_budget=None, rows=False):
+    """
+    Intersect two polygon layers with the selected kernel, see OVERLAY_METHODS.
+
+    :param containment: run the containment pre-pass and send only the boundary straddling df2 polygons to the kernel
+    :param store: PieceStore of the pieces of earlier years, used by the 'strtree' kernel
+    :param tree1: STRtree of the df1 geometries, built once when df1 is intersected with several layers
+    :param memory_budget: approximate memory of the intersection in MB, see Common/TiledOverlay.py
+    :param rows: keep the '__row1' / '__row2' positions of the input rows of each piece
+    """
+    if store is not None and method != 'strtree':
+        raise ValueError("Reusing intersection pieces needs the 'strtree' method")
+    if rows:
+        # the positions travel through every kernel as ordinary attribute columns
+        df1 = df1.assign(__row1=np.arange(len(df1)))
+        df2 = df2.assign(__row2=np.arange(len(df2)))
+    if memory_budget is not None:
+        # imported here, Common/TiledOverlay.py uses the helpers of this module
+        from Common.TiledOverlay import tiled_intersection
+        return tiled_intersection(df1, df2, memory_budget, containment, store, tree1)
+    if not containment:
+        return _kernel(df1, df2, method, store, tree1)
+
+    idx1, idx2 = contained_pairs(df1, df2, tree1)
+    if len(idx2) == 0:
+        return _kernel(df1, df2, method, store, tree1)
+
+    # the contained polygons are their own pieces
+    direct = joined_pieces(df1, df2, idx1, idx2, np.asarray(df2.geometry.array)[idx2])
+    direct['__row1'], direct['__row2'] = idx1, idx2
+
+    # carry the row positions through the kernel so that the original (df1 row, df2 row) order can be restored
+    straddling = np.setdiff1d(np.arange(len(df2)), idx2)
+    rest = _kernel(df1.assign(__row1=np.arange(len(df1))),
+                   df2.iloc[straddling].assign(__row2=straddling), method, store, tree1)
+
+    columns = [c for c in rest.columns if c not in ('__row1', '__row2', rest.geometry.name)]
+    result = pd.concat([rest, direct[columns + ['__row1', '__row2', direct.geometry.name]]], ignore_index=True)
+    result = result.sort_values(['__row1', '__row2'], kind='stable')
+    if not rows:
+        result = result.drop(columns=['__row1', '__row2'])
+    return gpd.GeoDataFrame(result.reset_index(drop=True), geometry=direct.geometry.name, crs=df1.crs)
+
+
+def overlay_options(options=None):
+    """Fill in the defaults for the options of a run."""
+    unknown = set(options or {}) - set(DEFAULT_OVERLAY_OPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown overlay options: {sorted(unknown)}")
+    options = dict(DEFAULT_OVERLAY_OPTIONS, **(options or {}))
+    if options['reuse'] and options['method'] != 'strtree':
+        raise ValueError("The 'reuse' option needs method='strtree'")
+    if options['output'] not in OUTPUT_MODES:
+        raise ValueError(f"Unknown output mode: {options['output']}, expected one of {OUTPUT_MODES}")
+    if options['area'] not in AREA_METHODS:
+        raise ValueError(f"Unknown area method: {options['area']}, expected one of {AREA_METHODS}")
+    if options['repair'] not in REPAIR_STRATEGIES:
+        raise ValueError(f"Unknown repair: {options['repair']}, expected one of {REPAIR_STRATEGIES}")
+    if options['memory_budget'] is not None and options['memory_budget'] <= 0:
+        raise ValueError(f"The memory budget must be positive, got {options['memory_budget']}")
+    return options
@@ -0,0 +1,83 @@
+"""
+This module runs independent pipeline tasks (e.g. one (year, state, layer) overlay) either serially or on a
+process pool (or a thread pool, for I/O bound tasks like the downloads).
+
+Every task is a tuple of positional arguments for the task function. Failures are isolated per task: an exception
+raised by a task is recorded for that task and the remaining tasks keep running. The wall time of each task
+is measured inside the worker and printed as the task finishes, followed by a summary of the batch.
+
+With workers=1 the tasks run in the calling process in the original order, which is the same as the old serial
+loops. Since each task writes its own output files, the output of a parallel run is identical to the serial one.
+"""
+
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+
+def _timed_call(func, task):
+    # run a single task and measure its wall time, never raising to the caller
+    start = time.perf_counter()
+    try:
+        result = func(*task)
+        status, error = 'ok', None
+    except Exception:
+        result = None
+        status, error = 'failed', traceback.format_exc()
+    return {'task': task, 'status': status, 'seconds': time.perf_counter() - start, 'result': result, 'error': error}
+
+
+def _report(label, record):
+    if record['status'] == 'ok':
+        print(f"[{label}] {record['task']} finished in {record['seconds']:.1f}s")
+    else:
+        print(f"[{label}] {record['task']} failed after {record['seconds']:.1f}s:\n{record['error']}")
+
+
+def summarize(records, label=''):
+    """Print the number of failed tasks and the slowest ones of a finished batch."""
+    failed = [r for r in records if r['status'] != 'ok']
+    total = sum(r['seconds'] for r in records)
+    print(f"[{label}] {len(records) - len(failed)}/{len(records)} tasks succeeded, {total:.1f}s of task time")
+    for record in sorted(records, key=lambda r: r['seconds'], reverse=True)[:5]:
+        print(f"[{label}]     {record['seconds']:8.1f}s  {record['task']}")
+    for record in failed:
+        print(f"[{label}] FAILED {record['task']}")
+
+
+def run_tasks(func, tasks, workers=1, label='', threads=False):
+    """
+    Run func(*task) for every task in tasks.
+
+    :param func: module-level function (it has to be picklable when workers > 1)
+    :param tasks: list of argument tuples
+    :param workers: number of worker processes, 1 runs everything in the current process
+    :param label: prefix for the progress messages
+    :param threads: use a thread pool instead of a process pool, for tasks that mostly wait on the network or disk
+    :return: one record per task, in the order of tasks, with the keys task, status ('ok' or 'failed'),
+             seconds, result and error
+    """
+    tasks = [tuple(task) for task in tasks]
+    records = [None] * len(tasks)
+
+    if workers is None or workers <= 1 or len(tasks) <= 1:
+        for i, task in enumerate(tasks):
+            records[i] = _timed_call(func, task)
+            _report(label, records[i])
+    else:
+        pool = ThreadPoolExecutor if threads else ProcessPoolExecutor
+        with pool(max_workers=workers) as executor:
+            futures = {executor.submit(_timed_call, func, task): i for i, task in enumerate(tasks)}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    records[i] = future.result()
+                except Exception:
+                    # the worker process itself died (e.g. a crash inside GEOS), this breaks the pool and the
+                    # tasks still pending are reported as failed too
+                    records[i] = {'task': tasks[i], 'status': 'failed', 'seconds': 0.0, 'result': None,
+                                  'error': traceback.format_exc()}
+                _report(label, records[i])
+
+    summarize(records, label)
+    return records
@@ -0,0 +1,58 @@
+"""
+This module stores the intersection pieces of (CoC polygon, census polygon) pairs so that later years can reuse them.
+
+CoC boundaries and TIGER geometries change very little from one year to the next. Each polygon gets a fingerprint,
+a hash of its normalized WKB and of its CRS, and the piece computed for a pair of fingerprints is kept in a SQLite
+database (one per layer). The pairwise kernel looks the candidate pairs up first and only intersects the new or
+changed ones, so a rebuild of all years costs roughly one full year plus the changes.
+
+A pair without a polygonal intersection (the polygons only touch) is stored without a piece (NULL), so that it is not
+recomputed either.
+"""
+
+import hashlib
+import os
+import sqlite3
+
+import numpy as np
+import shapely
+
+
+def geometry_fingerprints(gdf):
+    """Fingerprint of every geometry of a GeoDataFrame, equal for equal geometries in the same CRS."""
+    crs = gdf.crs.to_wkt() if gdf.crs is not None else ''
+    wkbs = shapely.to_wkb(shapely.normalize(np.asarray(gdf.geometry.array)))
+    return np.array([hashlib.blake2b(crs.encode() + (wkb or b''), digest_size=16).hexdigest() for wkb in wkbs],
+                    dtype=object)
+
+
+class PieceStore:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # several worker processes may share the database, wait for their writes instead of failing
+        self.connection = sqlite3.connect(path, timeout=600)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS pieces '
+                                '(coc TEXT, census TEXT, wkb BLOB, PRIMARY KEY (coc, census)) WITHOUT ROWID')
+        self.connection.commit()
+
+    def fetch(self, coc_fingerprints):
+        """All stored pieces of the given CoC polygons, as a dict (coc, census) -> WKB (None without a piece)."""
+        pieces = {}
+        coc_fingerprints = list(coc_fingerprints)
+        # stay below the SQLite limit of host parameters
+        for start in range(0, len(coc_fingerprints), 500):
+            batch = coc_fingerprints[start:start + 500]
+            rows = self.connection.execute(f"SELECT coc, census, wkb FROM pieces WHERE coc IN "
+                                           f"({','.join('?' * len(batch))})", batch)
+            pieces.update(((coc, census), wkb) for coc, census, wkb in rows)
+        return pieces
+
+    def add(self, coc_fingerprints, census_fingerprints, geoms):
+        wkbs = shapely.to_wkb(geoms)
+        with self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO pieces VALUES (?, ?, ?)',
+                                        zip(coc_fingerprints, census_fingerprints, wkbs))
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,114 @@
+"""
+This module repairs the input geometries and snaps them to a precision grid before the overlay, once per input file.
+
+CoC@Counties used to run .buffer(0.0001).simplify(0.0001) on both layers of every state in every run, while the other
+scripts did nothing. preprocess_layer replaces it, for every overlay path:
+    - invalid polygons are repaired with make_valid (only the polygonal parts are kept)
+    - with a precision (the 'precision' run option, in units of the CRS of the CoC file) the coordinates are snapped
+      to a grid of that size, which removes the slivers and the near-duplicate vertices, and the result stays valid
+
+The 'repair' run option makes the repair heavier (see REPAIR_STRATEGIES in Common/OverlayKernel.py): 'snap' always
+snaps the coordinates (to REPAIR_PRECISION when no precision is set), 'buffer' first runs the old buffer + simplify
+path. They are the fallbacks of a task that failed or ran out of time with the lighter ones (see Common/TaskGuard.py).
+
+The preprocessed geometry of a file is cached as a Parquet file keyed by the content hash of the file, the target
+CRS and the parameters, so it is only computed again when one of them changes. Each call reports the vertex
+reduction, and a cache hit the time it saved:
+- Intersection
+    - Output
+        - preprocessed
+            - hashes
+                - <path key>.json   (content hash of one input file, see Common/BuildCache.py)
+            - <key>.parquet     (WKB geometry of one preprocessed file, the statistics in its metadata)
+"""
+
+import os
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+
+from Common.BuildCache import BuildCache, params_hash
+from Common.OverlayKernel import REPAIR_STRATEGIES, make_valid_polygons
+
+# bump to invalidate the cached results after a change of the preprocessing steps
+PREPROCESS_VERSION = 1
+
+# grid size of the 'snap' and 'buffer' repairs when no precision is set, in units of the CRS (about 10 cm in degrees)
+REPAIR_PRECISION = 1e-6
+
+# buffer distance and simplify tolerance of the 'buffer' repair, the .buffer(0.0001).simplify(0.0001) of the old
+# CoC@Counties
+REPAIR_BUFFER = 0.0001
+
+
+def preprocess_dir(base_dir):
+    return os.path.join(base_dir, 'Intersection', 'Output', 'preprocessed')
+
+
+def preprocess_geometries(geoms, precision=None, repair='make_valid'):
+    """
+    Repair the polygons and snap them to a grid of the given size (None only repairs them).
+
+    :param repair: one of REPAIR_STRATEGIES, see the module docstring
+    """
+    if repair not in REPAIR_STRATEGIES:
+        raise ValueError(f"Unknown repair: {repair}, expected one of {REPAIR_STRATEGIES}")
+    geoms = make_valid_polygons(geoms)
+    if repair == 'buffer':
+        geoms = make_valid_polygons(shapely.simplify(shapely.buffer(geoms, REPAIR_BUFFER), REPAIR_BUFFER))
+    if repair != 'make_valid':
+        precision = precision or REPAIR_PRECISION
+    if precision:
+        geoms = shapely.set_precision(geoms, precision, mode='valid_output')
+    return geoms
+
+
+def preprocess_layer(gdf, source_path, precision=None, cache_dir=None, extra=None, repair='make_valid'):
+    """
+    Preprocessed copy of a layer read from source_path (and possibly reprojected), see preprocess_geometries.
+
+    :param cache_dir: directory of the cache, None computes the result without caching it
+    :param extra: other json serializable parameters the geometry depends on (e.g. the bbox the layer was read with)
+    :param repair: one of REPAIR_STRATEGIES, see the module docstring
+    :return: the GeoDataFrame with the preprocessed geometry
+    """
+    geoms = np.asarray(gdf.geometry.array)
+    name = os.path.basename(source_path)
+    path = None
+    if cache_dir is not None:
+        # one hash file per input file, so the workers preprocessing different files never overwrite each other's
+        hashes = BuildCache(os.path.join(cache_dir, 'hashes', f'{params_hash(os.path.abspath(source_path))}.json'))
+        params = {'input': hashes.input_hash(source_path), 'crs': gdf.crs.to_wkt() if gdf.crs is not None else None,
+                  'precision': precision, 'repair': repair, 'extra': extra, 'version': PREPROCESS_VERSION}
+        hashes.save()
+        path = os.path.join(cache_dir, f'{params_hash(params)}.parquet')
+
+    if path is not None and os.path.exists(path):
+        table = pq.read_table(path)
+        # a cache of a different number of rows cannot belong to this layer, recompute it
+        if table.num_rows == len(gdf):
+            stats = {k.decode(): float(v) for k, v in table.schema.metadata.items()}
+            print(f"[preprocess] {name}: reused, {int(stats['vertices_before'])} -> {int(stats['vertices_after'])} "
+                  f"vertices, saved {stats['seconds']:.1f}s")
+            return gdf.set_geometry(shapely.from_wkb(table.column('wkb').to_numpy(zero_copy_only=False)),
+                                    crs=gdf.crs)
+
+    start = time.perf_counter()
+    result = preprocess_geometries(geoms, precision, repair)
+    seconds = time.perf_counter() - start
+    before, after = int(shapely.get_num_coordinates(geoms).sum()), int(shapely.get_num_coordinates(result).sum())
+    print(f"[preprocess] {name}: {before} -> {after} vertices "
+          f"({100 * (before - after) / max(before, 1):.1f}% fewer) in {seconds:.1f}s")
+
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        metadata = {'vertices_before': str(before), 'vertices_after': str(after), 'seconds': str(seconds)}
+        table = pa.table({'wkb': shapely.to_wkb(result)}).replace_schema_metadata(metadata)
+        # write to a temporary file first, other worker processes may read the same key
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        pq.write_table(table, temp_path)
+        os.replace(temp_path, path)
+    return gdf.set_geometry(result, crs=gdf.crs)
@@ -0,0 +1,128 @@
+"""
+This module keeps the overlay results in one Hive-partitioned Parquet dataset instead of a shp and a csv per task.
+
+With output='dataset' the Intersection scripts (and NationwideIntersect.py) write the result of a (year, layer, state)
+to one partition of the dataset, replacing an earlier result of the same partition:
+- Intersection
+    - Output
+        - dataset
+            - year=2007
+                - layer=Counties
+                    - state=Alabama
+                        - part-0.parquet
+                    - state=New%20York
+                    - ...
+                - layer=Places
+                - layer=Subdivisions
+            - year=2008
+            - ...
+
+The CoC files do not all use the same CRS, so the geometry is stored in RESULT_CRS (NAD83, the CRS of TIGER). The
+share columns are computed before and are not affected. read_results reads any selection of partitions in a single
+scan (the attribute columns of the years are unified, the year, layer and state become columns) and export_results
+writes the per-state shp and csv files of the old layout on demand.
+
+The functions take the Output folder the dataset is in as output_dir, Intersection/Output of base_dir by default
+(NationwideIntersect.py keeps its results apart in Intersection/Output/Nationwide).
+"""
+
+import os
+from urllib.parse import quote
+
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# 'files': a shp and a csv per (year, state, layer), 'dataset': the partitioned Parquet dataset
+OUTPUT_MODES = ('files', 'dataset')
+
+RESULT_CRS = 'EPSG:4269'
+
+PARTITIONING = ds.partitioning(pa.schema([('year', pa.int16()), ('layer', pa.string()), ('state', pa.string())]),
+                               flavor='hive')
+
+
+def output_root(base_dir, output_dir=None):
+    return output_dir if output_dir is not None else os.path.join(base_dir, 'Intersection', 'Output')
+
+
+def dataset_root(base_dir, output_dir=None):
+    return os.path.join(output_root(base_dir, output_dir), 'dataset')
+
+
+def partition_path(base_dir, year, layer, state, output_dir=None):
+    # the partition values are URI encoded, as pyarrow expects them (state names contain spaces)
+    return os.path.join(dataset_root(base_dir, output_dir), f'year={year}', f'layer={quote(layer)}',
+                        f'state={quote(state)}', 'part-0.parquet')
+
+
+def write_partition(gdf, base_dir, year, layer, state, output_dir=None):
+    """Write the result of a (year, layer, state), replacing the partition, and return the path written."""
+    path = partition_path(base_dir, year, layer, state, output_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if gdf.crs is not None and gdf.crs != RESULT_CRS:
+        gdf = gdf.to_crs(RESULT_CRS)
+    # write to a temporary file first so that a reader never sees half a partition
+    # (pyarrow skips the files starting with a '.' when it lists the dataset)
+    temp_path = os.path.join(os.path.dirname(path), '.part-0.parquet.tmp')
+    gdf.to_parquet(temp_path, index=False)
+    os.replace(temp_path, path)
+    return path
+
+
+def read_results(base_dir, years=None, layers=None, states=None, columns=None, output_dir=None):
+    """
+    Read the partitions of the given years, layers and states (None selects all of them) into one GeoDataFrame.
+
+    :param columns: attribute columns to read, None reads all of them. The geometry and the year, layer and state
+                    columns are always read. A column missing in some years is null in their rows.
+    """
+    selection = None
+    for name, values in (('year', years), ('layer', layers), ('state', states)):
+        if values is not None:
+            condition = ds.field(name).isin(list(values))
+            selection = condition if selection is None else selection & condition
+
+    root = dataset_root(base_dir, output_dir)
+    fragments = list(ds.dataset(root, format='parquet', partitioning=PARTITIONING).get_fragments(filter=selection))
+    if not fragments:
+        return gpd.GeoDataFrame(columns=['year', 'layer', 'state', 'geometry'], geometry='geometry', crs=RESULT_CRS)
+
+    # the attribute columns differ between the years (e.g. COUNTYFP10 in 2010), unify them over the selected files
+    schema = pa.unify_schemas([pq.read_schema(f.path) for f in fragments] + [PARTITIONING.schema],
+                              promote_options='permissive')
+    dataset = ds.dataset([f.path for f in fragments], schema=schema.remove_metadata(), format='parquet',
+                         partitioning=PARTITIONING, partition_base_dir=root)
+    if columns is not None:
+        columns = ['year', 'layer', 'state'] + [c for c in columns if c not in ('year', 'layer', 'state')] \
+                  + ['geometry']
+    df = dataset.to_table(columns=columns).to_pandas()
+    df['geometry'] = gpd.GeoSeries.from_wkb(df['geometry'], crs=RESULT_CRS)
+    return gpd.GeoDataFrame(df, geometry='geometry', crs=RESULT_CRS)
+
+
+def export_results(base_dir, states_fips, years=None, layers=None, formats=('shp', 'csv'), output_dir=None):
+    """
+    Write the per-state files of the old output layout from the dataset, e.g.
+    Intersection/Output/2007/CoC@Counties/csv/CoC_Counties_01_Alabama_07.csv
+
+    :param states_fips: dict state -> FIPS code of the states to export
+    :return: the paths written
+    """
+    results = read_results(base_dir, years, layers, list(states_fips), output_dir=output_dir)
+    written = []
+    for (year, layer, state), gdf in results.groupby(['year', 'layer', 'state']):
+        # keep the columns of the partition itself, in their order
+        gdf = gdf[pq.read_schema(partition_path(base_dir, year, layer, state, output_dir)).names]
+        output_name = f"CoC_{layer}_{states_fips[state]}_{state}_{str(year)[2:]}"
+        layer_dir = os.path.join(output_root(base_dir, output_dir), str(year), f'CoC@{layer}')
+        if 'shp' in formats:
+            os.makedirs(os.path.join(layer_dir, 'shp'), exist_ok=True)
+            gdf.to_file(os.path.join(layer_dir, 'shp', f"{output_name}.shp"))
+            written.append(os.path.join(layer_dir, 'shp', f"{output_name}.shp"))
+        if 'csv' in formats:
+            os.makedirs(os.path.join(layer_dir, 'csv'), exist_ok=True)
+            gdf.drop(columns='geometry').to_csv(os.path.join(layer_dir, 'csv', f"{output_name}.csv"), index=False)
+            written.append(os.path.join(layer_dir, 'csv', f"{output_name}.csv"))
+    return written
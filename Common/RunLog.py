@@ -0,0 +1,130 @@
+"""
+This module writes the structured run log: one JSON line per task and stage of every pipeline step.
+
+A step creates a StageLog for each task (e.g. a (year, state) of an overlay) and calls lap() at the end of each stage
+(read, reproject, preprocess, overlay, area, write, or download / extract for the downloads). A lap records the time
+since the previous one:
+    {"time": "...", "step": "overlay_coc_counties", "task": {"year": 2018, "state": "Alabama"}, "stage": "read",
+     "wall": 1.23, "cpu": 1.10, "peak_rss_mb": 812.4, "features": 1520, "vertices": 803211, "pid": 1234}
+
+peak_rss_mb is the peak memory of the process so far (the worker processes run many tasks, so it only grows), the
+feature and vertex counts are those of the layers passed to lap().
+
+All processes append to the same file, RUN_LOG_PATH or the path in the COC_RUN_LOG environment variable (the worker
+processes inherit it). summarize_run_log ranks the slowest steps, stages, states and years of a log.
+"""
+
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import shapely
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+RUN_LOG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'logs', 'run_log.jsonl')
+
+
+def run_log_path():
+    return os.environ.get('COC_RUN_LOG', RUN_LOG_PATH)
+
+
+def peak_rss_mb():
+    """Peak resident memory of the current process in MB, None when it cannot be measured."""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 1024 ** 2
+    except (ImportError, AttributeError):
+        return None
+
+
+def layer_counts(*gdfs):
+    """Total feature and vertex count of the given GeoDataFrames (None entries are skipped)."""
+    gdfs = [gdf for gdf in gdfs if gdf is not None]
+    features = sum(len(gdf) for gdf in gdfs)
+    vertices = sum(int(shapely.get_num_coordinates(np.asarray(gdf.geometry.array)).sum()) for gdf in gdfs)
+    return features, vertices
+
+
+class StageLog:
+    def __init__(self, step, **task):
+        """
+        :param step: name of the pipeline step, e.g. the function name
+        :param task: the json serializable fields that identify the task, e.g. year=2018, state='Alabama'
+        """
+        self.step = step
+        self.task = task
+        self.path = run_log_path()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+
+    def lap(self, stage, *gdfs, **fields):
+        """Record the stage that ends now, with the counts of the given layers and any extra fields (e.g. bytes)."""
+        wall, cpu = time.perf_counter(), time.process_time()
+        record = {'time': datetime.now().isoformat(timespec='seconds'), 'step': self.step, 'task': self.task,
+                  'stage': stage, 'wall': round(wall - self._wall, 4), 'cpu': round(cpu - self._cpu, 4),
+                  'peak_rss_mb': peak_rss_mb()}
+        if gdfs:
+            record['features'], record['vertices'] = layer_counts(*gdfs)
+        record.update(fields)
+        record['pid'] = os.getpid()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # one short write per line in append mode, so the lines of several processes do not interleave
+        with open(self.path, 'a') as file:
+            file.write(json.dumps(record, default=str) + '\n')
+        # the time spent writing the log is not counted in the next stage
+        self._wall, self._cpu = time.perf_counter(), time.process_time()
+        return record
+
+
+def read_run_log(path=None):
+    """The run log as a DataFrame, with the task fields (year, state, layer, ...) as columns."""
+    with open(path or run_log_path()) as file:
+        records = [json.loads(line) for line in file if line.strip()]
+    log = pd.DataFrame(records)
+    if log.empty:
+        return log
+    return pd.concat([log.drop(columns='task'), pd.json_normalize(log['task'].tolist())], axis=1)
+
+
+def summarize_run_log(path=None, top=10, since=None):
+    """
+    Print the time spent per step and stage and rank the slowest (step, year, state) tasks, states and years.
+
+    :param since: only use the records written at or after this ISO time, e.g. '2024-02-01T09:00'
+    :return: dict name -> DataFrame of the tables printed
+    """
+    log = read_run_log(path)
+    if since is not None and not log.empty:
+        log = log[log['time'] >= since]
+    if log.empty:
+        print("The run log is empty")
+        return {}
+
+    tables = {
+        'steps': log.groupby(['step', 'stage'])[['wall', 'cpu']].sum().sort_values('wall', ascending=False),
+        'peak_memory': log.groupby('step')['peak_rss_mb'].max().sort_values(ascending=False).to_frame(),
+    }
+    keys = [k for k in ('year', 'state') if k in log.columns]
+    if keys:
+        tasks = log.groupby(['step'] + keys, dropna=False).agg(
+            wall=('wall', 'sum'), cpu=('cpu', 'sum'), peak_rss_mb=('peak_rss_mb', 'max'))
+        tables['slowest_tasks'] = tasks.sort_values('wall', ascending=False).head(top)
+        for key in keys:
+            tables[f'slowest_{key}s'] = log.groupby(key)['wall'].sum().sort_values(ascending=False).head(top).to_frame()
+
+    with pd.option_context('display.width', 200, 'display.max_columns', 20):
+        for name, table in tables.items():
+            print(f"\n[run log] {name}\n{table.round(2)}")
+    return tables
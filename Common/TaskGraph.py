@@ -0,0 +1,183 @@
+"""
+This module runs a graph of dependent pipeline tasks, e.g. the download, merge, split and overlay tasks of every
+(stage, year, state, layer) (see Pipeline/RunPipeline.py).
+
+Every task has a name (a tuple), a function with its positional arguments and the names of the tasks whose outputs it
+reads. A task is started as soon as all of them have finished, whatever their stage, so the overlays of a state run
+while the archives of the next states are still downloading. The tasks waiting on the network run on a thread pool
+(threads=True), the others on a pool of worker processes; failures are isolated per task as in run_tasks (see
+Common/ParallelRunner.py), and the tasks that depend on a failed task are not run ('blocked').
+
+With a journal, every finished task is recorded in a json file as soon as it finishes. A run that was interrupted (or
+had failures) is resumed by running the same graph again: the tasks recorded in the journal are not run again, only
+the ones that did not finish. resume=False clears the journal and runs every task.
+"""
+
+import json
+import os
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import datetime
+
+from Common.ParallelRunner import _report, _timed_call, summarize
+
+
+def task_key(name):
+    # the key of a task in the journal, e.g. ('overlay', 2018, 'Connecticut', 'counties') -> overlay/2018/...
+    return '/'.join(str(part) for part in name)
+
+
+class TaskJournal:
+    def __init__(self, path=None):
+        """
+        The finished tasks of a graph, a json file: {"<task key>": {"seconds": ..., "time": "..."}}
+
+        :param path: path of the json file, None keeps the journal in memory only (nothing is resumed)
+        """
+        self.path = path
+        self.finished = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as file:
+                self.finished = json.load(file)
+
+    def is_finished(self, name):
+        return task_key(name) in self.finished
+
+    def record(self, name, seconds):
+        self.finished[task_key(name)] = {'seconds': round(seconds, 3),
+                                         'time': datetime.now().isoformat(timespec='seconds')}
+        self.save()
+
+    def clear(self):
+        self.finished = {}
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        # write to a temporary file first so that an interrupted run never leaves a broken journal behind
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(self.finished, file, indent=1)
+        os.replace(temp_path, self.path)
+
+
+class TaskGraph:
+    def __init__(self):
+        # name -> (func, args, deps, threads), in the order the tasks were added
+        self.tasks = {}
+
+    def __contains__(self, name):
+        return name in self.tasks
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def add(self, name, func, args=(), deps=(), threads=False):
+        """
+        Add the task func(*args).
+
+        :param name: tuple naming the task, e.g. (stage, year, state, layer)
+        :param func: module-level function (it has to be picklable unless threads is True)
+        :param deps: names of the tasks that have to finish first, they have to be added before
+        :param threads: run the task on the thread pool, for tasks that mostly wait on the network
+        :return: name
+        """
+        if name in self.tasks:
+            raise ValueError(f"Task {name} is added twice")
+        for dep in deps:
+            if dep not in self.tasks:
+                raise KeyError(f"Unknown dependency {dep} of task {name}")
+        self.tasks[name] = (func, tuple(args), tuple(deps), threads)
+        return name
+
+    def dependents(self):
+        """dict name -> names of the tasks that depend on it."""
+        dependents = {name: [] for name in self.tasks}
+        for name, (_, _, deps, _) in self.tasks.items():
+            for dep in deps:
+                dependents[dep].append(name)
+        return dependents
+
+    def run(self, workers=1, threads=8, journal=None, resume=True, label='pipeline'):
+        """
+        Run every task once its dependencies have finished, see the module docstring.
+
+        :param workers: number of worker processes, 1 runs the tasks that are not threaded one at a time in the
+                        current process (still next to the threaded tasks)
+        :param threads: number of threads for the threaded tasks
+        :param journal: path of the json journal of the finished tasks, None does not record them
+        :param resume: skip the tasks recorded in the journal, False clears it first
+        :param label: prefix for the progress messages
+        :return: one record per task, in the order the tasks were added, with the keys task (the name), status
+                 ('ok', 'failed', 'blocked' or 'done' when it finished in an earlier run), seconds, result and error
+        """
+        journal = TaskJournal(journal)
+        if not resume:
+            journal.clear()
+        dependents = self.dependents()
+        records = {}
+        for name in self.tasks:
+            if journal.is_finished(name):
+                records[name] = {'task': name, 'status': 'done', 'seconds': 0.0, 'result': None, 'error': None}
+        waiting = {name: {dep for dep in deps if dep not in records}
+                   for name, (_, _, deps, _) in self.tasks.items() if name not in records}
+        print(f"[{label}] {len(records)}/{len(self.tasks)} tasks finished in an earlier run, {len(waiting)} to run")
+
+        def block(name):
+            # the tasks downstream of a failed task cannot run
+            for dependent in dependents[name]:
+                if dependent in waiting:
+                    del waiting[dependent]
+                    records[dependent] = {'task': dependent, 'status': 'blocked', 'seconds': 0.0, 'result': None,
+                                          'error': f'{name} failed'}
+                    block(dependent)
+
+        local = workers is None or workers <= 1
+        process_pool = ThreadPoolExecutor(max_workers=1) if local else ProcessPoolExecutor(max_workers=workers)
+        thread_pool = ThreadPoolExecutor(max_workers=threads)
+        if not local and any(not task[3] for name, task in self.tasks.items() if name in waiting):
+            # start the worker processes before any thread is running, forking a process with running threads is
+            # not safe
+            process_pool.submit(int).result()
+        running = {}
+        try:
+            ready = [name for name, deps in waiting.items() if not deps]
+            while ready or running:
+                for name in ready:
+                    del waiting[name]
+                    func, args, _, threaded = self.tasks[name]
+                    pool = thread_pool if threaded else process_pool
+                    running[pool.submit(_timed_call, func, args)] = name
+                ready = []
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        record = future.result()
+                    except Exception:
+                        # the worker process itself died, see run_tasks
+                        record = {'status': 'failed', 'seconds': 0.0, 'result': None, 'error': traceback.format_exc()}
+                    record['task'] = name
+                    records[name] = record
+                    _report(label, record)
+                    if record['status'] != 'ok':
+                        block(name)
+                        continue
+                    journal.record(name, record['seconds'])
+                    for dependent in dependents[name]:
+                        if dependent in waiting:
+                            waiting[dependent].discard(name)
+                            if not waiting[dependent]:
+                                ready.append(dependent)
+        finally:
+            # an interrupted run does not wait for the queued tasks, the journal has the finished ones
+            thread_pool.shutdown(cancel_futures=True)
+            process_pool.shutdown(cancel_futures=True)
+
+        summarize([r for r in records.values() if r['status'] in ('ok', 'failed')], label)
+        blocked = [r for r in records.values() if r['status'] == 'blocked']
+        for record in blocked:
+            print(f"[{label}] BLOCKED {record['task']} ({record['error']})")
+        return [records[name] for name in self.tasks]
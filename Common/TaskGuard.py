@@ -0,0 +1,140 @@
+"""
+This module runs an overlay task under a wall-clock and memory limit, and retries it with a heavier repair of the
+input geometries when it fails or runs out of time, so one pathological state (e.g. a self-intersecting CoC polygon
+that makes the overlay hang or throw) cannot stall or break the batch.
+
+run_limited runs a task in a child process of its own: the process is killed after `timeout` seconds, and its
+address space is limited to `memory_limit` MB (resource.RLIMIT_AS, not available on Windows), so a task growing past
+it fails with a MemoryError instead of swapping the machine. Without a limit the task runs in the calling process.
+
+run_with_fallback tries the repairs of REPAIR_STRATEGIES (see Common/OverlayKernel.py and Common/Preprocess.py) from
+the one set in the run options to the heaviest:
+    make_valid -> snap (make_valid + precision snapping) -> buffer (the buffer + simplify path, then snapping)
+and returns the result of the first attempt that succeeds. The outcome of every attempt and the repair the task
+finally succeeded with are recorded in the run log (step 'task_guard', see Common/RunLog.py):
+    {"step": "task_guard", "task": {"year": 2018, "state": "Alabama", "func": "overlay_coc_counties_state"},
+     "stage": "attempt", "repair": "make_valid", "outcome": "timeout", "error": "...", ...}
+    {..., "stage": "result", "repair": "snap", "outcome": "ok", "attempts": 2}
+"""
+
+import multiprocessing
+import traceback
+
+from pyogrio.errors import DataSourceError
+
+from Common.OverlayKernel import REPAIR_STRATEGIES, overlay_options
+from Common.RunLog import StageLog
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class TaskTimeout(Exception):
+    pass
+
+
+class TaskFailed(Exception):
+    pass
+
+
+class TaskInputError(TaskFailed):
+    pass
+
+
+# the errors a heavier repair cannot help with (a missing or unreadable input file), the task is not retried
+INPUT_ERRORS = (FileNotFoundError, DataSourceError, TaskInputError)
+
+
+def is_input_error(error):
+    return isinstance(error, INPUT_ERRORS)
+
+
+def _limited_call(connection, func, args, memory_limit):
+    # the child process: limit its memory, run the task and send back its result or its traceback
+    if memory_limit is not None and resource is not None:
+        limit = int(memory_limit * 1024 ** 2)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    try:
+        connection.send(('ok', func(*args)))
+    except BaseException as e:
+        connection.send(('input' if is_input_error(e) else 'failed', traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+def run_limited(func, args, timeout=None, memory_limit=None):
+    """
+    Run func(*args) in a child process under the given limits, see the module docstring.
+
+    :param timeout: wall-clock limit in seconds, None for no limit
+    :param memory_limit: address space limit of the child process in MB, None for no limit
+    :return: the result of func, raises TaskTimeout when it ran out of time, TaskInputError when it could not read
+             its inputs and TaskFailed when it raised otherwise or died
+    """
+    if timeout is None and memory_limit is None:
+        return func(*args)
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_limited_call, args=(sender, func, args, memory_limit))
+    process.start()
+    sender.close()
+    try:
+        if not receiver.poll(timeout):
+            process.kill()
+            raise TaskTimeout(f"no result after {timeout}s")
+        try:
+            status, value = receiver.recv()
+        except EOFError:
+            # the process died without an answer (e.g. killed by the system or a crash inside GEOS)
+            process.join()
+            raise TaskFailed(f"the task process exited with code {process.exitcode}")
+    finally:
+        receiver.close()
+        process.join()
+    if status == 'input':
+        raise TaskInputError(value)
+    if status != 'ok':
+        raise TaskFailed(value)
+    return value
+
+
+def run_with_fallback(func, args, options=None, timeout=None, memory_limit=None, **task):
+    """
+    Run func(*args, options) under the limits, retrying with the heavier repairs when it fails or times out.
+
+    :param options: overlay options, passed to func as its last argument with the 'repair' of the attempt
+    :param task: fields naming the task in the run log and the messages (e.g. year, state)
+    :return: the result of the first attempt that succeeded, the error of the last attempt is raised when none did
+             (an input error, see INPUT_ERRORS, is raised at once)
+    """
+    options = overlay_options(options)
+    strategies = REPAIR_STRATEGIES[REPAIR_STRATEGIES.index(options['repair']):]
+    log = StageLog('task_guard', func=func.__name__, **task)
+    for attempt, repair in enumerate(strategies, 1):
+        try:
+            result = run_limited(func, tuple(args) + (dict(options, repair=repair),), timeout, memory_limit)
+        except Exception as e:
+            outcome = 'timeout' if isinstance(e, TaskTimeout) else 'failed'
+            log.lap('attempt', repair=repair, outcome=outcome, error=str(e)[-2000:])
+            if attempt == len(strategies) or is_input_error(e):
+                log.lap('result', repair=repair, outcome=outcome, attempts=attempt)
+                raise
+            print(f"[task_guard] {func.__name__} {task}: {outcome} with the {repair} repair, retrying with "
+                  f"{strategies[attempt]}")
+            continue
+        log.lap('attempt', repair=repair, outcome='ok')
+        log.lap('result', repair=repair, outcome='ok', attempts=attempt)
+        if attempt > 1:
+            print(f"[task_guard] {func.__name__} {task}: succeeded with the {repair} repair")
+        return result
+
+
+def overlay_state_guarded(func, year, state, fips, base_dir, options=None, timeout=None, memory_limit=None):
+    """
+    The state function of an Intersection script, func(year, state, fips, base_dir, options), run by
+    run_with_fallback. Bind func and the limits with functools.partial to get a task function with the signature of
+    the state function (see run_cached in Common/BuildCache.py).
+    """
+    return run_with_fallback(func, (year, state, fips, base_dir), options, timeout, memory_limit, year=year,
+                             state=state)
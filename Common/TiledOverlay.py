@@ -0,0 +1,161 @@
+"""
+This module holds the tiled overlay, a memory-bounded variant of the intersection kernels for very large states.
+
+gpd.overlay and the pairwise kernel intersect all the polygons of a state at once, so their working memory grows with
+the state (Texas places, the Alaska coastline, ...). With the 'memory_budget' run option (in MB) intersect() runs
+tiled_intersection instead:
+    - the containment pre-pass (containment=True) and the PieceStore lookup (reuse=True) run on the whole layers,
+      they do not create new geometries
+    - the extent of the remaining candidate (df1 row, df2 row) pairs is split into a grid of tiles, so that the
+      vertices of the polygons of a tile fit in the budget (estimated with BYTES_PER_VERTEX)
+    - tile by tile, both polygons of each pair are clipped to the tile and intersected, and the pieces are streamed
+      to a temporary Parquet file instead of being kept in memory
+    - the pieces of a pair from different tiles are stitched back together with a union, so the shares are computed
+      on the whole piece of each (CoC, census polygon) pair, as without tiles
+
+The result has the layout of the other kernels (see Common/OverlayKernel.py). The tiles always use the pairwise
+intersection, whatever the 'method' option. The input layers are still read whole, the budget bounds the memory of
+the intersection itself.
+"""
+
+import os
+import tempfile
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+
+from Common.OverlayKernel import joined_pieces, make_valid_polygons, polygonal_parts, contained_pairs
+from Common.PieceStore import geometry_fingerprints
+
+# rough memory cost of one input vertex during the intersection of a tile: the clipped copies of both polygons,
+# the GEOS working geometries and the pieces
+BYTES_PER_VERTEX = 200
+
+
+def tile_grid(bounds, n_tiles):
+    """
+    Split a (minx, miny, maxx, maxy) extent into at least n_tiles tiles of about the same shape as the extent.
+
+    :return: array of shape (n, 4) with the bounds of the tiles
+    """
+    minx, miny, maxx, maxy = bounds
+    width, height = max(maxx - minx, 1e-12), max(maxy - miny, 1e-12)
+    nx = max(1, int(np.ceil(np.sqrt(n_tiles * width / height))))
+    ny = max(1, int(np.ceil(n_tiles / nx)))
+    xs, ys = np.linspace(minx, maxx, nx + 1), np.linspace(miny, maxy, ny + 1)
+    return np.array([(xs[i], ys[j], xs[i + 1], ys[j + 1]) for j in range(ny) for i in range(nx)])
+
+
+def tile_count(left, right, idx1, idx2, memory_budget):
+    """Number of tiles needed so that the vertices of the polygons of the given pairs fit in memory_budget MB."""
+    vertices = (shapely.get_num_coordinates(left[np.unique(idx1)]).sum() +
+                shapely.get_num_coordinates(right[np.unique(idx2)]).sum())
+    return max(1, int(np.ceil(vertices * BYTES_PER_VERTEX / (memory_budget * 1024 ** 2))))
+
+
+def _intersect_tile(left, right, idx1, idx2, tile):
+    # clip each polygon of the tile once, then intersect the clipped polygons of every pair
+    box = shapely.box(*tile)
+    unique1, inverse1 = np.unique(idx1, return_inverse=True)
+    unique2, inverse2 = np.unique(idx2, return_inverse=True)
+    clipped1 = shapely.intersection(left[unique1], box)
+    clipped2 = shapely.intersection(right[unique2], box)
+    return polygonal_parts(shapely.intersection(clipped1[inverse1], clipped2[inverse2]))
+
+
+def _stitch(table):
+    # union the pieces of each (row1, row2) pair, in (row1, row2) order
+    row1, row2 = table.column('row1').to_numpy(), table.column('row2').to_numpy()
+    pieces = shapely.from_wkb(table.column('wkb').to_numpy(zero_copy_only=False))
+    order = np.lexsort((row2, row1))
+    row1, row2, pieces = row1[order], row2[order], pieces[order]
+    if len(row1) == 0:
+        return row1, row2, np.empty(0, dtype=object)
+    starts = np.flatnonzero(np.r_[True, (row1[1:] != row1[:-1]) | (row2[1:] != row2[:-1])])
+    ends = np.r_[starts[1:], len(row1)]
+    stitched = pieces[starts].copy()
+    for k in np.flatnonzero(ends - starts > 1):
+        stitched[k] = shapely.union_all(pieces[starts[k]:ends[k]])
+    return row1[starts], row2[starts], stitched
+
+
+def tiled_intersection(df1, df2, memory_budget, containment=False, store=None, tree1=None, temp_dir=None):
+    """
+    Intersect two polygon layers tile by tile, see the module docstring.
+
+    :param memory_budget: approximate memory of the intersection in MB
+    :param containment: assign the df2 polygons lying inside a single df1 polygon directly
+    :param store: optional PieceStore, the stored pairs are reused and the new ones are added to it
+    :param tree1: optional STRtree of the df1 geometries
+    :param temp_dir: directory of the temporary piece file, the system default if None
+    :return: GeoDataFrame with the same layout as the other kernels
+    """
+    original_left = np.asarray(df1.geometry.array)
+    left, right = make_valid_polygons(original_left), make_valid_polygons(np.asarray(df2.geometry.array))
+    if tree1 is not None and left is original_left:
+        idx2, idx1 = tree1.query(right, predicate='intersects')
+    else:
+        idx1, idx2 = shapely.STRtree(right).query(left, predicate='intersects')
+
+    # the finished pairs: contained polygons and stored pieces
+    done1, done2, done_pieces = [], [], []
+    if containment:
+        contained1, contained2 = contained_pairs(df1, df2, tree1)
+        other = ~np.isin(idx2, contained2)
+        idx1, idx2 = idx1[other], idx2[other]
+        done1.append(contained1)
+        done2.append(contained2)
+        done_pieces.append(right[contained2])
+    if store is not None:
+        fingerprints1, fingerprints2 = geometry_fingerprints(df1), geometry_fingerprints(df2)
+        stored = store.fetch(np.unique(fingerprints1[idx1]))
+        found = np.array([pair in stored for pair in zip(fingerprints1[idx1], fingerprints2[idx2])], dtype=bool)
+        done1.append(idx1[found])
+        done2.append(idx2[found])
+        done_pieces.append(shapely.from_wkb([stored[(fingerprints1[i], fingerprints2[j])]
+                                             for i, j in zip(idx1[found], idx2[found])]))
+        print(f"Reused {found.sum()} of {len(found)} intersection pieces")
+        idx1, idx2 = idx1[~found], idx2[~found]
+
+    # the bounds of a pair is the overlap of the bounds of its two polygons
+    bounds1, bounds2 = shapely.bounds(left[idx1]), shapely.bounds(right[idx2])
+    pair_bounds = np.column_stack([np.maximum(bounds1[:, :2], bounds2[:, :2]),
+                                   np.minimum(bounds1[:, 2:], bounds2[:, 2:])])
+    tiles = np.empty((0, 4))
+    if len(idx1):
+        extent = (*pair_bounds[:, :2].min(axis=0), *pair_bounds[:, 2:].max(axis=0))
+        tiles = tile_grid(extent, tile_count(left, right, idx1, idx2, memory_budget))
+    print(f"Tiled overlay: {len(idx1)} pairs in {len(tiles)} tiles")
+
+    schema = pa.schema([('row1', pa.int64()), ('row2', pa.int64()), ('wkb', pa.binary())])
+    with tempfile.TemporaryDirectory(dir=temp_dir) as directory:
+        path = os.path.join(directory, 'pieces.parquet')
+        with pq.ParquetWriter(path, schema) as writer:
+            for tile in tiles:
+                in_tile = np.flatnonzero((pair_bounds[:, 0] <= tile[2]) & (pair_bounds[:, 2] >= tile[0]) &
+                                         (pair_bounds[:, 1] <= tile[3]) & (pair_bounds[:, 3] >= tile[1]))
+                if len(in_tile) == 0:
+                    continue
+                pieces = _intersect_tile(left, right, idx1[in_tile], idx2[in_tile], tile)
+                keep = ~(shapely.is_missing(pieces) | shapely.is_empty(pieces))
+                writer.write_table(pa.table({'row1': idx1[in_tile][keep], 'row2': idx2[in_tile][keep],
+                                             'wkb': shapely.to_wkb(pieces[keep])}, schema=schema))
+        tiled1, tiled2, stitched = _stitch(pq.read_table(path))
+
+    if store is not None:
+        # the pairs without a polygonal piece are stored without one, as in the pairwise kernel
+        pieces = np.full(len(idx1), None, dtype=object)
+        position = {pair: k for k, pair in enumerate(zip(tiled1, tiled2))}
+        for k, pair in enumerate(zip(idx1, idx2)):
+            if pair in position:
+                pieces[k] = stitched[position[pair]]
+        store.add(fingerprints1[idx1], fingerprints2[idx2], pieces)
+
+    idx1 = np.concatenate(done1 + [tiled1]).astype(np.int64)
+    idx2 = np.concatenate(done2 + [tiled2]).astype(np.int64)
+    pieces = np.concatenate(done_pieces + [stitched])
+    keep = ~(shapely.is_missing(pieces) | shapely.is_empty(pieces))
+    order = np.lexsort((idx2[keep], idx1[keep]))
+    return joined_pieces(df1, df2, idx1[keep][order], idx2[keep][order], pieces[keep][order])
@@ -0,0 +1,207 @@
+"""
+This script performs the CoC@Counties, CoC@Places and CoC@Subdivisions overlays of a (year, state) in one task.
+
+Each of the three scripts reads the same CoC_Merged shapefile and builds its own spatial index on it, so every CoC
+file was read and indexed three times. Here the CoC layer of a (year, state) is read once, its spatial index is built
+once and both are handed to the state function of each script. The outputs, their names and the build manifests are
+the same as when the three scripts are run one after the other (see CoC@Counties.py for the structure), and each
+layer runs with the run options of its script (run_options at the bottom of it, see layer_options), so the scripts and
+this driver can be mixed freely: they share the build manifests and the preprocessed inputs.
+
+Only the layers that are out of date in their build manifest are run for a (year, state). The subdivisions only exist
+for the states listed in CoC@Subdivisions.py.
+"""
+
+import importlib.util
+import os
+import sys
+import numpy as np
+import shapely
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Common.BuildCache import BuildCache
+from Common.GeoStore import read_layer
+from Common.OverlayKernel import REPAIR_STRATEGIES, overlay_options
+from Common.ParallelRunner import run_tasks
+from Common.Preprocess import preprocess_dir, preprocess_layer
+from Common.TaskGuard import is_input_error, run_limited, run_with_fallback
+
+
+def load_script(name):
+    # the script names contain an '@', so they are loaded from their file instead of imported
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), f'{name}.py')
+    module_name = name.replace('@', '_')
+    if module_name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(module_name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[module_name]
+
+
+counties_script = load_script('CoC@Counties')
+places_script = load_script('CoC@Places')
+subdivisions_script = load_script('CoC@Subdivisions')
+
+# state function, paths function, manifest name, states and run options of each census layer
+layers = {
+    'counties': (counties_script.overlay_coc_counties_state, counties_script.coc_counties_paths,
+                 'CoC@Counties', counties_script.states_fips_codes, counties_script.run_options),
+    'Census places': (places_script.overlay_coc_places_state, places_script.coc_places_paths,
+                      'CoC@Places', places_script.states_fips_codes, places_script.run_options),
+    'county subdivisions': (subdivisions_script.overlay_coc_subdivisions_state,
+                            subdivisions_script.coc_subdivisions_paths,
+                            'CoC@Subdivisions', subdivisions_script.states_fips_codes, subdivisions_script.run_options),
+}
+
+
+def layer_options(layer_type, options=None):
+    """
+    The run options of a layer: the run_options of its script updated with options, so a layer gets the same options
+    hash in its build manifest whether it is run by its script, this driver or Pipeline/RunPipeline.py.
+    """
+    return overlay_options(dict(layers[layer_type][4], **(options or {})))
+
+
+def _overlay_coc_layers_shared(year, state, fips, base_dir, options):
+    # the layers of a (year, state) with the CoC layer read and indexed once, returns the outputs and the failed layers
+    # every layer reads the same CoC shapefile, take its path from the first one
+    layer_types = list(options)
+    (coc_shp_path, _), _ = layers[layer_types[0]][1](year, state, fips, base_dir, options[layer_types[0]])
+
+    # Read the CoC shapefile once
+    coc_gdf = read_layer(coc_shp_path)
+    if coc_gdf.crs is None:
+        print(f"Missing CRS for CoC shapefile: {coc_shp_path}, passing for now")
+        return {layer_type: None for layer_type in layer_types}, []
+
+    outputs, failed, prepared = {}, [], {}
+    for layer_type in layer_types:
+        overlay_state = layers[layer_type][0]
+        # preprocess the CoC layer and build its spatial index once per precision and repair of the layers
+        key = (options[layer_type]['precision'], options[layer_type]['repair'])
+        if key not in prepared:
+            gdf = preprocess_layer(coc_gdf, coc_shp_path, key[0], preprocess_dir(base_dir), repair=key[1])
+            prepared[key] = (gdf, shapely.STRtree(np.asarray(gdf.geometry.array)))
+        coc_prepared, coc_tree = prepared[key]
+        # a failing layer does not stop the other layers of the state
+        try:
+            outputs[layer_type] = overlay_state(year, state, fips, base_dir, options[layer_type],
+                                                coc_gdf=coc_prepared, coc_tree=coc_tree)
+        except Exception as e:
+            print(f"Error during the {layer_type} overlay for {state} {year}: {e}")
+            outputs[layer_type] = None
+            if not is_input_error(e):
+                failed.append(layer_type)
+    return outputs, failed
+
+
+def overlay_coc_layers_state(year, state, fips, base_dir, options=None, timeout=None, memory_limit=None):
+    """
+    Read and index the CoC layer of a (year, state) once and overlay it with each of the given census layers.
+
+    The layers of the state run together under the time and memory limits (see Common/TaskGuard.py). A layer that
+    failed, or all of them when the state ran out of time or memory, is then retried on its own with the heavier
+    repairs of the geometries.
+
+    :param options: dict layer type -> run options of the layer (see layer_options), None runs every layer with the
+                    run options of its script
+    :return: dict layer type -> outputs of the state function (None when the layer passed or failed)
+    """
+    if options is None:
+        options = {layer_type: layer_options(layer_type) for layer_type in layers}
+    layer_types = list(options)
+    try:
+        outputs, failed = run_limited(_overlay_coc_layers_shared, (year, state, fips, base_dir, options),
+                                      timeout, memory_limit)
+    except Exception as e:
+        # a missing input fails the task, as before
+        if is_input_error(e):
+            raise
+        print(f"The overlays of {state} {year} did not finish: {e}")
+        outputs, failed = {}, layer_types
+
+    for layer_type in failed:
+        outputs[layer_type] = None
+        strategies = REPAIR_STRATEGIES[REPAIR_STRATEGIES.index(options[layer_type]['repair']):]
+        if len(strategies) == 1:
+            continue
+        try:
+            outputs[layer_type] = run_with_fallback(layers[layer_type][0], (year, state, fips, base_dir),
+                                                    dict(options[layer_type], repair=strategies[1]), timeout,
+                                                    memory_limit, year=year, state=state)
+        except Exception as e:
+            print(f"The {layer_type} overlay for {state} {year} failed with every repair: {e}")
+    return outputs
+
+
+def overlay_coc_layers(years, layer_types, base_dir='D:\\UMich\\z-others\\Haolin_Code', workers=1, force=False,
+                       timeout=None, memory_limit=None, **options):
+    """
+    Run the out of date layers of every (year, state), one task each, see overlay_coc_layers_state.
+
+    :param options: run options that override those of the scripts for every layer, see layer_options
+    """
+    options = {layer_type: layer_options(layer_type, options) for layer_type in layer_types}
+    caches = {layer_type: BuildCache(os.path.join(base_dir, 'Intersection', 'Output', 'manifests',
+                                                  f'{layers[layer_type][2]}.json'))
+              for layer_type in layer_types}
+
+    # one task per (year, state) with the layers of that state that are out of date
+    tasks, pending = [], []
+    total = 0
+    for year in years:
+        states = {}
+        for layer_type in layer_types:
+            for state, fips in layers[layer_type][3].items():
+                states.setdefault(state, fips)
+        for state, fips in states.items():
+            stale = []
+            for layer_type in layer_types:
+                if state not in layers[layer_type][3]:
+                    continue
+                total += 1
+                inputs, outputs = layers[layer_type][1](year, state, fips, base_dir, options[layer_type])
+                key = os.path.abspath(outputs[0])
+                if not force and caches[layer_type].is_fresh(key, inputs, options[layer_type], outputs):
+                    continue
+                stale.append(layer_type)
+                # remember the hashes the task was started with, a file changed during the run is picked up next time
+                pending.append((len(tasks), layer_type, key, inputs, outputs,
+                                caches[layer_type].input_hashes(inputs)))
+            if stale:
+                tasks.append((year, state, fips, base_dir, {layer_type: options[layer_type] for layer_type in stale},
+                              timeout, memory_limit))
+
+    print(f"[overlay_coc_layers] {total - len(pending)}/{total} overlays are up to date")
+    records = run_tasks(overlay_coc_layers_state, tasks, workers=workers, label='overlay_coc_layers') if tasks else []
+
+    for index, layer_type, key, inputs, outputs, hashes in pending:
+        record = records[index]
+        if record['status'] == 'ok' and record['result'].get(layer_type) is not None \
+                and None not in hashes.values() and all(os.path.exists(p) for p in outputs):
+            caches[layer_type].record(key, inputs, options[layer_type], outputs, hashes)
+    for cache in caches.values():
+        cache.save()
+    return records
+
+
+# the build manifests skip the years, states and layers that are already up to date
+year_to_process = range(2007, 2024)
+layers_to_process = ['counties', 'Census places', 'county subdivisions']
+
+# each layer runs with the run_options of its script, these override them for all layers (e.g. {'output': 'dataset'}),
+# see DEFAULT_OVERLAY_OPTIONS in Common/OverlayKernel.py
+run_options = {}
+
+# number of worker processes, each one holds a full state with its three census layers in memory
+workers = 4
+
+# wall-clock limit of a (year, state) in seconds and memory limit of its process in MB (None for no limit), see
+# Common/TaskGuard.py
+task_timeout = 3600
+task_memory_limit = None
+
+if __name__ == '__main__':
+    overlay_coc_layers(year_to_process, layers_to_process, workers=workers, timeout=task_timeout,
+                       memory_limit=task_memory_limit, **run_options)
@@ -30,6 +30,10 @@ Structure of the input files:
         - 2008
         - 2009
         - 2010
+        - 2011
+            - county_store      (from 2011 on, one partition per state, see CountyProcess.py)
+                - 01.parquet
+                - ...
 
 Structure of the output files:
 - Intersection
@@ -50,96 +54,152 @@ Structure of the output files:
 """
 
 import os
-import geopandas as gpd
-
-
-def overlay_coc_counties(years, states_fips, base_dir='D:\\UMich\\z-others\\Haolin_Code'):
-    for year in years:
-        for state, fips in states_fips.items():
-            # Construct the CoC shapefile path
-            coc_shp_path = os.path.join(base_dir, 'shapefiles', 'CoC_Merged', str(year), state,
-                                        f"{state.replace(' ', '_')}_{year}_CoC_Merged.shp")
-
-            # Construct the county shapefile path with a year-based prefix
-            county_prefix = 'fe' if year == 2007 else 'tl'
-            county_suffix = '10' if year == 2010 else ''
-            county_shp_path = os.path.join(base_dir, 'shapefiles', 'counties', str(year),
-                                           f"{fips}_{state.upper().replace(' ', '_')}",
-                                           f"{county_prefix}_{year}_{fips}_county{county_suffix}.shp")
-
-            # Read the shapefiles
-            coc_gdf = gpd.read_file(coc_shp_path)
-            county_gdf = gpd.read_file(county_shp_path)
-
-            # Check CRS and reproject if necessary
-            if coc_gdf.crs is None:
-                print(f"Missing CRS for CoC shapefile: {coc_shp_path}, passing for now")
-                continue
-            if county_gdf.crs is None:
-                print(f"Missing CRS for county shapefile: {county_shp_path}, passing for now")
-                continue
-            try:
-                if coc_gdf.crs != county_gdf.crs:
-                    county_gdf = county_gdf.to_crs(coc_gdf.crs)  # Reproject county shapefile to match CoC shapefile
-            except ValueError as e:
-                print(f"Error reprojecting CoC shapefile: {e}")
-                continue
-
-            # Perform overlay operation
-            # set the buffer distance and simplify tolerance
-            buffer_distance = 0.0001
-            simplify_tolerance = 0.0001
-
-            # simplify the geometry of the coc_gdf and county_gdf
-            coc_gdf['geometry'] = coc_gdf['geometry'].buffer(buffer_distance).simplify(simplify_tolerance)
-            county_gdf['geometry'] = county_gdf['geometry'].buffer(buffer_distance).simplify(simplify_tolerance)
-            intersected_gdf = gpd.overlay(coc_gdf, county_gdf, how='intersection')
-
-            # create new column in the intersected_gdf to store the % area of the current county that is in each CoC
-            intersected_gdf['area'] = intersected_gdf['geometry'].area
-            county_gdf['total_area'] = county_gdf['geometry'].area
-            county_areas = county_gdf[['COUNTYFP' if year != 2010 else 'COUNTYFP10', 'total_area']].drop_duplicates()
-
-            # merge the county_areas with the intersected_gdf
-            intersected_gdf = intersected_gdf.merge(county_areas, on='COUNTYFP' if year != 2010 else 'COUNTYFP10', how='left')
-
-            # calculate the % area of the belonging county
-            intersected_gdf['%of_county'] = intersected_gdf['area'] / intersected_gdf['total_area']
-
-            # coc_gdf['total_area'] = coc_gdf['geometry'].area
-            # coc_areas = coc_gdf[['CoC_Number', 'total_area']].drop_duplicates()
-            #
-            # # merge the coc_areas with the intersected_gdf
-            # intersected_gdf = intersected_gdf.merge(coc_areas, on='CoC_Number', how='left')
-            #
-            # # calculate the % area of each county / place / county subdivision that is in each CoC
-            # intersected_gdf['%of_coc'] = intersected_gdf['area'] / intersected_gdf['total_area']
-
-            # drop the columns that are not needed
-            intersected_gdf = intersected_gdf.drop(columns=['total_area', 'area'])
-
-            # Define the output path
-            output_dir = os.path.join(base_dir, 'Intersection', 'Output', str(year), 'CoC@Counties', 'shp')
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-            output_path = os.path.join(output_dir, f"CoC_Counties_{fips}_{state}_{str(year)[2:]}.shp")
-
-            # Save the output shapefile
-            intersected_gdf.to_file(output_path)
-
-            # export the csv table
-            output_dir = os.path.join(base_dir, 'Intersection', 'Output', str(year), 'CoC@Counties')
-            if not os.path.exists(os.path.join(output_dir, 'csv')):
-                os.makedirs(os.path.join(output_dir, 'csv'))
-            csv_output_path = os.path.join(output_dir, 'csv', f"CoC_Counties_{fips}_{state}_{str(year)[2:]}.csv")
-            intersected_gdf.drop('geometry',axis=1).to_csv(csv_output_path, index=False)
-
-            print(f"Saved CoC@Counties for {state} {year}")
+import sys
+from functools import partial
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Common.AreaEngine import reproject, shares
+from Common.BuildCache import run_cached
+from Common.Catalog import find_layer
+from Common.CountyStore import county_layer_path
+from Common.GeoStore import read_layer, resolve_layer
+from Common.OverlayKernel import intersect, overlay_options
+from Common.PieceStore import PieceStore
+from Common.Preprocess import preprocess_dir, preprocess_layer
+from Common.ResultStore import partition_path, write_partition
+from Common.RunLog import StageLog
+from Common.TaskGuard import overlay_state_guarded
+
+
+def coc_counties_paths(year, state, fips, base_dir, options=None):
+    # Construct the CoC shapefile path
+    coc_shp_path = os.path.join(base_dir, 'shapefiles', 'CoC_Merged', str(year), state,
+                                f"{state.replace(' ', '_')}_{year}_CoC_Merged.shp")
+
+    # Construct the county shapefile path with a year-based prefix
+    county_prefix = 'fe' if year == 2007 else 'tl'
+    county_suffix = '10' if year == 2010 else ''
+    county_shp_path = os.path.join(base_dir, 'shapefiles', 'counties', str(year),
+                                   f"{fips}_{state.upper().replace(' ', '_')}",
+                                   f"{county_prefix}_{year}_{fips}_county{county_suffix}.shp")
+    # from 2011 on the counties of the state are the STATEFP partition of the county store, see Common/CountyStore.py
+    if year >= 2011:
+        county_shp_path = county_layer_path(os.path.join(base_dir, 'shapefiles', 'counties'), year, fips,
+                                            county_shp_path)
+    # an input recorded in the input catalog is taken from it, see Common/Catalog.py
+    shapefiles_dir = os.path.join(base_dir, 'shapefiles')
+    coc_shp_path = find_layer(shapefiles_dir, 'CoC_Merged', year, state) or coc_shp_path
+    county_shp_path = find_layer(shapefiles_dir, 'counties', year, fips=fips) or county_shp_path
+
+    # Define the output paths
+    output_dir = os.path.join(base_dir, 'Intersection', 'Output', str(year), 'CoC@Counties')
+    output_path = os.path.join(output_dir, 'shp', f"CoC_Counties_{fips}_{state}_{str(year)[2:]}.shp")
+    csv_output_path = os.path.join(output_dir, 'csv', f"CoC_Counties_{fips}_{state}_{str(year)[2:]}.csv")
+
+    # the GeoParquet version of an input, or the shapefile inside its downloaded zip archive, is read instead when
+    # that is what is there, see Common/GeoStore.py
+    inputs = [resolve_layer(coc_shp_path), resolve_layer(county_shp_path)]
+    # with output='dataset' the result goes to a partition of the result dataset, see Common/ResultStore.py
+    if overlay_options(options)['output'] == 'dataset':
+        return inputs, [partition_path(base_dir, year, 'Counties', state)]
+    return inputs, [output_path, csv_output_path]
+
+
+def overlay_coc_counties_state(year, state, fips, base_dir, options=None, coc_gdf=None, coc_tree=None):
+    options = overlay_options(options)
+    log = StageLog('overlay_coc_counties', year=year, state=state)
+    (coc_shp_path, county_shp_path), outputs = coc_counties_paths(year, state, fips, base_dir, options)
+
+    # Read the shapefiles
+    # (the CoC layer and its spatial index can be passed in already loaded and preprocessed, see CoC@AllLayers.py)
+    preprocessed = coc_gdf is not None
+    if coc_gdf is None:
+        coc_gdf = read_layer(coc_shp_path)
+    county_gdf = read_layer(county_shp_path)
+    log.lap('read', coc_gdf, county_gdf)
+
+    # Check CRS and reproject if necessary
+    if coc_gdf.crs is None:
+        print(f"Missing CRS for CoC shapefile: {coc_shp_path}, passing for now")
+        return
+    if county_gdf.crs is None:
+        print(f"Missing CRS for county shapefile: {county_shp_path}, passing for now")
+        return
+    try:
+        if coc_gdf.crs != county_gdf.crs:
+            county_gdf = reproject(county_gdf, coc_gdf.crs)  # Reproject county shapefile to match CoC shapefile
+    except ValueError as e:
+        print(f"Error reprojecting CoC shapefile: {e}")
+        return
+    log.lap('reproject')
+
+    # repair the geometry of the coc_gdf and county_gdf and snap it to the precision grid (this replaces the
+    # .buffer(0.0001).simplify(0.0001) of every run, the result is cached per input file, see Common/Preprocess.py)
+    if not preprocessed:
+        coc_gdf = preprocess_layer(coc_gdf, coc_shp_path, options['precision'], preprocess_dir(base_dir),
+                                   repair=options['repair'])
+    county_gdf = preprocess_layer(county_gdf, county_shp_path, options['precision'], preprocess_dir(base_dir),
+                                  repair=options['repair'])
+    log.lap('preprocess', coc_gdf, county_gdf)
+
+    # Perform overlay operation
+    # the pieces of the (CoC, county) pairs that did not change since an earlier year are reused
+    store = None
+    if options['reuse']:
+        store = PieceStore(os.path.join(base_dir, 'Intersection', 'Output', 'pieces', 'CoC@Counties.sqlite'))
+    intersected_gdf = intersect(coc_gdf, county_gdf, method=options['method'], containment=options['containment'],
+                                store=store, tree1=coc_tree, memory_budget=options['memory_budget'], rows=True)
+    if store is not None:
+        store.close()
+    log.lap('overlay', intersected_gdf)
+
+    # the share of the county and of the CoC each piece covers, the areas of both layers are looked up by the row
+    # positions intersect() carried through the overlay (see Common/AreaEngine.py)
+    coc_share, county_share = shares(intersected_gdf, coc_gdf, county_gdf, options['area'], options['area_crs'])
+    intersected_gdf = intersected_gdf.drop(columns=['__row1', '__row2'])
+    intersected_gdf['%of_county'] = county_share
+    intersected_gdf['%of_coc'] = coc_share
+    log.lap('area', intersected_gdf)
+
+    # with output='dataset' the result goes to the result dataset instead of a shp and a csv
+    if options['output'] == 'dataset':
+        write_partition(intersected_gdf, base_dir, year, 'Counties', state)
+        log.lap('write')
+        print(f"Saved CoC@Counties for {state} {year} (dataset)")
+        return outputs
+    output_path, csv_output_path = outputs
+
+    # Save the output shapefile
+    if not os.path.exists(os.path.dirname(output_path)):
+        os.makedirs(os.path.dirname(output_path))
+    intersected_gdf.to_file(output_path)
+
+    # export the csv table
+    if not os.path.exists(os.path.dirname(csv_output_path)):
+        os.makedirs(os.path.dirname(csv_output_path))
+    intersected_gdf.drop('geometry',axis=1).to_csv(csv_output_path, index=False)
+    log.lap('write')
+
+    print(f"Saved CoC@Counties for {state} {year}")
+    return outputs
+
+
+def overlay_coc_counties(years, states_fips, base_dir='D:\\UMich\\z-others\\Haolin_Code', workers=1, force=False,
+                         timeout=None, memory_limit=None, **options):
+    # every (year, state) pair is independent, so they can be spread over a pool of worker processes
+    tasks = [(year, state, fips, base_dir, options) for year in years for state, fips in states_fips.items()]
+    # each task runs under the time and memory limits, and is retried with a heavier repair of the geometries when
+    # it fails or runs out of time (see Common/TaskGuard.py)
+    task = partial(overlay_state_guarded, overlay_coc_counties_state, timeout=timeout, memory_limit=memory_limit)
+    # the pairs whose inputs and options did not change since the last run are skipped
+    manifest_path = os.path.join(base_dir, 'Intersection', 'Output', 'manifests', 'CoC@Counties.json')
+    return run_cached(task, tasks, coc_counties_paths, manifest_path, overlay_options(options),
+                      workers=workers, label='overlay_coc_counties', force=force)
 
 
 # Example usage
-# year_to_process = range(2007, 2024)
-year_to_process = range(2018, 2024)
+# the build manifest skips the years and states that are already up to date
+year_to_process = range(2007, 2024)
 states_fips_codes = {
     'Alabama': '01',
     'Alaska': '02',
@@ -197,4 +257,27 @@ states_fips_codes = {
     'Virgin Islands of the United States': '78'
 }
 
-overlay_coc_counties(year_to_process, states_fips_codes)
+# overlay options, see DEFAULT_OVERLAY_OPTIONS in Common/OverlayKernel.py
+# method: 'overlay' (gpd.overlay) or 'strtree' (pairwise STRtree kernel)
+# containment: assign the polygons lying inside a single CoC directly, only clip the ones on CoC boundaries
+# reuse: reuse the pieces of pairs that did not change since an earlier year (needs 'strtree')
+# output: 'files' (a shp and a csv per task) or 'dataset' (the partitioned Parquet dataset, see Common/ResultStore.py)
+# area: 'planar' (in the CRS of the CoC file), 'equal_area' or 'geodesic' (see Common/AreaEngine.py)
+# precision: grid size the geometries are snapped to after their repair, in CoC CRS units (see Common/Preprocess.py)
+# (0.0001 is the tolerance of the buffer + simplify this script used before)
+# memory_budget: approximate memory of the overlay in MB, large states are then intersected tile by tile
+# (see Common/TiledOverlay.py), None intersects the whole state at once
+run_options = {'method': 'strtree', 'containment': True, 'reuse': True, 'area': 'equal_area', 'precision': 0.0001}
+
+# number of worker processes, each one holds a full state in memory during the overlay
+workers = 4
+
+# wall-clock limit of a task in seconds and memory limit of its process in MB (None for no limit), a task that fails
+# or runs out of either is retried with a heavier repair of the geometries (see Common/TaskGuard.py)
+task_timeout = 3600
+task_memory_limit = None
+
+# the guard is needed so that the worker processes do not re-run the whole batch when they import this script
+if __name__ == '__main__':
+    overlay_coc_counties(year_to_process, states_fips_codes, workers=workers, timeout=task_timeout,
+                         memory_limit=task_memory_limit, **run_options)
@@ -50,73 +50,143 @@ Structure of the output files:
 """
 
 import os
-import geopandas as gpd
-
-
-def overlay_coc_places(years, states_fips, base_dir='D:\\UMich\\z-others\\Haolin_Code'):
-    for year in years:
-        for state, fips in states_fips.items():
-            # Construct the CoC shapefile path
-            coc_shp_path = os.path.join(base_dir, 'shapefiles', 'CoC_Merged', str(year), state,
-                                        f"{state.replace(' ', '_')}_{year}_CoC_Merged.shp")
-            # Construct the places shapefile path
-            places_prefix = 'fe' if year == 2007 else 'tl'
-            places_suffix = '10' if year == 2010 else ''
-            places_shp_path = os.path.join(base_dir, 'shapefiles', 'Census places', str(year),
-                                           f"{fips}_{state.upper().replace(' ', '_')}",
-                                           f"{places_prefix}_{year}_{fips}_place{places_suffix}.shp")
-
-            # Read the intersecting shapefiles
-            coc_shp = gpd.read_file(coc_shp_path)
-            places_shp = gpd.read_file(places_shp_path)
-
-            # Check CRS and reproject if necessary
-            if coc_shp.crs is None:
-                print(f"Missing CRS for CoC shapefile: {coc_shp_path}, passing for now")
-                continue
-            if places_shp.crs is None:
-                print(f"Missing CRS for place shapefile: {places_shp_path}, passing for now")
-                continue
-            try:
-                if coc_shp.crs != places_shp.crs:
-                    places_shp = places_shp.to_crs(coc_shp.crs)  # Reproject county shapefile to match CoC shapefile
-            except ValueError as e:
-                print(f"Error reprojecting CoC shapefile: {e}")
-                continue
-
-            # Perform the overlay operation
-            intersected_gdf = gpd.overlay(coc_shp, places_shp, how='intersection')
-
-            # create new column in the intersected_gdf to store the % area of each places
-            intersected_gdf['area'] = intersected_gdf['geometry'].area
-            places_shp['total_area'] = places_shp['geometry'].area
-            places_areas = places_shp[['PLACEFP' if year != 2010 else 'PLACEFP10', 'total_area']].drop_duplicates()
-
-            # merge the places_areas with the intersected_gdf
-            intersected_gdf = intersected_gdf.merge(places_areas, on='PLACEFP' if year != 2010 else 'PLACEFP10', how='left')
-
-            # calculate the % area of each places in each place
-            intersected_gdf['%of_place'] = intersected_gdf['area'] / intersected_gdf['total_area']
-
-            # drop the unnecessary columns
-            intersected_gdf = intersected_gdf.drop(columns=['total_area', 'area'])
-
-            # save the output
-            shp_output_dir = os.path.join(base_dir, 'Intersection', 'Output', str(year), 'CoC@Places', 'shp')
-            if not os.path.exists(shp_output_dir):
-                os.makedirs(shp_output_dir)
-            intersected_gdf.to_file(os.path.join(shp_output_dir, f"CoC_Places_{fips}_{state}_{str(year)[2:]}.shp"))
-
-            csv_output_dir = os.path.join(base_dir, 'Intersection', 'Output', str(year), 'CoC@Places', 'csv')
-            if not os.path.exists(csv_output_dir):
-                os.makedirs(csv_output_dir)
-            intersected_gdf.drop('geometry',axis=1).to_csv(os.path.join(csv_output_dir, f"CoC_Places_{fips}_{state}_{str(year)[2:]}.csv"), index=False)
-
-            print(f"Finished processing for {state} {year}")
-
-
-# year_to_process = range(2007, 2024)
-year_to_process = range(2018, 2024)
+import sys
+from functools import partial
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Common.AreaEngine import reproject, shares
+from Common.BuildCache import run_cached
+from Common.Catalog import find_layer
+from Common.GeoStore import read_layer, resolve_layer
+from Common.OverlayKernel import intersect, overlay_options
+from Common.PieceStore import PieceStore
+from Common.Preprocess import preprocess_dir, preprocess_layer
+from Common.ResultStore import partition_path, write_partition
+from Common.RunLog import StageLog
+from Common.TaskGuard import overlay_state_guarded
+
+
+def coc_places_paths(year, state, fips, base_dir, options=None):
+    # Construct the CoC shapefile path
+    coc_shp_path = os.path.join(base_dir, 'shapefiles', 'CoC_Merged', str(year), state,
+                                f"{state.replace(' ', '_')}_{year}_CoC_Merged.shp")
+    # Construct the places shapefile path
+    places_prefix = 'fe' if year == 2007 else 'tl'
+    places_suffix = '10' if year == 2010 else ''
+    places_shp_path = os.path.join(base_dir, 'shapefiles', 'Census places', str(year),
+                                   f"{fips}_{state.upper().replace(' ', '_')}",
+                                   f"{places_prefix}_{year}_{fips}_place{places_suffix}.shp")
+    # an input recorded in the input catalog is taken from it, see Common/Catalog.py
+    shapefiles_dir = os.path.join(base_dir, 'shapefiles')
+    coc_shp_path = find_layer(shapefiles_dir, 'CoC_Merged', year, state) or coc_shp_path
+    places_shp_path = find_layer(shapefiles_dir, 'Census places', year, fips=fips) or places_shp_path
+
+    # Construct the output paths
+    shp_output_dir = os.path.join(base_dir, 'Intersection', 'Output', str(year), 'CoC@Places', 'shp')
+    shp_output_path = os.path.join(shp_output_dir, f"CoC_Places_{fips}_{state}_{str(year)[2:]}.shp")
+    csv_output_dir = os.path.join(base_dir, 'Intersection', 'Output', str(year), 'CoC@Places', 'csv')
+    csv_output_path = os.path.join(csv_output_dir, f"CoC_Places_{fips}_{state}_{str(year)[2:]}.csv")
+
+    # the GeoParquet version of an input, or the shapefile inside its downloaded zip archive, is read instead when
+    # that is what is there, see Common/GeoStore.py
+    inputs = [resolve_layer(coc_shp_path), resolve_layer(places_shp_path)]
+    # with output='dataset' the result goes to a partition of the result dataset, see Common/ResultStore.py
+    if overlay_options(options)['output'] == 'dataset':
+        return inputs, [partition_path(base_dir, year, 'Places', state)]
+    return inputs, [shp_output_path, csv_output_path]
+
+
+def overlay_coc_places_state(year, state, fips, base_dir, options=None, coc_gdf=None, coc_tree=None):
+    options = overlay_options(options)
+    log = StageLog('overlay_coc_places', year=year, state=state)
+    (coc_shp_path, places_shp_path), outputs = coc_places_paths(year, state, fips, base_dir, options)
+
+    # Read the intersecting shapefiles
+    # (the CoC layer and its spatial index can be passed in already loaded, see CoC@AllLayers.py)
+    coc_shp = coc_gdf if coc_gdf is not None else read_layer(coc_shp_path)
+    places_shp = read_layer(places_shp_path)
+    log.lap('read', coc_shp, places_shp)
+
+    # Check CRS and reproject if necessary
+    if coc_shp.crs is None:
+        print(f"Missing CRS for CoC shapefile: {coc_shp_path}, passing for now")
+        return
+    if places_shp.crs is None:
+        print(f"Missing CRS for place shapefile: {places_shp_path}, passing for now")
+        return
+    try:
+        if coc_shp.crs != places_shp.crs:
+            places_shp = reproject(places_shp, coc_shp.crs)  # Reproject places shapefile to match CoC shapefile
+    except ValueError as e:
+        print(f"Error reprojecting CoC shapefile: {e}")
+        return
+    log.lap('reproject')
+
+    # repair the geometries and snap them to the precision grid, cached per input file (see Common/Preprocess.py)
+    # (a CoC layer passed in is already preprocessed)
+    if coc_gdf is None:
+        coc_shp = preprocess_layer(coc_shp, coc_shp_path, options['precision'], preprocess_dir(base_dir),
+                                   repair=options['repair'])
+    places_shp = preprocess_layer(places_shp, places_shp_path, options['precision'], preprocess_dir(base_dir),
+                                  repair=options['repair'])
+    log.lap('preprocess', coc_shp, places_shp)
+
+    # Perform the overlay operation
+    # the pieces of the (CoC, place) pairs that did not change since an earlier year are reused
+    store = None
+    if options['reuse']:
+        store = PieceStore(os.path.join(base_dir, 'Intersection', 'Output', 'pieces', 'CoC@Places.sqlite'))
+    intersected_gdf = intersect(coc_shp, places_shp, method=options['method'], containment=options['containment'],
+                                store=store, tree1=coc_tree, memory_budget=options['memory_budget'], rows=True)
+    if store is not None:
+        store.close()
+    log.lap('overlay', intersected_gdf)
+
+    # the share of the place and of the CoC each piece covers, the areas of both layers are looked up by the row
+    # positions intersect() carried through the overlay (see Common/AreaEngine.py)
+    coc_share, place_share = shares(intersected_gdf, coc_shp, places_shp, options['area'], options['area_crs'])
+    intersected_gdf = intersected_gdf.drop(columns=['__row1', '__row2'])
+    intersected_gdf['%of_place'] = place_share
+    intersected_gdf['%of_coc'] = coc_share
+    log.lap('area', intersected_gdf)
+
+    # with output='dataset' the result goes to the result dataset instead of a shp and a csv
+    if options['output'] == 'dataset':
+        write_partition(intersected_gdf, base_dir, year, 'Places', state)
+        log.lap('write')
+        print(f"Finished processing for {state} {year} (dataset)")
+        return outputs
+    shp_output_path, csv_output_path = outputs
+
+    # save the output
+    if not os.path.exists(os.path.dirname(shp_output_path)):
+        os.makedirs(os.path.dirname(shp_output_path))
+    intersected_gdf.to_file(shp_output_path)
+
+    if not os.path.exists(os.path.dirname(csv_output_path)):
+        os.makedirs(os.path.dirname(csv_output_path))
+    intersected_gdf.drop('geometry',axis=1).to_csv(csv_output_path, index=False)
+    log.lap('write')
+
+    print(f"Finished processing for {state} {year}")
+    return outputs
+
+
+def overlay_coc_places(years, states_fips, base_dir='D:\\UMich\\z-others\\Haolin_Code', workers=1, force=False,
+                       timeout=None, memory_limit=None, **options):
+    # every (year, state) pair is independent, so they can be spread over a pool of worker processes
+    tasks = [(year, state, fips, base_dir, options) for year in years for state, fips in states_fips.items()]
+    # each task runs under the time and memory limits, and is retried with a heavier repair of the geometries when
+    # it fails or runs out of time (see Common/TaskGuard.py)
+    task = partial(overlay_state_guarded, overlay_coc_places_state, timeout=timeout, memory_limit=memory_limit)
+    # the pairs whose inputs and options did not change since the last run are skipped
+    manifest_path = os.path.join(base_dir, 'Intersection', 'Output', 'manifests', 'CoC@Places.json')
+    return run_cached(task, tasks, coc_places_paths, manifest_path, overlay_options(options),
+                      workers=workers, label='overlay_coc_places', force=force)
+
+
+# the build manifest skips the years and states that are already up to date
+year_to_process = range(2007, 2024)
 states_fips_codes = {
     'Alabama': '01',
     'Alaska': '02',
@@ -174,4 +244,26 @@ states_fips_codes = {
     'Virgin Islands of the United States': '78'
 }
 
-overlay_coc_places(year_to_process, states_fips_codes)
\ No newline at end of file
+# overlay options, see DEFAULT_OVERLAY_OPTIONS in Common/OverlayKernel.py
+# method: 'overlay' (gpd.overlay) or 'strtree' (pairwise STRtree kernel)
+# containment: assign the polygons lying inside a single CoC directly, only clip the ones on CoC boundaries
+# reuse: reuse the pieces of pairs that did not change since an earlier year (needs 'strtree')
+# output: 'files' (a shp and a csv per task) or 'dataset' (the partitioned Parquet dataset, see Common/ResultStore.py)
+# area: 'planar' (in the CRS of the CoC file), 'equal_area' or 'geodesic' (see Common/AreaEngine.py)
+# precision: grid size the geometries are snapped to after their repair, in CoC CRS units (see Common/Preprocess.py)
+# memory_budget: approximate memory of the overlay in MB, large states are then intersected tile by tile
+# (see Common/TiledOverlay.py), None intersects the whole state at once
+run_options = {'method': 'strtree', 'containment': True, 'reuse': True, 'area': 'equal_area'}
+
+# number of worker processes, each one holds a full state in memory during the overlay
+workers = 4
+
+# wall-clock limit of a task in seconds and memory limit of its process in MB (None for no limit), a task that fails
+# or runs out of either is retried with a heavier repair of the geometries (see Common/TaskGuard.py)
+task_timeout = 3600
+task_memory_limit = None
+
+# the guard is needed so that the worker processes do not re-run the whole batch when they import this script
+if __name__ == '__main__':
+    overlay_coc_places(year_to_process, states_fips_codes, workers=workers, timeout=task_timeout,
+                       memory_limit=task_memory_limit, **run_options)
@@ -50,71 +50,142 @@ Structure of the output files:
 """
 
 import os
-import geopandas as gpd
-
-
-def overlay_coc_subdivisions(years, states_fips, base_dir='D:\\UMich\\z-others\\Haolin_Code'):
-    for year in years:
-        for state, fips in states_fips.items():
-            # Construct the CoC shapefile path
-            coc_shp_path = os.path.join(base_dir, 'shapefiles', 'CoC_Merged', str(year), state,
-                                        f"{state.replace(' ', '_')}_{year}_CoC_Merged.shp")
-            # Construct the subdivisions shapefile path
-            subdivisions_prefix = 'fe' if year == 2007 else 'tl'
-            subdivisions_suffix = '10' if year == 2010 else ''
-            year_dir = year if year != 2007 else '2007_Merged'
-            subdivisions_shp_path = os.path.join(base_dir, 'shapefiles', 'county subdivisions', str(year_dir),
-                                                 f"{fips}_{state.upper().replace(' ', '_')}",
-                                                 f"{subdivisions_prefix}_{year}_{fips}_cousub{subdivisions_suffix}.shp")
-
-            # Read the shapefiles as GeoDataFrames
-            coc_gdf = gpd.read_file(coc_shp_path)
-            subdivisions_gdf = gpd.read_file(subdivisions_shp_path)
-
-            # Check CRS
-            if coc_gdf.crs is None:
-                print(f'CRS for {coc_shp_path} is None. passing for now ...')
-                continue
-            if subdivisions_gdf.crs is None:
-                print(f'CRS for {subdivisions_shp_path} is None. passing for now ...')
-                continue
-            try:
-                if coc_gdf.crs != subdivisions_gdf.crs:
-                    subdivisions_gdf = subdivisions_gdf.to_crs(
-                        coc_gdf.crs)  # Reproject subdivisions shapefile to match CoC shapefile
-            except ValueError as e:
-                print(f"Error reprojecting CoC shapefile: {e}")
-                continue
-
-            # Perform the overlay operation
-            intersected_gdf = gpd.overlay(coc_gdf, subdivisions_gdf, how='intersection')
-
-            intersected_gdf['area'] = intersected_gdf['geometry'].area
-            subdivisions_gdf['total_area'] = subdivisions_gdf['geometry'].area
-            subdivisions_areas = subdivisions_gdf[['COUSUBFP' if year != 2010 else 'COUSUBFP10', 'total_area']].drop_duplicates()
-
-            # merge the total area of each subdivision to the intersected_gdf
-            intersected_gdf = intersected_gdf.merge(subdivisions_areas, on='COUSUBFP' if year != 2010 else 'COUSUBFP10', how='left')
-
-            # calculate the percentage
-            intersected_gdf['%of_subdiv'] = intersected_gdf['area'] / intersected_gdf['total_area']
-
-            # drop the columns that are not needed
-            intersected_gdf = intersected_gdf.drop(columns=['total_area', 'area'])
-
-            output_dir = os.path.join(base_dir, 'Intersection', 'Output', str(year), 'CoC@Subdivisions')
-            if not os.path.exists(os.path.join(output_dir, 'shp')):
-                os.makedirs(os.path.join(output_dir, 'shp'))
-            output_shp_path = os.path.join(output_dir, 'shp', f"CoC_Subdivisions_{fips}_{state}_{str(year)[2:]}.shp")
-
-            intersected_gdf.to_file(output_shp_path)
-            output_dir = os.path.join(base_dir, 'Intersection', 'Output', str(year), 'CoC@Subdivisions')
-            if not os.path.exists(os.path.join(output_dir, 'csv')):
-                os.makedirs(os.path.join(output_dir, 'csv'))
-            output_csv_path = os.path.join(output_dir, 'csv', f"CoC_Subdivisions_{fips}_{state}_{str(year)[2:]}.csv")
-            intersected_gdf.drop('geometry',axis=1).to_csv(output_csv_path, index=False)
-
-            print(f"Finished CoC@Subdivisions processing for {state} {year}")
+import sys
+from functools import partial
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Common.AreaEngine import reproject, shares
+from Common.BuildCache import run_cached
+from Common.Catalog import find_layer
+from Common.GeoStore import read_layer, resolve_layer
+from Common.OverlayKernel import intersect, overlay_options
+from Common.PieceStore import PieceStore
+from Common.Preprocess import preprocess_dir, preprocess_layer
+from Common.ResultStore import partition_path, write_partition
+from Common.RunLog import StageLog
+from Common.TaskGuard import overlay_state_guarded
+
+
+def coc_subdivisions_paths(year, state, fips, base_dir, options=None):
+    # Construct the CoC shapefile path
+    coc_shp_path = os.path.join(base_dir, 'shapefiles', 'CoC_Merged', str(year), state,
+                                f"{state.replace(' ', '_')}_{year}_CoC_Merged.shp")
+    # Construct the subdivisions shapefile path
+    subdivisions_prefix = 'fe' if year == 2007 else 'tl'
+    subdivisions_suffix = '10' if year == 2010 else ''
+    year_dir = year if year != 2007 else '2007_Merged'
+    subdivisions_shp_path = os.path.join(base_dir, 'shapefiles', 'county subdivisions', str(year_dir),
+                                         f"{fips}_{state.upper().replace(' ', '_')}",
+                                         f"{subdivisions_prefix}_{year}_{fips}_cousub{subdivisions_suffix}.shp")
+    # an input recorded in the input catalog is taken from it, see Common/Catalog.py
+    shapefiles_dir = os.path.join(base_dir, 'shapefiles')
+    coc_shp_path = find_layer(shapefiles_dir, 'CoC_Merged', year, state) or coc_shp_path
+    subdivisions_shp_path = find_layer(shapefiles_dir, 'county subdivisions', year, fips=fips) or subdivisions_shp_path
+
+    # Construct the output paths
+    output_dir = os.path.join(base_dir, 'Intersection', 'Output', str(year), 'CoC@Subdivisions')
+    output_shp_path = os.path.join(output_dir, 'shp', f"CoC_Subdivisions_{fips}_{state}_{str(year)[2:]}.shp")
+    output_csv_path = os.path.join(output_dir, 'csv', f"CoC_Subdivisions_{fips}_{state}_{str(year)[2:]}.csv")
+
+    # the GeoParquet version of an input, or the shapefile inside its downloaded zip archive, is read instead when
+    # that is what is there, see Common/GeoStore.py
+    inputs = [resolve_layer(coc_shp_path), resolve_layer(subdivisions_shp_path)]
+    # with output='dataset' the result goes to a partition of the result dataset, see Common/ResultStore.py
+    if overlay_options(options)['output'] == 'dataset':
+        return inputs, [partition_path(base_dir, year, 'Subdivisions', state)]
+    return inputs, [output_shp_path, output_csv_path]
+
+
+def overlay_coc_subdivisions_state(year, state, fips, base_dir, options=None, coc_gdf=None, coc_tree=None):
+    options = overlay_options(options)
+    log = StageLog('overlay_coc_subdivisions', year=year, state=state)
+    (coc_shp_path, subdivisions_shp_path), outputs = coc_subdivisions_paths(year, state, fips, base_dir, options)
+
+    # Read the shapefiles as GeoDataFrames
+    # (the CoC layer and its spatial index can be passed in already loaded and preprocessed, see CoC@AllLayers.py)
+    preprocessed = coc_gdf is not None
+    if coc_gdf is None:
+        coc_gdf = read_layer(coc_shp_path)
+    subdivisions_gdf = read_layer(subdivisions_shp_path)
+    log.lap('read', coc_gdf, subdivisions_gdf)
+
+    # Check CRS
+    if coc_gdf.crs is None:
+        print(f'CRS for {coc_shp_path} is None. passing for now ...')
+        return
+    if subdivisions_gdf.crs is None:
+        print(f'CRS for {subdivisions_shp_path} is None. passing for now ...')
+        return
+    try:
+        if coc_gdf.crs != subdivisions_gdf.crs:
+            # Reproject subdivisions shapefile to match CoC shapefile
+            subdivisions_gdf = reproject(subdivisions_gdf, coc_gdf.crs)
+    except ValueError as e:
+        print(f"Error reprojecting CoC shapefile: {e}")
+        return
+    log.lap('reproject')
+
+    # repair the geometries and snap them to the precision grid, cached per input file (see Common/Preprocess.py)
+    if not preprocessed:
+        coc_gdf = preprocess_layer(coc_gdf, coc_shp_path, options['precision'], preprocess_dir(base_dir),
+                                   repair=options['repair'])
+    subdivisions_gdf = preprocess_layer(subdivisions_gdf, subdivisions_shp_path, options['precision'],
+                                        preprocess_dir(base_dir),
+                                        repair=options['repair'])
+    log.lap('preprocess', coc_gdf, subdivisions_gdf)
+
+    # Perform the overlay operation
+    # the pieces of the (CoC, subdivision) pairs that did not change since an earlier year are reused
+    store = None
+    if options['reuse']:
+        store = PieceStore(os.path.join(base_dir, 'Intersection', 'Output', 'pieces', 'CoC@Subdivisions.sqlite'))
+    intersected_gdf = intersect(coc_gdf, subdivisions_gdf, method=options['method'], containment=options['containment'],
+                                store=store, tree1=coc_tree, memory_budget=options['memory_budget'], rows=True)
+    if store is not None:
+        store.close()
+    log.lap('overlay', intersected_gdf)
+
+    # the share of the subdivision and of the CoC each piece covers, the areas of both layers are looked up by the row
+    # positions intersect() carried through the overlay (see Common/AreaEngine.py)
+    coc_share, subdivision_share = shares(intersected_gdf, coc_gdf, subdivisions_gdf, options['area'], options['area_crs'])
+    intersected_gdf = intersected_gdf.drop(columns=['__row1', '__row2'])
+    intersected_gdf['%of_subdiv'] = subdivision_share
+    intersected_gdf['%of_coc'] = coc_share
+    log.lap('area', intersected_gdf)
+
+    # with output='dataset' the result goes to the result dataset instead of a shp and a csv
+    if options['output'] == 'dataset':
+        write_partition(intersected_gdf, base_dir, year, 'Subdivisions', state)
+        log.lap('write')
+        print(f"Finished CoC@Subdivisions processing for {state} {year} (dataset)")
+        return outputs
+    output_shp_path, output_csv_path = outputs
+
+    if not os.path.exists(os.path.dirname(output_shp_path)):
+        os.makedirs(os.path.dirname(output_shp_path))
+    intersected_gdf.to_file(output_shp_path)
+
+    if not os.path.exists(os.path.dirname(output_csv_path)):
+        os.makedirs(os.path.dirname(output_csv_path))
+    intersected_gdf.drop('geometry',axis=1).to_csv(output_csv_path, index=False)
+    log.lap('write')
+
+    print(f"Finished CoC@Subdivisions processing for {state} {year}")
+    return outputs
+
+
+def overlay_coc_subdivisions(years, states_fips, base_dir='D:\\UMich\\z-others\\Haolin_Code', workers=1, force=False,
+                             timeout=None, memory_limit=None, **options):
+    # every (year, state) pair is independent, so they can be spread over a pool of worker processes
+    tasks = [(year, state, fips, base_dir, options) for year in years for state, fips in states_fips.items()]
+    # each task runs under the time and memory limits, and is retried with a heavier repair of the geometries when
+    # it fails or runs out of time (see Common/TaskGuard.py)
+    task = partial(overlay_state_guarded, overlay_coc_subdivisions_state, timeout=timeout, memory_limit=memory_limit)
+    # the pairs whose inputs and options did not change since the last run are skipped
+    manifest_path = os.path.join(base_dir, 'Intersection', 'Output', 'manifests', 'CoC@Subdivisions.json')
+    return run_cached(task, tasks, coc_subdivisions_paths, manifest_path,
+                      overlay_options(options), workers=workers, label='overlay_coc_subdivisions', force=force)
+
 
 year_to_process = range(2007, 2024)
 states_fips_codes = {
@@ -139,4 +210,26 @@ states_fips_codes = {
     'Wisconsin': '55',
 }
 
-overlay_coc_subdivisions(year_to_process, states_fips_codes)
+# overlay options, see DEFAULT_OVERLAY_OPTIONS in Common/OverlayKernel.py
+# method: 'overlay' (gpd.overlay) or 'strtree' (pairwise STRtree kernel)
+# containment: assign the polygons lying inside a single CoC directly, only clip the ones on CoC boundaries
+# reuse: reuse the pieces of pairs that did not change since an earlier year (needs 'strtree')
+# output: 'files' (a shp and a csv per task) or 'dataset' (the partitioned Parquet dataset, see Common/ResultStore.py)
+# area: 'planar' (in the CRS of the CoC file), 'equal_area' or 'geodesic' (see Common/AreaEngine.py)
+# precision: grid size the geometries are snapped to after their repair, in CoC CRS units (see Common/Preprocess.py)
+# memory_budget: approximate memory of the overlay in MB, large states are then intersected tile by tile
+# (see Common/TiledOverlay.py), None intersects the whole state at once
+run_options = {'method': 'strtree', 'containment': True, 'reuse': True, 'area': 'equal_area'}
+
+# number of worker processes, each one holds a full state in memory during the overlay
+workers = 4
+
+# wall-clock limit of a task in seconds and memory limit of its process in MB (None for no limit), a task that fails
+# or runs out of either is retried with a heavier repair of the geometries (see Common/TaskGuard.py)
+task_timeout = 3600
+task_memory_limit = None
+
+# the guard is needed so that the worker processes do not re-run the whole batch when they import this script
+if __name__ == '__main__':
+    overlay_coc_subdivisions(year_to_process, states_fips_codes, workers=workers, timeout=task_timeout,
+                             memory_limit=task_memory_limit, **run_options)
@@ -0,0 +1,89 @@
+"""
+This script exports the per-state shapefiles and csv tables from the result dataset (output='dataset', see
+Common/ResultStore.py), with the names and the layout the Intersection scripts write with output='files':
+- Intersection
+    - Output
+        - 2007
+            - CoC@Counties
+                - shp
+                    - CoC_Counties_01_Alabama_07.shp
+                    - ...
+                - csv
+                    - CoC_Counties_01_Alabama_07.csv
+                    - ...
+
+The geometry of the exported shapefiles is in the CRS of the dataset (NAD83).
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Common.ResultStore import export_results
+
+base_dir = 'D:\\UMich\\z-others\\Haolin_Code'
+years_to_export = range(2007, 2024)
+layers_to_export = ['Counties', 'Places', 'Subdivisions']
+# csv only is much faster when the geometry is not needed
+formats = ('shp', 'csv')
+
+states_fips_codes = {
+    'Alabama': '01',
+    'Alaska': '02',
+    'Arizona': '04',
+    'Arkansas': '05',
+    'California': '06',
+    'Colorado': '08',
+    'Connecticut': '09',
+    'Delaware': '10',
+    'District of Columbia': '11',
+    'Florida': '12',
+    'Georgia': '13',
+    'Hawaii': '15',
+    'Idaho': '16',
+    'Illinois': '17',
+    'Indiana': '18',
+    'Iowa': '19',
+    'Kansas': '20',
+    'Kentucky': '21',
+    'Louisiana': '22',
+    'Maine': '23',
+    'Maryland': '24',
+    'Massachusetts': '25',
+    'Michigan': '26',
+    'Minnesota': '27',
+    'Mississippi': '28',
+    'Missouri': '29',
+    'Montana': '30',
+    'Nebraska': '31',
+    'Nevada': '32',
+    'New Hampshire': '33',
+    'New Jersey': '34',
+    'New Mexico': '35',
+    'New York': '36',
+    'North Carolina': '37',
+    'North Dakota': '38',
+    'Ohio': '39',
+    'Oklahoma': '40',
+    'Oregon': '41',
+    'Pennsylvania': '42',
+    'Rhode Island': '44',
+    'South Carolina': '45',
+    'South Dakota': '46',
+    'Tennessee': '47',
+    'Texas': '48',
+    'Utah': '49',
+    'Vermont': '50',
+    'Virginia': '51',
+    'Washington': '53',
+    'West Virginia': '54',
+    'Wisconsin': '55',
+    'Wyoming': '56',
+    'Guam': '66',
+    'Puerto Rico': '72',
+    'Virgin Islands of the United States': '78'
+}
+
+if __name__ == '__main__':
+    written = export_results(base_dir, states_fips_codes, years_to_export, layers_to_export, formats)
+    print(f"Exported {len(written)} files")
@@ -1,67 +1,89 @@
 import os
-import geopandas as gpd
-import pandas as pd
-
-
-def merge_shapefiles(base_dir, years, states):
-    for year in years:
-        for state in states:
-            # Define the directory for the current state and year within the Continuum of Care folder
-            state_dir = os.path.join(base_dir, 'Continuums of Care', str(year), state)
-            # Define the directory to store merged shapefiles outside the Continuum of Care folder, in a parallel 'Merged' folder
-            merged_dir = os.path.join(base_dir, 'CoC_Merged', str(year), state)
-
-            # Create a directory for merged shapefiles if it doesn't exist
-            if not os.path.exists(merged_dir):
-                os.makedirs(merged_dir)
-
-            # Initialize an empty list to hold GeoDataFrames
-            gdfs = []
-
-            # Adjust the path and filename handling based on the year
-            if year in [2007, 2008, 2009]:
-                # List all shapefiles in the state's directory for the year
-                if os.path.exists(state_dir):
-                    shapefiles = [f for f in os.listdir(state_dir) if f.endswith('.shp')]
-
-                    # Load each shapefile into a GeoDataFrame and add it to the list
-                    for shp in shapefiles:
-                        filepath = os.path.join(state_dir, shp)
-                        gdf = gpd.read_file(filepath)
-                        # Extract the CoC number from the filename based on year-specific patterns
-                        if year == 2007:
-                            coc_number = shp.split('-')[1].split('.')[0]
-                        elif year == 2008:
-                            coc_number = shp.split('_')[1].split('.')[0]
-                        elif year == 2009:
-                            coc_number = shp.split('_')[1].split('.')[0]
-                        # Create a new column 'CoC_Number' with the extracted CoC number
-                        gdf['CoC_Number'] = coc_number
-                        gdfs.append(gdf)
-
-            elif year >= 2010:
-                # For 2010, each shapefile is stored in a subfolder
-                subdirs = [d for d in os.listdir(state_dir) if os.path.isdir(os.path.join(state_dir, d))]
-                for subdir in subdirs:
-                    shp_path = os.path.join(state_dir, subdir)
-                    shapefiles = [f for f in os.listdir(shp_path) if f.endswith('.shp')]
-                    for shp in shapefiles:
-                        filepath = os.path.join(shp_path, shp)
-                        gdf = gpd.read_file(filepath)
-                        # Extract the CoC number from the subdirectory name
-                        coc_number = subdir.split('_')[1]
-                        # Create a new column 'CoC_Number' with the extracted CoC number
-                        gdf['CoC_Number'] = coc_number
-                        gdfs.append(gdf)
-
-            # Merge all GeoDataFrames into one
-            if gdfs:  # Check if the list is not empty
-                merged_gdf = gpd.GeoDataFrame(pd.concat(gdfs, ignore_index=True))
-
-                # Save the merged GeoDataFrame to a new shapefile
-                output_filename = f'{state.replace(" ", "_")}_{year}_CoC_Merged.shp'
-                merged_gdf.to_file(os.path.join(merged_dir, output_filename))
-                print(f'Saved Merged File for {state} {year}')  # Print a message to the console
+import sys
+import zipfile
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Common.Catalog import find_parts
+from Common.GeoStore import concat_layers, vsizip_path, write_layer
+from Common.ParallelRunner import run_tasks
+from Common.RunLog import StageLog
+
+
+def coc_shapefiles(state_dir, year):
+    """
+    The CoC shapefiles of a state as (path, path relative to the state folder) pairs: from 2007 to 2009 the shapefiles
+    in the state folder, from 2010 on those in a subfolder per CoC. When nothing was extracted, the shapefiles are read
+    from inside the downloaded CoC_GIS_State_Shapefile archive (/vsizip/ paths, see Common/GeoStore.py).
+    """
+    if not os.path.exists(state_dir):
+        return []
+    depth = 1 if year in [2007, 2008, 2009] else 2
+    shapefiles = []
+    for root, dirs, files in os.walk(state_dir):
+        relative_dir = os.path.relpath(root, state_dir)
+        parts = [] if relative_dir == '.' else relative_dir.split(os.sep)
+        shapefiles.extend((os.path.join(root, f), '/'.join(parts + [f])) for f in files
+                          if f.endswith('.shp') and len(parts) + 1 == depth)
+    if shapefiles:
+        return shapefiles
+
+    for archive_name in os.listdir(state_dir):
+        if not (archive_name.startswith('CoC_GIS_State_Shapefile') and archive_name.endswith('.zip')):
+            continue
+        zip_path = os.path.join(state_dir, archive_name)
+        with zipfile.ZipFile(zip_path) as archive:
+            members = [m for m in archive.namelist() if m.endswith('.shp')]
+        # the members are under a top folder, which the extraction used to drop
+        shapefiles.extend((vsizip_path(zip_path, m), '/'.join(m.split('/')[1:])) for m in members
+                          if len(m.split('/')) - 1 == depth)
+    return shapefiles
+
+
+def coc_number(relative_path, year):
+    # the CoC number is in the file name (2007 - 2009) or the subfolder name (2010 on)
+    if year == 2007:
+        return relative_path.split('-')[1].split('.')[0]
+    if year in [2008, 2009]:
+        return relative_path.split('_')[1].split('.')[0]
+    return relative_path.split('/')[0].split('_')[1]
+
+
+def merge_coc_state(base_dir, year, state, fmt='shp'):
+    log = StageLog('merge_shapefiles', year=year, state=state)
+    # Define the directory for the current state and year within the Continuum of Care folder
+    state_dir = os.path.join(base_dir, 'Continuums of Care', str(year), state)
+    # Define the directory to store merged shapefiles outside the Continuum of Care folder, in a parallel 'Merged' folder
+    merged_dir = os.path.join(base_dir, 'CoC_Merged', str(year), state)
+
+    # Create a directory for merged shapefiles if it doesn't exist
+    if not os.path.exists(merged_dir):
+        os.makedirs(merged_dir)
+
+    # The CoC shapefiles of the state as recorded in the input catalog (see Common/Catalog.py), else as found in the
+    # state folder (extracted or inside the downloaded archive)
+    depth = 1 if year in [2007, 2008, 2009] else 2
+    shapefiles = [(path, part) for path, part in find_parts(base_dir, 'Continuums of Care', year, state)
+                  if len(part.split('/')) == depth] or coc_shapefiles(state_dir, year)
+    # Read them in one pass of Arrow batches, the 'CoC_Number' column is filled with the CoC number of the file each
+    # row comes from
+    merged_gdf = concat_layers([path for path, _ in shapefiles], 'CoC_Number',
+                               [coc_number(relative_path, year) for _, relative_path in shapefiles])
+    log.lap('read', merged_gdf)
+
+    if merged_gdf is None:
+        return None
+    # Save the merged GeoDataFrame to a new shapefile (or GeoParquet file, see Common/GeoStore.py)
+    output_filename = f'{state.replace(" ", "_")}_{year}_CoC_Merged.shp'
+    path = write_layer(merged_gdf, os.path.join(merged_dir, output_filename), fmt)
+    log.lap('write', merged_gdf)
+    print(f'Saved Merged File for {state} {year}')  # Print a message to the console
+    return path
+
+
+def merge_shapefiles(base_dir, years, states, fmt='shp', workers=1):
+    """Merge the CoC shapefiles of every (year, state), on a pool of worker processes, see run_tasks."""
+    return run_tasks(merge_coc_state, [(base_dir, year, state, fmt) for year in years for state in states],
+                     workers=workers, label='CoC merge')
 
 
 # Base directory where the 'Continuum of Care' folders are located
@@ -88,5 +110,12 @@ territories = ["District of Columbia", "Guam", "Puerto Rico", "Virgin Islands of
 # Combine the states and territories into one list
 states_to_process = states + territories
 
+# Format of the merged files: 'shp' or 'parquet' (GeoParquet, read by the Intersection and AddiInter scripts too)
+intermediate_format = 'shp'
+
+# number of worker processes, the (year, state) merges run in parallel
+workers = 4
+
 # Call the function with the specified parameters
-merge_shapefiles(base_directory, years_to_process, states_to_process)
+if __name__ == '__main__':
+    merge_shapefiles(base_directory, years_to_process, states_to_process, intermediate_format, workers)
@@ -1,44 +1,58 @@
 import os
-import pandas as pd
-import geopandas as gpd
+import sys
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Common.Catalog import find_parts
+from Common.GeoStore import concat_layers, write_layer
+from Common.ParallelRunner import run_tasks
+from Common.RunLog import StageLog
 
-def merge_county_subdivisions(base_dir, year, states_fips):
-    merged_base_dir = os.path.join(base_dir, 'shapefiles', 'county subdivisions', 'Merged', str(year))
 
-    for state, fips in states_fips.items():
-        # Define the directory for the current state and year within the county subdivisions folder
-        state_dir = os.path.join(base_dir, 'shapefiles', 'county subdivisions', str(year), f"{fips}_{state.upper()}")
-        # Define the directory to store merged shapefiles in the 'Merged' folder within the specific state directory
-        merged_state_dir = os.path.join(merged_base_dir, f"{fips}_{state.upper()}")
+def county_shapefiles(state_dir):
+    # the shapefiles in the county directories of a state
+    shapefiles = []
+    if os.path.exists(state_dir):
+        counties = [d for d in os.listdir(state_dir) if os.path.isdir(os.path.join(state_dir, d))]
+        for county in counties:
+            county_dir = os.path.join(state_dir, county)
+            shapefiles.extend(os.path.join(county_dir, f) for f in os.listdir(county_dir) if f.endswith('.shp'))
+    return shapefiles
 
-        # Create a directory for merged shapefiles if it doesn't exist
-        if not os.path.exists(merged_state_dir):
-            os.makedirs(merged_state_dir)
 
-        # Initialize an empty list to hold GeoDataFrames
-        gdfs = []
+def merge_state_subdivisions(base_dir, year, state, fips, fmt='shp'):
+    log = StageLog('merge_county_subdivisions', year=year, state=state)
+    # Define the directory for the current state and year within the county subdivisions folder
+    state_dir = os.path.join(base_dir, 'shapefiles', 'county subdivisions', str(year), f"{fips}_{state.upper()}")
+    # Define the directory to store merged shapefiles in the 'Merged' folder within the specific state directory
+    merged_state_dir = os.path.join(base_dir, 'shapefiles', 'county subdivisions', 'Merged', str(year),
+                                    f"{fips}_{state.upper()}")
 
-        # Check if the state directory exists and list all subdirectories (each representing a county)
-        if os.path.exists(state_dir):
-            counties = [d for d in os.listdir(state_dir) if os.path.isdir(os.path.join(state_dir, d))]
+    # Create a directory for merged shapefiles if it doesn't exist
+    if not os.path.exists(merged_state_dir):
+        os.makedirs(merged_state_dir)
 
-            # Loop through each county directory to find and process shapefiles
-            for county in counties:
-                county_dir = os.path.join(state_dir, county)
-                shapefiles = [f for f in os.listdir(county_dir) if f.endswith('.shp')]
-                for shp in shapefiles:
-                    filepath = os.path.join(county_dir, shp)
-                    gdf = gpd.read_file(filepath)
-                    gdfs.append(gdf)
+    # The shapefiles of the counties as recorded in the input catalog (see Common/Catalog.py), else as found in the
+    # county directories
+    catalogued = find_parts(os.path.join(base_dir, 'shapefiles'), 'county subdivisions', year, fips=fips)
+    shapefiles = [path for path, part in catalogued if len(part.split('/')) == 2] or county_shapefiles(state_dir)
+    # Read them as Arrow batches and concatenate them once
+    merged_gdf = concat_layers(shapefiles)
+    log.lap('read', merged_gdf)
 
-        # Merge all GeoDataFrames into one
-        if gdfs:  # Check if the list is not empty
-            merged_gdf = gpd.GeoDataFrame(pd.concat(gdfs, ignore_index=True))
+    if merged_gdf is None:
+        return None
+    # Save the merged GeoDataFrame to a new shapefile (or GeoParquet file) in the specific state's Merged directory
+    output_filename = f'fe_{year}_{fips}_cousub.shp'
+    path = write_layer(merged_gdf, os.path.join(merged_state_dir, output_filename), fmt)
+    log.lap('write', merged_gdf)
+    return path
 
-            # Save the merged GeoDataFrame to a new shapefile in the specific state's Merged directory
-            output_filename = f'fe_{year}_{fips}_cousub.shp'
-            merged_gdf.to_file(os.path.join(merged_state_dir, output_filename))
+
+def merge_county_subdivisions(base_dir, year, states_fips, fmt='shp', workers=1):
+    """Merge the county subdivisions of every state, on a pool of worker processes, see run_tasks."""
+    return run_tasks(merge_state_subdivisions,
+                     [(base_dir, year, state, fips, fmt) for state, fips in states_fips.items()],
+                     workers=workers, label='subdivision merge')
 
 
 # Base directory where the 'county subdivisions' folder is located
@@ -70,5 +84,12 @@ states_fips_codes = {
     'Wisconsin': '55',
 }
 
+# Format of the merged files: 'shp' or 'parquet' (GeoParquet, see Common/GeoStore.py)
+intermediate_format = 'shp'
+
+# number of worker processes, the states are merged in parallel
+workers = 4
+
 # Call the function with the specified parameters
-merge_county_subdivisions(base_directory, year_to_process, states_fips_codes)
+if __name__ == '__main__':
+    merge_county_subdivisions(base_directory, year_to_process, states_fips_codes, intermediate_format, workers)
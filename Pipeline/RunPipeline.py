@@ -0,0 +1,225 @@
+"""
+This script runs the whole pipeline (download, merge, split and overlay) as one graph of dependent tasks, instead of
+running the BulkDownload, Merge, CountyProcess and Intersection scripts by hand one after the other.
+
+There is a task per (stage, year, state, layer), with the dependencies:
+    download CoC archive      -> merge the CoC files of the state (Merge/CoCMerge.py)  -> overlays of the state
+    download counties         -> county store of the year, 2011 on (CountyProcess)     -> counties overlay
+    download places           -> places overlay
+    download subdivisions     -> subdivisions overlay (2007: fetched and merged per state in one task)
+
+Every task starts as soon as the tasks it depends on have finished (see Common/TaskGraph.py): the downloads run on a
+thread pool, the merges, county stores and overlays on `workers` processes, so the overlays of the first states run
+while the other states are still downloading. A failed task blocks only the tasks downstream of it.
+
+The finished tasks are recorded in the journal, <base_dir>/pipeline_journal.json. Running the script again after an
+interruption or a failure resumes the run: only the tasks that did not finish are run. Set resume = False to run
+every task again (the downloads then still skip the archives that did not change, see Common/Downloader.py).
+
+The outputs are the same as those of the individual scripts, in the same folders:
+- <base_dir>
+    - shapefiles
+        - Continuums of Care, CoC_Merged, counties, Census places, county subdivisions
+    - Intersection
+        - Output
+    - pipeline_journal.json
+"""
+
+import importlib.util
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Common.CountyStore import build_county_store
+from Common.Downloader import Downloader
+from Common.GeoStore import resolve_layer
+from Common.TaskGraph import TaskGraph
+from Common.TaskGuard import overlay_state_guarded
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_script(relative_path):
+    # the scripts are not in packages (and some names contain an '@'), so they are loaded from their file
+    module_name = os.path.splitext(os.path.basename(relative_path))[0].replace('@', '_')
+    if module_name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(REPO_DIR, relative_path))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[module_name]
+
+
+coc_download = load_script(os.path.join('BulkDownload', 'CoCDownload', 'CoCDownload.py'))
+counties_download = load_script(os.path.join('BulkDownload', 'CountiesDownload', 'CountiesDownload.py'))
+places_download = load_script(os.path.join('BulkDownload', 'PlacesDownload', 'PlacesDownload.py'))
+subdivisions_download = load_script(os.path.join('BulkDownload', 'SubdivisionsDownload', 'SubdivisionsDownload.py'))
+subdivisions_download_2007 = load_script(os.path.join('BulkDownload', 'SubdivisionsDownload',
+                                                      'SubdivisionsDownload_for2007.py'))
+coc_merge = load_script(os.path.join('Merge', 'CoCMerge.py'))
+all_layers = load_script(os.path.join('Intersection', 'CoC@AllLayers.py'))
+
+# the download function of each census layer and the states (fips -> NAME) it knows
+census_downloads = {
+    'counties': (counties_download.download_and_extract_county, counties_download.states_and_territories),
+    'Census places': (places_download.download_and_extract, places_download.states_and_territories),
+    'county subdivisions': (subdivisions_download.download_and_extract_cousub, subdivisions_download.specified_states),
+}
+
+
+def download(func, *args):
+    # a download script reports a failed download with its HTTP status, the task fails so that nothing reads it
+    status = func(*args)
+    if status not in (200, 304):
+        raise IOError(f"Download failed with HTTP status {status}")
+    return status
+
+
+def fetch_and_merge_subdivisions_2007(counties, state_key, output_dir, fmt):
+    # the county archives of a state, merged as they come in, see SubdivisionsDownload_for2007.py
+    subdivisions_download_2007.fetch_and_merge_subdivisions({state_key: counties}, 2007, output_dir, fmt)
+    path = resolve_layer(os.path.join(output_dir, state_key.replace(' ', '_'),
+                                      f"fe_2007_{state_key.split('_')[0]}_cousub.shp"))
+    if not os.path.exists(path):
+        raise IOError(f"No county subdivisions fetched for {state_key}")
+    return path
+
+
+def overlay(layer_type, year, state, fips, base_dir, options, timeout=None, memory_limit=None):
+    # the state function of the Intersection script of the layer (see Intersection/CoC@AllLayers.py), under the time
+    # and memory limits and retried with heavier repairs when it fails or runs out of time (see Common/TaskGuard.py)
+    outputs = overlay_state_guarded(all_layers.layers[layer_type][0], year, state, fips, base_dir, options, timeout,
+                                    memory_limit)
+    if outputs is None:
+        raise RuntimeError(f"The {layer_type} overlay of {state} {year} wrote no output")
+    return outputs
+
+
+def configure_downloads(base_dir, hud_url, census_url, download_workers=8, rate_limit=4):
+    """Point the download scripts at the shapefiles folder of base_dir (and the given servers), one manifest each."""
+    shapefiles_dir = os.path.join(base_dir, 'shapefiles')
+    for script, layer_type in ((coc_download, 'Continuums of Care'), (counties_download, 'counties'),
+                               (places_download, 'Census places'), (subdivisions_download, 'county subdivisions')):
+        script.target_directory = os.path.join(shapefiles_dir, layer_type)
+        script.base_url = census_url
+        script.downloader = Downloader(workers=download_workers, rate_limit=rate_limit,
+                                       manifest=os.path.join(script.target_directory, 'download_manifest.json'))
+    coc_download.base_url = hud_url
+    subdivisions_download_2007.base_url = census_url
+    # the 2007 county archives are kept next to the other county subdivisions, as SubdivisionMerge.py reads them
+    subdivisions_download_2007.data_directory = os.path.join(shapefiles_dir, 'county subdivisions', '2007')
+    subdivisions_download_2007.downloader = Downloader(
+        workers=download_workers, rate_limit=rate_limit,
+        manifest=os.path.join(subdivisions_download_2007.data_directory, 'download_manifest.json'))
+
+
+def build_pipeline(base_dir, years, states, layer_types, stages=('download', 'merge', 'split', 'overlay'),
+                   options=None, fmt='shp', fips_csv=None, timeout=None, memory_limit=None):
+    """
+    The task graph of the pipeline, see the module docstring.
+
+    :param states: dict state name (e.g. 'Rhode Island') -> fips
+    :param layer_types: census layers to overlay, see Intersection/CoC@AllLayers.py
+    :param options: run options overriding those of the Intersection script of each layer, see layer_options in
+                    Intersection/CoC@AllLayers.py
+    :param stages: the stages to run, the tasks of the other stages are assumed done (e.g. without 'download' the
+                   archives already on disk are used)
+    :param fmt: format of the merged files, 'shp' or 'parquet'
+    :param fips_csv: the csv of the counties of the 2007 county subdivision archives
+    :param timeout: wall-clock limit of an overlay task in seconds, None for no limit
+    :param memory_limit: memory limit of the process of an overlay task in MB, None for no limit
+    """
+    shapefiles_dir = os.path.join(base_dir, 'shapefiles')
+    coc_abbreviations = {name: abbreviation for abbreviation, name in coc_download.states.items()}
+    counties_2007 = (subdivisions_download_2007.read_csv_to_dict(fips_csv)
+                     if fips_csv is not None and 2007 in years and 'county subdivisions' in layer_types else {})
+    graph = TaskGraph()
+
+    def add(name, func, args, deps=(), threads=False):
+        # only the tasks of the selected stages are added, and only those are waited on
+        if name[0] in stages:
+            graph.add(name, func, args, [dep for dep in deps if dep in graph], threads)
+        return name
+
+    for year in years:
+        if year >= 2011 and 'counties' in layer_types:
+            # one national county file per year, split into the county store of the year
+            downloaded = add(('download', year, 'us', 'counties'), download,
+                             (counties_download.download_and_extract_county, year, 'us', 'USA'), threads=True)
+            add(('split', year, 'us', 'counties'), build_county_store,
+                (os.path.join(shapefiles_dir, 'counties'), year), [downloaded])
+
+        for state, fips in states.items():
+            downloaded = add(('download', year, state, 'CoC'), download,
+                             (coc_download.download_and_extract_coc_state, year, coc_abbreviations[state], state,
+                              coc_download.base_url, coc_download.target_directory), threads=True)
+            merged = add(('merge', year, state, 'CoC'), coc_merge.merge_coc_state,
+                         (shapefiles_dir, year, state, fmt), [downloaded])
+
+            for layer_type in layer_types:
+                if state not in all_layers.layers[layer_type][3]:
+                    continue
+                download_state, names = census_downloads[layer_type]
+                if layer_type == 'counties' and year >= 2011:
+                    census = ('split', year, 'us', 'counties')
+                elif layer_type == 'county subdivisions' and year == 2007:
+                    state_key = f"{fips}_{state.upper()}"
+                    census = add(('download', year, state, layer_type), fetch_and_merge_subdivisions_2007,
+                                 (counties_2007.get(state_key, []), state_key,
+                                  os.path.join(shapefiles_dir, 'county subdivisions', '2007_Merged'), fmt),
+                                 threads=True)
+                else:
+                    census = add(('download', year, state, layer_type), download,
+                                 (download_state, year, fips, names[fips]), threads=True)
+                add(('overlay', year, state, layer_type), overlay,
+                    (layer_type, year, state, fips, base_dir, all_layers.layer_options(layer_type, options), timeout,
+                     memory_limit), [merged, census])
+    return graph
+
+
+def run_pipeline(base_dir, years, states, layer_types, stages=('download', 'merge', 'split', 'overlay'),
+                 options=None, fmt='shp', fips_csv=None, workers=4, threads=8, resume=True, timeout=None,
+                 memory_limit=None):
+    """Build the task graph and run it, resuming from the journal of an earlier run, see Common/TaskGraph.py."""
+    graph = build_pipeline(base_dir, years, states, layer_types, stages, options, fmt, fips_csv, timeout,
+                           memory_limit)
+    return graph.run(workers, threads, journal=os.path.join(base_dir, 'pipeline_journal.json'), resume=resume)
+
+
+# base directory holding the shapefiles folder, the outputs are written to its Intersection folder
+base_directory = "D:\\UMich\\z-others\\Haolin_Code"
+
+years_to_process = range(2007, 2024)
+# the states of the Intersection scripts (only the states listed in CoC@Subdivisions.py have county subdivisions)
+states_to_process = all_layers.layers['counties'][3]
+layers_to_process = ['counties', 'Census places', 'county subdivisions']
+stages_to_run = ('download', 'merge', 'split', 'overlay')
+
+# the overlays run with the run_options of the Intersection script of their layer, these override them for all layers
+# (see layer_options in Intersection/CoC@AllLayers.py and DEFAULT_OVERLAY_OPTIONS in Common/OverlayKernel.py)
+run_options = {}
+# Format of the merged files: 'shp' or 'parquet' (GeoParquet, see Common/GeoStore.py)
+intermediate_format = 'shp'
+
+# the HUD and Census servers, set to the url of a local fixture server to test (see Benchmark/FixtureServer.py)
+hud_url = "https://files.hudexchange.info/reports/published"
+census_url = "https://www2.census.gov/geo/tiger/"
+fips_by_state_csv = os.path.join(REPO_DIR, 'BulkDownload', 'SubdivisionsDownload', 'fips-by-state.csv')
+
+# number of worker processes for the merges, county stores and overlays, and of threads for the downloads
+workers = 4
+download_threads = 8
+
+# False runs every task again instead of resuming from the journal
+resume = True
+
+# wall-clock limit of an overlay task in seconds and memory limit of its process in MB (None for no limit), a task
+# that fails or runs out of either is retried with a heavier repair of the geometries (see Common/TaskGuard.py)
+task_timeout = 3600
+task_memory_limit = None
+
+if __name__ == '__main__':
+    configure_downloads(base_directory, hud_url, census_url)
+    run_pipeline(base_directory, years_to_process, states_to_process, layers_to_process, stages_to_run, run_options,
+                 intermediate_format, fips_by_state_csv, workers, download_threads, resume, task_timeout,
+                 task_memory_limit)